@@ -0,0 +1,167 @@
+# Nearest-neighbor search under DTW with a cascade of lower bounds
+#
+# For each candidate, cheap bounds are checked in order of increasing cost, and the candidate is pruned as soon as a
+# bound reaches the best-so-far distance:
+#   1) LB_Kim (first and last points - every warping path contains both)
+#   2) LB_Keogh(query, envelope(candidate))
+#   3) LB_Keogh(candidate, envelope(query))
+#   4) banded DTW, early abandoned at the best-so-far distance
+# Candidates are visited in order of increasing LB_Keogh so that the best-so-far tightens quickly.
+#
+# nearest_neighbor() searches for one query. assign_nearest() does the same for a whole batch of series against a
+# (small) set of centroids, evaluating each stage for all series at once.
+
+from collections import Counter
+import numpy as np
+
+from dtw import dtw_distance, dtw_distances
+from lb_keogh import envelope, lb_keogh_envelope
+
+PRUNE_STAGES = ['lb_kim', 'lb_keogh_qc', 'lb_keogh_cq', 'dtw_pruned', 'dtw_best']
+# dtw_pruned: DTW was started but abandoned (or finished) at or above the best-so-far
+# dtw_best: DTW finished below the best-so-far, i.e. candidate became the current nearest neighbor
+
+def lb_kim(query, candidates):
+    """
+    Return LB_Kim (first and last point) lower bound between query and every candidate
+
+    Parameters
+    ----------
+    query: 1-d array
+    candidates: 2-d array of dimension (num_candidates, max_len)
+    """
+    candidates = np.atleast_2d(candidates)
+    if candidates.shape[1] == 1:
+        return np.abs(query[0] - candidates[:, 0])
+    return np.sqrt((query[0] - candidates[:, 0]) ** 2 + (query[-1] - candidates[:, -1]) ** 2)
+
+def get_lb_radius(r, w, max_len):
+    """
+    Return LB_Keogh envelope window size that keeps LB_Keogh a lower bound to DTW with band w.
+
+    The envelope of index i covers [i-r, i+r-1] (see lb_keogh.py), so it must be at least w+1 to cover the band.
+    An unconstrained DTW (w is None) needs the envelope to cover the whole series.
+    """
+    if w is None:
+        return max_len
+    return max(r, w + 1)
+
+def nearest_neighbor(query, candidates, w, r, query_env=None, cand_env=None, stats=None):
+    """
+    Return (index, distance) of the candidate with the smallest DTW distance to query
+
+    Parameters
+    ----------
+    query: 1-d array of length max_len
+    candidates: 2-d array of dimension (num_candidates, max_len)
+    w: int, Sakoe-Chiba band for DTW
+    r: int, LB_Keogh window size. Should be at least w+1 (see get_lb_radius())
+    query_env: (upper, lower) of query, computed if None
+    cand_env: (upper, lower) of candidates, each of dimension (num_candidates, max_len), computed if None
+    stats: Counter, incremented with the stage (see PRUNE_STAGES) at which each candidate was resolved
+    """
+    query = np.asarray(query, dtype=np.float64)
+    candidates = np.atleast_2d(np.asarray(candidates, dtype=np.float64))
+    query_env = envelope(query, r) if query_env is None else query_env
+    cand_env = envelope(candidates, r) if cand_env is None else cand_env
+    stats = Counter() if stats is None else stats
+
+    kim = lb_kim(query, candidates)
+    keogh_qc = lb_keogh_envelope(query, cand_env[0], cand_env[1])
+    keogh_cq = lb_keogh_envelope(candidates, query_env[0], query_env[1])
+
+    best_idx, best_dist = None, float('inf')
+    for c in np.argsort(keogh_qc):
+        if kim[c] >= best_dist:
+            stats['lb_kim'] += 1
+        elif keogh_qc[c] >= best_dist:
+            stats['lb_keogh_qc'] += 1
+        elif keogh_cq[c] >= best_dist:
+            stats['lb_keogh_cq'] += 1
+        else:
+            cutoff = None if best_idx is None else best_dist
+            dist = dtw_distance(query, candidates[c], w=w, cutoff=cutoff)
+            if dist < best_dist:
+                stats['dtw_best'] += 1
+                best_idx, best_dist = c, dist
+            else:
+                stats['dtw_pruned'] += 1
+
+    return best_idx, best_dist
+
+def assign_nearest(series, centroids, w, r, offsets=None, stats=None, series_env=None):
+    """
+    Return, for every series, the centroid with the smallest DTW-based distance, computed for all series at once.
+
+    The distance between series i and centroid c is sqrt(offsets[i, c] + DTW(series[i], centroids[c])**2), where
+    offsets is an optional non-negative term added per pair (e.g. a distance between invariant features). Bounds
+    are computed for all (series, centroid) pairs with vectorized numpy. DTW is then run one centroid at a time
+    against the batch of series that the bounds could not prune, first for each series' most promising centroid,
+    then for the rest with each series' best-so-far distance as its early-abandoning cutoff.
+
+    Parameters
+    ----------
+    series: 2-d array of dimension (num_timeseries, len)
+    centroids: 2-d array of dimension (num_centroids, len_c)
+    w: int, Sakoe-Chiba band for DTW
+    r: int, LB_Keogh window size, should be at least w+1 (see get_lb_radius()). LB_Keogh is only used if
+        len == len_c and r is not None
+    offsets: 2-d array of dimension (num_timeseries, num_centroids)
+    stats: Counter, incremented with the stage (see PRUNE_STAGES) at which each pair was resolved
+    series_env: (upper, lower) LB_Keogh envelopes of series with window size r, computed if None
+
+    Returns
+    -------
+    labels: 1-d int array of length num_timeseries
+    dists: 1-d array of length num_timeseries
+    """
+    series = np.atleast_2d(np.asarray(series, dtype=np.float64))
+    centroids = np.atleast_2d(np.asarray(centroids, dtype=np.float64))
+    num_ts, num_c = len(series), len(centroids)
+    offsets = np.zeros([num_ts, num_c]) if offsets is None else np.asarray(offsets, dtype=np.float64)
+    stats = Counter() if stats is None else stats
+
+    # Lower bounds for every pair, each combined with the offset
+    kim = np.array([lb_kim(centroids[c], series) for c in range(num_c)]).T            # (num_ts, num_c)
+    bounds = [('lb_kim', np.sqrt(offsets + kim ** 2))]
+    if (series.shape[1] == centroids.shape[1]) and (r is not None):
+        s_upper, s_lower = envelope(series, r) if series_env is None else series_env
+        c_upper, c_lower = envelope(centroids, r)
+        keogh_qc = np.array([lb_keogh_envelope(series, c_upper[c], c_lower[c]) for c in range(num_c)]).T
+        keogh_cq = np.array([lb_keogh_envelope(centroids[c], s_upper, s_lower) for c in range(num_c)]).T
+        bounds.append(('lb_keogh_qc', np.sqrt(offsets + keogh_qc ** 2)))
+        bounds.append(('lb_keogh_cq', np.sqrt(offsets + keogh_cq ** 2)))
+    bound = np.max([b for _, b in bounds], axis=0)
+
+    labels = np.full(num_ts, -1, dtype=np.int64)
+    dists = np.full(num_ts, np.inf)
+
+    def update(c, idxs, cutoffs):
+        """Compute DTW between centroid c and series[idxs], keep improvements"""
+        if len(idxs) == 0:
+            return
+        dtw_dists = dtw_distances(centroids[c], series[idxs], w=w, cutoff=cutoffs)
+        total = np.sqrt(offsets[idxs, c] + dtw_dists ** 2)
+        better = total < dists[idxs]
+        stats['dtw_best'] += int(better.sum())
+        stats['dtw_pruned'] += int((~better).sum())
+        labels[idxs[better]] = c
+        dists[idxs[better]] = total[better]
+
+    # Most promising centroid per series first, so every series has a tight best-so-far
+    first = np.argmin(bound, axis=1)
+    for c in range(num_c):
+        update(c, np.where(first == c)[0], None)
+
+    # Remaining pairs, pruned by bounds and early abandoned at the best-so-far
+    for c in np.argsort(bound.mean(axis=0)):
+        todo = first != c
+        for stage, b in bounds:
+            pruned = todo & (b[:, c] >= dists)
+            stats[stage] += int(pruned.sum())
+            todo &= ~pruned
+        idxs = np.where(todo)[0]
+        cutoffs = np.sqrt(np.maximum(dists[idxs] ** 2 - offsets[idxs, c], 0.0))
+        update(c, idxs, cutoffs)
+
+    return labels, dists
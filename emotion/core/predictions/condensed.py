@@ -0,0 +1,129 @@
+# Condensed (upper triangle only) float32 distance matrix
+#
+# Entries (i, j), i < j, of a symmetric (n, n) matrix are stored row by row in a flat array of length n(n-1)/2, the
+# same layout as scipy.spatial.distance.squareform / pdist. Entry (i, j) lives at
+#   n*i - i*(i+1)/2 + (j - i - 1)
+# so lookups are O(1) and the matrix can be saved as one .npy and memory-mapped, taking ~1/8 of the dense float64
+# matrix it replaces.
+
+import numpy as np
+
+class CondensedDistMatrix(object):
+    def __init__(self, dists, n):
+        """
+        dists: 1-d array of length n(n-1)/2 (e.g. a read-only memmap)
+        n: int, number of series
+        """
+        if len(dists) != n * (n - 1) // 2:
+            raise ValueError('Condensed matrix of length {} does not match n={}'.format(len(dists), n))
+        self.dists = dists
+        self.n = n
+        self.shape = (n, n)
+
+    ####################################################################################################################
+    # Construct, save, load
+    ####################################################################################################################
+    @classmethod
+    def from_square(cls, matrix, dtype=np.float32):
+        """
+        Return condensed matrix from square matrix. Only the upper triangle (j > i) is read, so this works for
+        upper-triangle-only matrices as well as for symmetric ones. Rows are copied one at a time, so matrix can be a
+        memmap larger than memory.
+        """
+        n = len(matrix)
+        dists = np.empty(n * (n - 1) // 2, dtype=dtype)
+        for i in range(n - 1):
+            start = cls._row_start(n, i)
+            dists[start:start + n - i - 1] = matrix[i, i + 1:]
+        return cls(dists, n)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Return condensed matrix saved by save(), memory-mapped read-only by default"""
+        dists = np.load(path, mmap_mode=mmap_mode)
+        n = int(round((1 + np.sqrt(1 + 8 * len(dists))) / 2))
+        return cls(dists, n)
+
+    def save(self, path):
+        np.save(path, self.dists)
+
+    ####################################################################################################################
+    # Indexing
+    ####################################################################################################################
+    @staticmethod
+    def _row_start(n, i):
+        return n * i - i * (i + 1) // 2
+
+    def index(self, i, j):
+        """
+        Return position of entry (i, j) in dists. i and j can be ints or broadcastable int arrays, but must not
+        be equal (the diagonal is not stored)
+        """
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        return self.n * i - i * (i + 1) // 2 + (j - i - 1)
+
+    def get(self, i, j):
+        """Return distance(s) between i and j. Diagonal entries are 0"""
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        i, j = np.broadcast_arrays(i, j)
+        same = i == j
+        out = np.zeros(i.shape, dtype=self.dists.dtype)
+        out[~same] = self.dists[self.index(i[~same], j[~same])]
+        return out if out.ndim else out[()]
+
+    def __getitem__(self, key):
+        i, j = key
+        return self.get(i, j)
+
+    def row(self, i):
+        """Return distances from i to every series"""
+        return self.get(i, np.arange(self.n))
+
+    def columns(self, cols):
+        """Return (n, len(cols)) matrix of distances from every series to each of cols"""
+        cols = np.asarray(cols, dtype=np.int64)
+        return self.get(np.arange(self.n)[:, np.newaxis], cols[np.newaxis, :])
+
+    def submatrix(self, idxs):
+        """Return dense symmetric (len(idxs), len(idxs)) matrix of distances between idxs"""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        return self.get(idxs[:, np.newaxis], idxs[np.newaxis, :])
+
+    def permute(self, idxs):
+        """
+        Return condensed matrix whose series p is series idxs[p] of this one. Returns self (no copy) if idxs is the
+        identity.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if (len(idxs) == self.n) and np.array_equal(idxs, np.arange(self.n)):
+            return self
+        m = len(idxs)
+        dists = np.empty(m * (m - 1) // 2, dtype=self.dists.dtype)
+        for p in range(m - 1):
+            start = self._row_start(m, p)
+            dists[start:start + m - p - 1] = self.get(idxs[p], idxs[p + 1:])
+        return CondensedDistMatrix(dists, m)
+
+    def to_square(self, dtype=np.float32):
+        """Return dense symmetric matrix, e.g. for libraries that only take square precomputed distances"""
+        square = np.zeros(self.shape, dtype=dtype)
+        for i in range(self.n - 1):
+            start = self._row_start(self.n, i)
+            square[i, i + 1:] = self.dists[start:start + self.n - i - 1]
+        square += square.T
+        return square
+
+    def upper_sum(self, idxs):
+        """Return sum of distances over all pairs in idxs"""
+        return np.triu(self.submatrix(idxs), 1).sum(dtype=np.float64)
+
+def dense(D, dtype=np.float32):
+    """
+    Return dense symmetric distance matrix of dtype, from a CondensedDistMatrix or a dense (n, n) array. For code that
+    reads rows many times (k-medoids swaps, metrics, bootstrap subsamples), which trades the O(1) condensed lookups for
+    one copy (float32 by default, half of a dense float64 matrix)
+    """
+    if isinstance(D, CondensedDistMatrix):
+        return D.to_square(dtype=dtype)
+    return np.asarray(D, dtype=dtype)
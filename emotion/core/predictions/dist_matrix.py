@@ -0,0 +1,233 @@
+# Build distance matrices in parallel, block by block, straight into an on-disk condensed np.memmap
+#
+# The upper triangle of the (num_timeseries, num_timeseries) matrix is tiled into (block_size, block_size) blocks.
+# Series (and LB_Keogh envelopes) are written once to .npy files that every worker opens with mmap_mode='r', so
+# workers share one page-cache copy instead of being sent pickled series per pair. Each worker writes the rows of its
+# block directly into the result .npy, a condensed float32 matrix (see condensed.py) opened as a memmap, so no dense
+# (n, n) matrix is ever allocated. It flushes the block, and the parent appends the block to a progress log.
+# Re-running with the same out_path skips blocks that are already in the log, so a killed run resumes. A run only
+# resumes if the parameters and a sha1 of the input series match the previous (partial) build, so blocks of a
+# different corpus of the same size are never mixed in.
+#
+# With metric 'lb_keogh' and a list of window sizes r, one matrix per window size is built in the same pass: the
+# result is (len(r), n(n-1)/2), envelopes for all window sizes are computed together (see lb_keogh.envelopes), and
+# each block is computed for all window sizes by the same worker (MultiLBKeogh).
+#
+# Files, for out_path = <dir>/<name>.npy:
+#   <name>.npy          result, condensed float32 upper triangle (one row per window size, for a list of r)
+#   <name>.json         parameters of the build, sha1 of the input series, and whether it is complete
+#   <name>.blocks       progress log, one "<row_block> <col_block>" per finished block
+#   <name>-ts.npy, <name>-upper.npy, <name>-lower.npy: inputs shared with workers, removed once complete
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from condensed import CondensedDistMatrix
+from dtw import dtw_distances
+from lb_keogh import LBKeogh, MultiLBKeogh, envelope, envelopes
+
+METRICS = ['lb_keogh', 'dtw']
+
+########################################################################################################################
+# Paths and metadata
+########################################################################################################################
+def _get_paths(out_path):
+    base = out_path[:-4] if out_path.endswith('.npy') else out_path
+    return {'result': base + '.npy',
+            'meta': base + '.json',
+            'blocks': base + '.blocks',
+            'ts': base + '-ts.npy',
+            'upper': base + '-upper.npy',
+            'lower': base + '-lower.npy'}
+
+def _load_meta(out_path):
+    path = _get_paths(out_path)['meta']
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _save_meta(out_path, meta):
+    with open(_get_paths(out_path)['meta'], 'w') as f:
+        json.dump(meta, f)
+
+def _load_finished_blocks(out_path):
+    path = _get_paths(out_path)['blocks']
+    finished = set()
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:         # last line may be partial if killed mid-write
+                    finished.add((int(parts[0]), int(parts[1])))
+    return finished
+
+def is_complete(out_path):
+    """Return True if a finished distance matrix exists at out_path"""
+    meta = _load_meta(out_path)
+    return (meta is not None) and meta.get('complete', False) and os.path.exists(_get_paths(out_path)['result'])
+
+def load_dist_matrix(out_path, mmap_mode='r'):
+    """
+    Return finished distance matrix as a CondensedDistMatrix (a list of them, one per window size, for a list of r),
+    memory-mapped by default
+    """
+    meta = _load_meta(out_path)
+    dists = np.load(_get_paths(out_path)['result'], mmap_mode=mmap_mode)
+    if dists.ndim == 2:
+        return [CondensedDistMatrix(cur_dists, meta['n']) for cur_dists in dists]
+    return CondensedDistMatrix(dists, meta['n'])
+
+def get_blocks(n, block_size):
+    """Return list of (row_block, col_block) that tile the upper triangle of an n x n matrix"""
+    nblocks = int(np.ceil(n / float(block_size)))
+    return [(bi, bj) for bi in range(nblocks) for bj in range(bi, nblocks)]
+
+########################################################################################################################
+# Workers
+########################################################################################################################
+_worker = {}
+
+def _init_worker(paths, meta):
+    """Open shared inputs and result read-only / read-write as memmaps once per worker process"""
+    _worker['meta'] = meta
+    _worker['ts'] = np.load(paths['ts'], mmap_mode='r')
+    _worker['result'] = np.load(paths['result'], mmap_mode='r+')
+    if meta['metric'] == 'lb_keogh':
+        lb_class = MultiLBKeogh if isinstance(meta['r'], list) else LBKeogh
+        _worker['lb'] = lb_class(_worker['ts'], meta['r'],
+                                 upper=np.load(paths['upper'], mmap_mode='r'),
+                                 lower=np.load(paths['lower'], mmap_mode='r'))
+
+def _compute_block(block):
+    """Compute one block, write it into the result memmap, and return the block and time taken"""
+    start_time = time.time()
+    bi, bj = block
+    meta = _worker['meta']
+    n, block_size = meta['n'], meta['block_size']
+    rows = np.arange(bi * block_size, min(n, (bi + 1) * block_size))
+    cols = np.arange(bj * block_size, min(n, (bj + 1) * block_size))
+
+    if meta['metric'] == 'lb_keogh':
+        dists = _worker['lb'].all_pairs(rows=rows, cols=cols)
+    elif meta['metric'] == 'dtw':
+        ts = _worker['ts']
+        dists = np.zeros([len(rows), len(cols)])
+        for i, row in enumerate(rows):
+            upper_cols = cols > row if bi == bj else slice(None)
+            dists[i, upper_cols] = dtw_distances(ts[row], ts[cols[upper_cols]], w=meta['w'])
+
+    # Entries (row, cols > row) of a row are contiguous in the condensed result
+    result = _worker['result']
+    for i, row in enumerate(rows):
+        upper_cols = cols[cols > row]
+        if len(upper_cols) == 0:
+            continue
+        start = CondensedDistMatrix._row_start(n, row) + (upper_cols[0] - row - 1)
+        result[..., start:start + len(upper_cols)] = dists[..., i, cols > row]
+    result.flush()
+    return block, time.time() - start_time
+
+########################################################################################################################
+# Build
+########################################################################################################################
+def build_dist_matrix(data, out_path, metric='lb_keogh', r=None, w=None, block_size=128, num_workers=None,
+                      logger=None):
+    """
+    Compute upper triangle of pairwise distance matrix in parallel and return it as a CondensedDistMatrix backed by
+    a read-only memmap (a list of them, one per window size, for a list of r)
+
+    Parameters
+    ----------
+    data: np array of dimension (num_timeseries, max_len)
+    out_path: path to result .npy file. Other files are saved next to it (see top of file)
+    metric: 'lb_keogh' (LB_Keogh(data[i], data[j], r)) or 'dtw' (banded DTW with window w)
+    r: int, LB_Keogh window size. For lb_keogh, can be a list of window sizes to build one matrix per window size
+    w: int, DTW window size
+    block_size: int, blocks are (block_size, block_size) entries
+    num_workers: int, number of processes. If None, number of cpus
+    logger: logger to report progress to
+
+    Notes
+    -----
+    If a previous build with the same parameters and the same data was interrupted, only the missing blocks are
+    computed.
+    """
+    if metric not in METRICS:
+        raise ValueError('Metric unknown: {}'.format(metric))
+    log = logger.info if logger else (lambda msg: None)
+    paths = _get_paths(out_path)
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    multi_r = isinstance(r, (list, tuple))
+    if multi_r:
+        if metric != 'lb_keogh':
+            raise ValueError('List of window sizes only for lb_keogh')
+        r = [int(cur_r) for cur_r in r]
+    data_sha1 = hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()
+    meta = {'n': n, 'max_len': data.shape[1], 'metric': metric, 'r': r, 'w': w, 'block_size': block_size,
+            'data_sha1': data_sha1, 'layout': 'condensed', 'complete': False}
+
+    # Start over if parameters or input series changed since last (partial) build
+    prev_meta = _load_meta(out_path)
+    if prev_meta is not None:
+        prev_complete = prev_meta.pop('complete', False)
+        if prev_meta == {k: v for k, v in meta.items() if k != 'complete'}:
+            if prev_complete and os.path.exists(paths['result']):
+                log('Distance matrix already complete: {}'.format(paths['result']))
+                return load_dist_matrix(out_path)
+        else:
+            log('Parameters or input series changed since last build, starting over')
+            for path in paths.values():
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Write shared inputs and (zero-filled, sparse on disk) condensed result
+    if not os.path.exists(paths['ts']):
+        np.save(paths['ts'], data)
+    if (metric == 'lb_keogh') and not (os.path.exists(paths['upper']) and os.path.exists(paths['lower'])):
+        upper, lower = envelopes(data, r) if multi_r else envelope(data, r)
+        np.save(paths['upper'], upper)
+        np.save(paths['lower'], lower)
+        del upper, lower
+    if not os.path.exists(paths['result']):
+        num_pairs = n * (n - 1) // 2
+        shape = (len(r), num_pairs) if multi_r else (num_pairs,)
+        result = np.lib.format.open_memmap(paths['result'], mode='w+', dtype=np.float32, shape=shape)
+        del result
+    _save_meta(out_path, meta)
+
+    blocks = get_blocks(n, block_size)
+    finished = _load_finished_blocks(out_path)
+    todo = [b for b in blocks if b not in finished]
+    log('{} blocks of size {}: {} finished, {} to compute'.format(len(blocks), block_size, len(finished), len(todo)))
+
+    num_workers = num_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=num_workers, initializer=_init_worker, initargs=(paths, meta))
+    try:
+        with open(paths['blocks'], 'a') as f:
+            for i, (block, secs) in enumerate(pool.imap_unordered(_compute_block, todo)):
+                f.write('{} {}\n'.format(block[0], block[1]))
+                f.flush()
+                os.fsync(f.fileno())
+                log('Block {} done in {:.1f}s ({}/{})'.format(block, secs, len(finished) + i + 1, len(blocks)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    # Mark complete, remove inputs only needed while building
+    meta['complete'] = True
+    _save_meta(out_path, meta)
+    for name in ['ts', 'upper', 'lower', 'blocks']:
+        if os.path.exists(paths[name]):
+            os.remove(paths[name])
+
+    return load_dist_matrix(out_path)
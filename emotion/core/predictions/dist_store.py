@@ -0,0 +1,230 @@
+# Distance store keyed by video title, so that adding / removing videos only computes the new entries
+#
+# The store holds a condensed float32 distance matrix (see condensed.py) in the store's own order, the titles, and a
+# fingerprint of each title's series. On update():
+#   - titles that disappeared (or whose series changed, e.g. new predictions or a new max_len) are dropped
+#   - only (new x all) entries are computed
+# For a pair of titles (a, b) with a < b, the stored distance is LB_Keogh(series[a], series[b], r) (or DTW), i.e.
+# the upper triangle of a matrix ordered by title. This orientation does not depend on the order that prepare_ts
+# happened to find the videos in, so entries stay valid as the corpus grows.
+#
+# Files, for path = <dir>/<name>:
+#   <name>.npy              condensed distance matrix, float32, memory-mapped when loaded
+#   <name>-titles.json      params, titles and fingerprints (row order of the matrix)
+#
+# build_lb_keogh_stores() builds the LB_Keogh stores for several window sizes from one pass of the block builder.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from condensed import CondensedDistMatrix
+from dist_matrix import build_dist_matrix
+from dtw import dtw_distances
+from lb_keogh import LBKeogh
+
+def fingerprint(series):
+    """Return hex digest of series values"""
+    return hashlib.sha1(np.ascontiguousarray(series, dtype=np.float64).tobytes()).hexdigest()
+
+class DistStore(object):
+    def __init__(self, path, metric='lb_keogh', r=None, w=None):
+        """
+        path: path to store, without extension
+        metric: 'lb_keogh' or 'dtw'
+        r: int, LB_Keogh window size
+        w: int, DTW window size
+
+        titles, fingerprints, and matrix are loaded if the store exists and was built with the same parameters
+        """
+        self.path = path
+        self.params = {'metric': metric, 'r': r, 'w': w}
+        self.titles = []
+        self.fingerprints = []
+        self.matrix = CondensedDistMatrix(np.zeros(0, dtype=np.float32), 0)
+        self._load()
+
+    def _get_matrix_path(self):
+        return self.path + '.npy'
+
+    def _get_titles_path(self):
+        return self.path + '-titles.json'
+
+    def _load(self):
+        if not (os.path.exists(self._get_matrix_path()) and os.path.exists(self._get_titles_path())):
+            return
+        with open(self._get_titles_path(), 'r') as f:
+            saved = json.load(f)
+        if saved['params'] != self.params:
+            return
+        self.titles = saved['titles']
+        self.fingerprints = saved['fingerprints']
+        self.matrix = CondensedDistMatrix.load(self._get_matrix_path())
+
+    def save(self, matrix_path=None):
+        """
+        Save matrix and titles. Written to temporary files first so an interrupted save keeps the old store. If
+        matrix_path is given, it is a condensed matrix .npy already on disk (e.g. from the block builder) that is
+        moved into place instead of writing self.matrix
+        """
+        tmp_matrix_path = self.path + '-tmp.npy'
+        tmp_titles_path = self._get_titles_path() + '.tmp'
+        if matrix_path is None:
+            self.matrix.save(tmp_matrix_path)
+        else:
+            os.rename(matrix_path, tmp_matrix_path)
+        with open(tmp_titles_path, 'w') as f:
+            json.dump({'params': self.params, 'titles': self.titles, 'fingerprints': self.fingerprints}, f)
+        os.rename(tmp_matrix_path, self._get_matrix_path())
+        os.rename(tmp_titles_path, self._get_titles_path())
+        if matrix_path is not None:
+            self.matrix = CondensedDistMatrix.load(self._get_matrix_path())
+
+    def update(self, titles, data, num_workers=None, logger=None):
+        """
+        Bring store up to date with current series, computing only entries that involve new or changed titles
+
+        Parameters
+        ----------
+        titles: list of titles, parallel to data
+        data: np array of dimension (num_timeseries, max_len)
+        num_workers: int, number of processes used if the store has to be built from scratch
+        logger: logger to report progress to
+
+        Returns
+        -------
+        True if store changed (and was saved)
+        """
+        log = logger.info if logger else (lambda msg: None)
+        titles = [self._to_unicode(t) for t in titles]
+        fingerprints = [fingerprint(s) for s in data]
+        title2fp = dict(zip(titles, fingerprints))
+
+        # Keep titles that are still present and unchanged
+        keep = [i for i, t in enumerate(self.titles) if title2fp.get(t) == self.fingerprints[i]]
+        kept_titles = set([self.titles[i] for i in keep])
+        new = [i for i, t in enumerate(titles) if t not in kept_titles]
+        log('Distance store: {} kept, {} removed or changed, {} new'.format(
+            len(keep), len(self.titles) - len(keep), len(new)))
+        if (len(keep) == len(self.titles)) and (len(new) == 0):
+            return False
+
+        if len(keep) == 0:
+            self._build(titles, fingerprints, data, num_workers, logger)
+        else:
+            self._extend(keep, titles, fingerprints, data, new)
+            self.save()
+        return True
+
+    def _build(self, titles, fingerprints, data, num_workers, logger):
+        """
+        Compute whole matrix with the parallel, resumable block builder, ordering series by title, and save. The
+        builder writes the condensed matrix, which is moved into place as the store's matrix without a copy
+        """
+        order = sorted(range(len(titles)), key=lambda i: titles[i])
+        build_dist_matrix(np.asarray(data)[order], self.path + '-build.npy',
+                          metric=self.params['metric'], r=self.params['r'], w=self.params['w'],
+                          num_workers=num_workers, logger=logger)
+        self.titles = [titles[i] for i in order]
+        self.fingerprints = [fingerprints[i] for i in order]
+        self.save(matrix_path=self.path + '-build.npy')
+        os.remove(self.path + '-build.json')
+
+    def _extend(self, keep, titles, fingerprints, data, new):
+        """Drop rows / columns not in keep, and append rows / columns for new"""
+        data = np.asarray(data, dtype=np.float64)
+        title2idx = {t: i for i, t in enumerate(titles)}
+        kept_idxs = [title2idx[self.titles[i]] for i in keep]        # indices into data, in store order
+        all_idxs = kept_idxs + new
+
+        # Distances for new x all. LB_Keogh is asymmetric, so it is computed in both directions and the orientation
+        # is picked by title order. DTW is symmetric, so one direction is enough
+        new_vs_all = self._compute(data, new, all_idxs)                 # dist(data[new[i]], data[all_idxs[j]])
+        if self.params['metric'] == 'dtw':
+            new_rows = new_vs_all
+        else:
+            all_vs_new = self._compute(data, all_idxs, new).T           # dist(data[all_idxs[j]], data[new[i]])
+            new_titles = np.array([titles[i] for i in new], dtype=object)[:, np.newaxis]
+            all_titles = np.array([titles[i] for i in all_idxs], dtype=object)[np.newaxis, :]
+            new_rows = np.where(new_titles < all_titles, new_vs_all, all_vs_new)
+
+        # Row p of the new condensed matrix: kept x kept entries from the old matrix, then the new columns
+        nkeep, nall = len(keep), len(all_idxs)
+        dists = np.empty(nall * (nall - 1) // 2, dtype=np.float32)
+        pos = 0
+        for p in range(nall - 1):
+            if p < nkeep:
+                kept = self.matrix.get(keep[p], keep[p + 1:])
+                dists[pos:pos + len(kept)] = kept
+                pos += len(kept)
+                dists[pos:pos + len(new)] = new_rows[:, p]
+                pos += len(new)
+            else:
+                rest = new_rows[p - nkeep, p + 1:]
+                dists[pos:pos + len(rest)] = rest
+                pos += len(rest)
+
+        self.matrix = CondensedDistMatrix(dists, nall)
+        self.titles = [titles[i] for i in all_idxs]
+        self.fingerprints = [fingerprints[i] for i in all_idxs]
+
+    def _compute(self, data, rows, cols):
+        """Return (len(rows), len(cols)) matrix of distances from data[rows[i]] to data[cols[j]]"""
+        if self.params['metric'] == 'lb_keogh':
+            # Only the series involved need envelopes
+            idxs = sorted(set(rows) | set(cols))
+            pos = {idx: p for p, idx in enumerate(idxs)}
+            lb = LBKeogh(data[idxs], self.params['r'])
+            return lb.all_pairs(rows=[pos[i] for i in rows], cols=[pos[j] for j in cols])
+        elif self.params['metric'] == 'dtw':
+            return np.array([dtw_distances(data[i], data[cols], w=self.params['w']) for i in rows])
+        else:
+            raise ValueError('Metric unknown: {}'.format(self.params['metric']))
+
+    def get_matrix(self, titles):
+        """
+        Return CondensedDistMatrix ordered by titles, i.e. series i is titles[i]. No copy is made if titles are in
+        store order
+        """
+        title2idx = {t: i for i, t in enumerate(self.titles)}
+        idxs = [title2idx[self._to_unicode(t)] for t in titles]
+        return self.matrix.permute(idxs)
+
+    def _to_unicode(self, title):
+        """Titles are byte strings from os.walk, but come back from json as unicode"""
+        return title if isinstance(title, unicode) else title.decode('utf-8')
+
+def build_lb_keogh_stores(paths, rs, titles, data, num_workers=None, logger=None):
+    """
+    Build (from scratch) one LB_Keogh store per window size, computing the matrices for all window sizes together
+    (see build_dist_matrix with a list of r), and return the stores
+
+    Parameters
+    ----------
+    paths: list of store paths (without extension), one per window size in rs
+    rs: list of ints, LB_Keogh window sizes
+    titles: list of titles, parallel to data
+    data: np array of dimension (num_timeseries, max_len)
+    num_workers: int, number of processes
+    logger: logger to report progress to
+    """
+    stores = [DistStore(path, metric='lb_keogh', r=r) for path, r in zip(paths, rs)]
+    titles = [stores[0]._to_unicode(t) for t in titles]
+    order = sorted(range(len(titles)), key=lambda i: titles[i])
+    build_path = paths[0] + '-sweep-build.npy'
+    matrices = build_dist_matrix(np.asarray(data)[order], build_path, metric='lb_keogh', r=list(rs),
+                                 num_workers=num_workers, logger=logger)
+    fingerprints = [fingerprint(data[i]) for i in order]
+    # Each window size's condensed row of the build is written out as its store's matrix (float32, never expanded)
+    for store, matrix in zip(stores, matrices):
+        store.matrix = matrix
+        store.titles = [titles[i] for i in order]
+        store.fingerprints = fingerprints
+        store.save()
+        store.matrix = CondensedDistMatrix.load(store._get_matrix_path())
+    del matrices
+    for ext in ['.npy', '.json']:
+        os.remove(paths[0] + '-sweep-build' + ext)
+    return stores
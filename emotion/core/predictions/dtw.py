@@ -0,0 +1,142 @@
+# Banded dynamic time warping (DTW) kernel
+#
+# Only two rows of the cost matrix are kept at any time, and each row only covers the Sakoe-Chiba band
+# [i-w, i+w], so memory is O(w) per pair instead of O(n*m). The horizontal dependency within a row
+# (cost[i][j] depends on cost[i][j-1]) is resolved with a cumulative-sum / running-minimum trick so that every row
+# is a handful of vectorized numpy ops:
+#
+#   a[j]    = d[j] + min(prev[j], prev[j-1])            # vertical and diagonal moves
+#   cur[j]  = min(a[j], d[j] + cur[j-1])                # horizontal move
+#           = D[j] + min_{k<=j}(a[k] - D[k])            # where D = cumsum(d)
+#
+# The same row update is applied to a stack of candidates at once in dtw_distances(), which is what the clusterers
+# use to score one series against many.
+#
+# The band is inclusive on both sides. The original DTWDistance loop (range(max(0, i-w), min(m, i+w))) left out
+# column i+w, which made it asymmetric for small w. Distances for a given w therefore differ from those of the old
+# implementation, and should not be compared with distance matrices or clusterings saved before this kernel.
+
+import numpy as np
+
+INF = float('inf')
+
+########################################################################################################################
+# Helpers
+########################################################################################################################
+def _get_window(n, m, w):
+    """
+    Return band half-width. None means unconstrained. Band is widened to |n-m| so that a path always exists.
+    """
+    if w is None:
+        return max(n, m)
+    return max(int(w), abs(n - m))
+
+def _band(i, m, w):
+    """Return inclusive [lo, hi] column range of row i"""
+    return max(0, i - w), min(m - 1, i + w)
+
+def _shift_prev(prev, prev_lo, prev_hi, lo, hi):
+    """
+    Return (up, diag) for row with columns [lo, hi], given previous row values covering [prev_lo, prev_hi].
+    Columns outside of the previous band are inf. Works on 1-d rows and 2-d (num_candidates, width) stacks.
+    """
+    width = hi - lo + 1
+    shape = prev.shape[:-1] + (width + 1,)
+    # ext[..., t] holds previous row value for column lo - 1 + t
+    ext = np.full(shape, INF)
+    src_lo = max(prev_lo, lo - 1)
+    src_hi = min(prev_hi, hi)
+    if src_lo <= src_hi:
+        ext[..., src_lo - lo + 1:src_hi - lo + 2] = prev[..., src_lo - prev_lo:src_hi - prev_lo + 1]
+    return ext[..., 1:], ext[..., :-1]
+
+def _row_update(d, up, diag):
+    """Return cost row given squared distances d and (up, diag) from previous row"""
+    a = d + np.minimum(up, diag)
+    D = np.cumsum(d, axis=-1)
+    return D + np.minimum.accumulate(a - D, axis=-1)
+
+########################################################################################################################
+# DTW
+########################################################################################################################
+def dtw_distance(s1, s2, w=None, cutoff=None):
+    """
+    Return dynamic time warping Euclidean distance between two sequences.
+
+    Parameters
+    ----------
+    s1: 1-d array
+    s2: 1-d array
+    w: int, Sakoe-Chiba band half-width, columns [i-w, i+w] inclusive. If None, unconstrained
+    cutoff: float, early abandon as soon as every cell in a row exceeds cutoff. Returns inf if abandoned
+
+    Returns
+    -------
+    float
+    """
+    s1 = np.asarray(s1, dtype=np.float64)
+    s2 = np.asarray(s2, dtype=np.float64)
+    n, m = len(s1), len(s2)
+    w = _get_window(n, m, w)
+    cutoff_sq = INF if cutoff is None else cutoff ** 2
+
+    # Virtual row -1 only has cell (-1, -1) = 0
+    prev, prev_lo, prev_hi = np.zeros(1), -1, -1
+    for i in range(n):
+        lo, hi = _band(i, m, w)
+        up, diag = _shift_prev(prev, prev_lo, prev_hi, lo, hi)
+        d = (s1[i] - s2[lo:hi + 1]) ** 2
+        prev = _row_update(d, up, diag)
+        prev_lo, prev_hi = lo, hi
+        if prev.min() > cutoff_sq:
+            return INF
+
+    return np.sqrt(prev[m - 1 - prev_lo])
+
+def dtw_distances(query, candidates, w=None, cutoff=None):
+    """
+    Return DTW distances between query and every candidate, computing all candidates' rows together.
+
+    Parameters
+    ----------
+    query: 1-d array of length n
+    candidates: 2-d array of dimension (num_candidates, m)
+    w: int, Sakoe-Chiba band half-width. If None, unconstrained
+    cutoff: float or 1-d array of length num_candidates. Candidates whose whole row exceeds their cutoff are
+        abandoned and get a distance of inf
+
+    Returns
+    -------
+    1-d array of length num_candidates
+    """
+    query = np.asarray(query, dtype=np.float64)
+    candidates = np.atleast_2d(np.asarray(candidates, dtype=np.float64))
+    num_cands, m = candidates.shape
+    n = len(query)
+    w = _get_window(n, m, w)
+
+    dists = np.full(num_cands, INF)
+    if cutoff is None:
+        cutoff_sq = np.full(num_cands, INF)
+    else:
+        cutoff_sq = np.broadcast_to(np.asarray(cutoff, dtype=np.float64) ** 2, (num_cands,)).copy()
+
+    alive = np.arange(num_cands)
+    prev, prev_lo, prev_hi = np.zeros((num_cands, 1)), -1, -1
+    for i in range(n):
+        lo, hi = _band(i, m, w)
+        up, diag = _shift_prev(prev, prev_lo, prev_hi, lo, hi)
+        d = (query[i] - candidates[alive, lo:hi + 1]) ** 2
+        prev = _row_update(d, up, diag)
+        prev_lo, prev_hi = lo, hi
+
+        # Drop abandoned candidates so later rows only pay for survivors
+        keep = prev.min(axis=1) <= cutoff_sq[alive]
+        if not keep.all():
+            alive = alive[keep]
+            prev = prev[keep]
+            if len(alive) == 0:
+                return dists
+
+    dists[alive] = np.sqrt(prev[:, m - 1 - prev_lo])
+    return dists
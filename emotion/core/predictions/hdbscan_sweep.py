@@ -0,0 +1,89 @@
+# HDBSCAN over many (min_samples, min_cluster_size) settings, sharing the expensive steps
+#
+# HDBSCAN with a precomputed distance matrix:
+#   1) core distance of each series: distance to its min_samples-th nearest neighbor
+#   2) mutual reachability distance: max(d(a, b), core(a), core(b))
+#   3) single linkage tree (minimum spanning tree) of the mutual reachability distances
+#   4) condensed tree for min_cluster_size, cluster stabilities, and cluster selection (excess of mass)
+# Steps 1-3 only depend on min_samples, so they are computed once per min_samples, and only step 4 (which is linear
+# in the number of series) is repeated per min_cluster_size. Step 4 uses hdbscan's own tree functions, so labels and
+# persistence match hdbscan.HDBSCAN(metric='precomputed').
+#
+# Mutual reachability distances are computed row by row on the condensed matrix (condensed.py), and the single
+# linkage tree with scipy, whose (n-1, 4) linkage format is the single_linkage_tree hdbscan uses.
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from hdbscan._hdbscan_tree import compute_stability, condense_tree, get_clusters
+
+from condensed import CondensedDistMatrix
+
+def core_distances(dist_matrix, min_samples):
+    """Return distance from every series to its min_samples-th nearest neighbor (not counting itself)"""
+    n = dist_matrix.n
+    min_samples = min(min_samples, n - 1)
+    core = np.zeros(n)
+    for i in range(n):
+        core[i] = np.partition(dist_matrix.row(i), min_samples)[min_samples]
+    return core
+
+def mutual_reachability(dist_matrix, core):
+    """Return condensed (float64) mutual reachability distances, same layout as dist_matrix"""
+    n = dist_matrix.n
+    mr = np.empty(len(dist_matrix.dists), dtype=np.float64)
+    for i in range(n - 1):
+        start = CondensedDistMatrix._row_start(n, i)
+        end = start + n - i - 1
+        mr[start:end] = np.maximum(np.maximum(dist_matrix.dists[start:end], core[i + 1:]), core[i])
+    return mr
+
+def single_linkage_tree(dist_matrix, min_samples):
+    """Return single linkage tree, (n-1, 4) array of (left, right, distance, size), of the mutual reachability"""
+    core = core_distances(dist_matrix, min_samples)
+    return linkage(mutual_reachability(dist_matrix, core), method='single')
+
+def extract_clusters(tree, min_cluster_size):
+    """
+    Return (labels, persistence) for one min_cluster_size. labels is -1 for noise, persistence has one entry per
+    cluster (hdbscan's cluster_persistence_)
+    """
+    condensed_tree = condense_tree(tree, min_cluster_size)
+    stability = compute_stability(condensed_tree)
+    labels, _, persistence = get_clusters(condensed_tree, stability)
+    return labels, persistence
+
+def hdbscan_sweep(dist_matrix, min_samples_list, min_cluster_size_list, logger=None):
+    """
+    Return (settings, labels) for every combination of min_samples and min_cluster_size
+
+    Parameters
+    ----------
+    dist_matrix: CondensedDistMatrix
+    min_samples_list: list of ints. None means min_samples = min_cluster_size, as in hdbscan.HDBSCAN
+    min_cluster_size_list: list of ints
+    logger: logger to report progress to
+
+    Returns
+    -------
+    settings: list of dicts (ms, mcs, num_clusters, noise_frac, persistence), one per row of labels
+    labels: 2-d int32 array of dimension (num_settings, num_timeseries), -1 is noise
+    """
+    log = logger.info if logger else (lambda msg: None)
+    combos = [(ms if ms is not None else mcs, ms, mcs) for ms in min_samples_list for mcs in min_cluster_size_list]
+    settings = []
+    labels = np.zeros([len(combos), dist_matrix.n], dtype=np.int32)
+    tree_ms, tree = None, None
+    for i, (effective_ms, ms, mcs) in enumerate(sorted(combos, key=lambda combo: combo[0])):
+        if effective_ms != tree_ms:
+            log('Single linkage tree of mutual reachability, min_samples={}'.format(effective_ms))
+            tree_ms, tree = effective_ms, single_linkage_tree(dist_matrix, effective_ms)
+        cur_labels, persistence = extract_clusters(tree, mcs)
+        labels[i] = cur_labels
+        settings.append({'ms': ms,
+                         'mcs': mcs,
+                         'num_clusters': len(persistence),
+                         'noise_frac': float(np.mean(cur_labels == -1)),
+                         'persistence': [float(p) for p in persistence]})
+        log('ms={}, mcs={}: {} clusters, {:.3f} noise'.format(ms, mcs, len(persistence),
+                                                                settings[-1]['noise_frac']))
+    return settings, labels
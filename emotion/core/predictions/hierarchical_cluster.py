@@ -1,19 +1,71 @@
 # Heirarchical cluster of time-series data
-# Unlike dynamic time warping-based clustering, this method not designed specifically for time-series data
-# However, do not have to choose k
+# Unlike k-means / k-medoids, do not have to choose k: the linkage is computed once, and can then be cut at any
+# number of clusters or height.
+#
+# Linkage is computed from the precomputed (condensed) DTW-based distance matrix, or from a sparse kNN graph (see
+# knn_graph.py). Nothing is plotted while clustering; plot_dendrogram() is a separate step.
 
+import numpy as np
 import scipy.cluster.hierarchy as hac
-import matplotlib.pyplot as plt
+
+from knn_graph import average_linkage, single_linkage
+
+# Linkage methods that only need distances (ward, centroid, median assume Euclidean distances between raw vectors)
+METHODS = ['single', 'complete', 'average', 'weighted']
 
 class HierarchicalCluster(object):
     def __init__(self):
-        pass
+        """
+        z holds the linkage, (num_timeseries - 1, 4) array in scipy format
+        """
+        self.z = None
+
+    def cluster(self, dist_matrix, method='single'):
+        """
+        Return linkage computed from all pairwise distances
+
+        dist_matrix: CondensedDistMatrix (its condensed array is scipy's condensed distance format)
+        method: one of METHODS
+        """
+        if method not in METHODS:
+            raise ValueError('Linkage method unknown: {}'.format(method))
+        self.z = hac.linkage(np.asarray(dist_matrix.dists, dtype=np.float64), method)
+        return self.z
+
+    def cluster_graph(self, graph, method='single'):
+        """
+        Return linkage computed from a sparse k-nearest-neighbor graph (see knn_graph.py) instead of all pairs
+
+        graph: scipy.sparse matrix of distances, symmetric
+        method: 'single' or 'average'
+        """
+        if method == 'single':
+            self.z = single_linkage(graph)
+        elif method == 'average':
+            self.z = average_linkage(graph)
+        else:
+            raise ValueError('Linkage method unknown: {}'.format(method))
+        return self.z
+
+    def cut(self, ks=None, heights=None):
+        """
+        Return labels of the tree cut at every k in ks (or height in heights), as a (len(ks), num_timeseries) array.
+        All cuts are made in one pass over the linkage
 
-    def cluster(self, data):
-        """data is np array of [num_timeseries, max_len]"""
-        z = hac.linkage(data, 'single', 'correlation')
+        ks: list of ints, number of clusters
+        heights: list of floats, distances at which to cut
+        """
+        if ks is not None:
+            return hac.cut_tree(self.z, n_clusters=ks).T
+        return hac.cut_tree(self.z, height=heights).T
 
-        # Plot the dendogram
+    def plot_dendrogram(self, z=None, truncate_p=None):
+        """
+        Plot dendrogram of linkage z (self.z if None) on a new figure. If truncate_p, only the last truncate_p
+        merges are shown. Caller saves / shows the figure
+        """
+        import matplotlib.pyplot as plt
+        z = self.z if z is None else z
         plt.figure(figsize=(25, 10))
         plt.title('Hierarchical Clustering Dendrogram')
         plt.xlabel('sample index')
@@ -22,5 +74,6 @@ class HierarchicalCluster(object):
             z,
             leaf_rotation=90.,  # rotates the x axis labels
             leaf_font_size=8.,  # font size for the x axis labels
+            truncate_mode='lastp' if truncate_p else None,
+            p=truncate_p or 30,
         )
-        plt.show()
\ No newline at end of file
@@ -0,0 +1,129 @@
+# Compact result of a k-clustering (k-means, k-medoids, k-shape, ...), one memory-mappable file per run
+#
+# Instead of pickled dicts of member series and dict-of-dict distances, a result is four arrays:
+#   labels      int32 (num_timeseries,)         cluster of every series
+#   medoids     int64 (num_clust,)              index of each cluster's medoid (for centroid-based methods, the
+#                                               member closest to the centroid). -1 for empty clusters
+#   dists       float32 (num_timeseries,)       distance from every series to its cluster's medoid / centroid
+#   centroids   float32 (num_clust, max_len)    centroids (un-normalized, as plotted)
+#
+# File layout: 'KCR1', uint32 header length, json header ({name: {dtype, shape, offset}}), then each array at a
+# 64-byte aligned offset, so load() can memory-map every array directly. The website and the analysis code load
+# results with KClustResult.load().
+
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'KCR1'
+ALIGN = 64
+FIELDS = [('labels', np.int32), ('medoids', np.int64), ('dists', np.float32), ('centroids', np.float32)]
+
+class KClustResult(object):
+    def __init__(self, labels, medoids, dists, centroids):
+        self.labels = labels
+        self.medoids = medoids
+        self.dists = dists
+        self.centroids = centroids
+        self.num_clust = len(centroids)
+
+    @classmethod
+    def from_clusters(cls, num_ts, assignments, ts_dists, centroids, medoids=None):
+        """
+        Return result from the dicts clusterers keep
+
+        Parameters
+        ----------
+        num_ts: int, number of series
+        assignments: dict, key is cluster index (into centroids), value is list of member indices
+        ts_dists: dict, key is cluster index, value is dict (key is member index, value is distance)
+        centroids: array-like of dimension (num_clust, max_len)
+        medoids: array of medoid indices, one per cluster. If None, the member closest to each centroid
+        """
+        centroids = np.asarray(centroids, dtype=np.float32)
+        labels = np.full(num_ts, -1, dtype=np.int32)
+        dists = np.zeros(num_ts, dtype=np.float32)
+        for c, members in assignments.items():
+            members = np.asarray(members, dtype=np.int64)
+            labels[members] = c
+            dists[members] = [ts_dists[c][m] for m in members]
+        if medoids is None:
+            medoids = np.full(len(centroids), -1, dtype=np.int64)
+            for c in range(len(centroids)):
+                members = np.where(labels == c)[0]
+                if len(members) > 0:
+                    medoids[c] = members[np.argmin(dists[members])]
+        return cls(labels, np.asarray(medoids, dtype=np.int64), dists, centroids)
+
+    ####################################################################################################################
+    # Save, load
+    ####################################################################################################################
+    def save(self, path):
+        """Save to path. Written to a temporary file first, so an interrupted save keeps the old result"""
+        arrays = [(name, np.ascontiguousarray(getattr(self, name), dtype=dtype)) for name, dtype in FIELDS]
+        header = {}
+        offset = 0
+        for name, arr in arrays:
+            header[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+            offset += -(-arr.nbytes // ALIGN) * ALIGN
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGN) * ALIGN
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            for name, arr in arrays:
+                f.seek(data_start + header[name]['offset'])
+                f.write(arr.tobytes())
+            f.truncate(data_start + offset)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Return result saved by save(), every array memory-mapped (read-only by default). mmap_mode None reads"""
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('Not a clustering result: {}'.format(path))
+            header_len = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        data_start = -(-(len(MAGIC) + 4 + header_len) // ALIGN) * ALIGN
+
+        arrays = {}
+        for name, _ in FIELDS:
+            spec = header[name]
+            dtype, shape = np.dtype(str(spec['dtype'])), tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            elif mmap_mode is None:
+                with open(path, 'rb') as f:
+                    f.seek(data_start + spec['offset'])
+                    arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, offset=data_start + spec['offset'],
+                                         shape=shape)
+        return cls(arrays['labels'], arrays['medoids'], arrays['dists'], arrays['centroids'])
+
+    ####################################################################################################################
+    # Views
+    ####################################################################################################################
+    def members(self, c):
+        """Return indices of series in cluster c"""
+        return np.where(np.asarray(self.labels) == c)[0]
+
+    def closest(self, c, top_n=None):
+        """Return indices of series in cluster c, sorted by distance to the medoid / centroid"""
+        members = self.members(c)
+        return members[np.argsort(self.dists[members], kind='mergesort')][:top_n]
+
+    def assignments(self):
+        """Return dict, key is cluster index, value is list of member indices (for non-empty clusters)"""
+        return {c: self.members(c).tolist() for c in np.unique(self.labels).tolist() if c >= 0}
+
+    def ts_dists(self):
+        """Return dict, key is cluster index, value is dict (key is member index, value is distance)"""
+        return {c: dict(zip(members, np.asarray(self.dists)[members].tolist()))
+                for c, members in self.assignments().items()}
@@ -1,44 +1,234 @@
-# https://github.com/letiantian/kmedoids
+# k-medoids with greedy BUILD initialization and a FasterPAM-style swap phase
+#
+# Schubert and Rousseeuw, "Faster k-Medoids Clustering: Improving the PAM, CLARA, and CLARANS Algorithms" (2019).
+# For every point the distance to its nearest and second-nearest medoid is cached, along with the loss of removing
+# each medoid. The change in cost of swapping any medoid for a candidate x can then be computed for all k medoids
+# at once from row x of the distance matrix, i.e. O(n) per candidate instead of O(n^2) (or O(k n^2)). The first
+# improving swap is applied eagerly. Several seeds can be run in parallel, keeping the lowest cost, and a sweep over
+# k can be split across processes, warm starting each k from the previous one (kmedoids_sweep).
+#
+# Replaces https://github.com/letiantian/kmedoids, whose kMedoids() interface is kept.
+
+import multiprocessing
 
 import numpy as np
-import random
 
-def kMedoids(D, k, tmax=100):
-    # determine dimensions of distance matrix D
-    m, n = D.shape
+from condensed import dense
+from metrics import silhouette
+
+########################################################################################################################
+# Helpers
+########################################################################################################################
+def _nearest_two(D, medoids):
+    """Return (nearest medoid position, distance to nearest, distance to second nearest) for every point"""
+    dists = D[:, medoids]                       # (n, k)
+    if len(medoids) == 1:
+        return np.zeros(len(D), dtype=np.int64), dists[:, 0], np.full(len(D), np.inf, dtype=D.dtype)
+    order = np.argsort(dists, axis=1)[:, :2]
+    rows = np.arange(len(D))
+    return order[:, 0], dists[rows, order[:, 0]], dists[rows, order[:, 1]]
+
+def _removal_loss(nearest, dnear, dsecond, k):
+    """Return increase in cost of removing each medoid (its points move to their second-nearest medoid)"""
+    return np.bincount(nearest, weights=dsecond - dnear, minlength=k)
+
+def build(D, k, medoids=None):
+    """
+    Return k medoids chosen greedily (BUILD): first the point with the smallest total distance, then repeatedly the
+    point that reduces the total cost the most. If medoids is given, greedily add to those instead (e.g. to go from
+    the medoids for k-1 to k)
+    """
+    n = len(D)
+    if medoids is None or len(medoids) == 0:
+        medoids = [int(np.argmin(D.sum(axis=1, dtype=np.float64)))]
+    medoids = [int(m) for m in medoids]
+    dnear = D[:, medoids].min(axis=1).astype(np.float64)
+    while len(medoids) < k:
+        # gain[x] = sum_o max(dnear[o] - D[o, x], 0), computed a block of candidates at a time
+        gains = np.zeros(n)
+        block = max(1, (2 ** 22) // n)
+        for start in range(0, n, block):
+            gains[start:start + block] = np.maximum(dnear[:, np.newaxis] - D[:, start:start + block], 0).sum(axis=0)
+        gains[medoids] = -np.inf
+        x = int(np.argmax(gains))
+        medoids.append(x)
+        dnear = np.minimum(dnear, D[:, x])
+    return np.array(medoids)
+
+def swap(D, medoids, max_iter=100, rng=None):
+    """
+    Return (medoids, cost) after FasterPAM swaps starting from medoids
+
+    Parameters
+    ----------
+    D: dense (n, n) distance matrix
+    medoids: array of k initial medoid indices
+    max_iter: int, maximum number of passes over all candidates
+    rng: np.random.RandomState used to shuffle the order candidates are tried in
+    """
+    n, k = len(D), len(medoids)
+    medoids = np.array(medoids)
+    is_medoid = np.zeros(n, dtype=bool)
+    is_medoid[medoids] = True
+    nearest, dnear, dsecond = _nearest_two(D, medoids)
+    loss = _removal_loss(nearest, dnear, dsecond, k)
+
+    candidates = np.arange(n) if rng is None else rng.permutation(n)
+    last_swap = None
+    for _ in range(max_iter):
+        swapped = False
+        for x in candidates:
+            if x == last_swap:          # a full pass since the last swap without improvement
+                return medoids, float(dnear.sum())
+            if is_medoid[x]:
+                continue
 
+            dx = D[x]
+            closer = dx < dnear                               # x would become their nearest
+            second = ~closer & (dx < dsecond)                 # x would become their second nearest
+            # Change in cost if medoid m is replaced by x, for every m
+            delta = loss.copy()
+            delta += np.bincount(nearest[closer], weights=dnear[closer] - dsecond[closer], minlength=k)
+            delta += np.bincount(nearest[second], weights=dx[second] - dsecond[second], minlength=k)
+            delta += (dx[closer] - dnear[closer]).sum()
+
+            m = int(np.argmin(delta))
+            if delta[m] < -1e-6 * max(1.0, float(dnear.sum())) / n:
+                is_medoid[medoids[m]] = False
+                is_medoid[x] = True
+                medoids[m] = x
+                nearest, dnear, dsecond = _nearest_two(D, medoids)
+                loss = _removal_loss(nearest, dnear, dsecond, k)
+                last_swap = x
+                swapped = True
+        if not swapped:
+            break
+
+    return medoids, float(dnear.sum())
+
+########################################################################################################################
+# Running several seeds in parallel
+########################################################################################################################
+_D = None           # set before forking workers, so they share the parent's (read-only) matrix
+
+def _run_seed(args):
+    """Return (medoids, cost) for one seed. Seed None uses BUILD, other seeds random initial medoids"""
+    k, max_iter, seed, init_medoids = args
+    if init_medoids is not None:
+        medoids = np.array(init_medoids)
+    elif seed is None:
+        medoids = build(_D, k)
+    else:
+        medoids = np.random.RandomState(seed).choice(len(_D), k, replace=False)
+    rng = None if seed is None else np.random.RandomState(seed)
+    return swap(_D, medoids, max_iter, rng)
+
+def fast_kmedoids(D, k, max_iter=100, n_seeds=1, num_workers=None, init_medoids=None, seed=0):
+    """
+    Return (medoids, labels, cost) of the best of n_seeds runs
+
+    Parameters
+    ----------
+    D: CondensedDistMatrix or dense (n, n) distance matrix
+    k: int, number of medoids
+    max_iter: int, maximum number of swap passes per run
+    n_seeds: int, number of runs. The first starts from BUILD (or init_medoids), the rest from random medoids
+    num_workers: int, number of processes when n_seeds > 1. If None, min(n_seeds, number of cpus)
+    init_medoids: array of k medoid indices to start the first run from (e.g. to warm start from a related run)
+    seed: int, base seed for the random runs
+
+    Returns
+    -------
+    medoids: 1-d array of k indices
+    labels: 1-d array of length n, position in medoids of each point's nearest medoid
+    cost: float, sum of distances from every point to its nearest medoid
+    """
+    global _D
+    _D = dense(D)
+    n = len(_D)
     if k > n:
         raise Exception('too many medoids')
-    # randomly initialize an array of k medoid indices
-    M = np.arange(n)
-    np.random.shuffle(M)
-    M = np.sort(M[:k])
 
-    # create a copy of the array of medoid indices
-    Mnew = np.copy(M)
+    runs = [(k, max_iter, None, init_medoids)] + [(k, max_iter, seed + i, None) for i in range(1, n_seeds)]
+    if len(runs) == 1:
+        results = [_run_seed(runs[0])]
+    else:
+        num_workers = num_workers or min(len(runs), multiprocessing.cpu_count())
+        pool = multiprocessing.Pool(processes=num_workers)
+        try:
+            results = pool.map(_run_seed, runs)
+        finally:
+            pool.close()
+            pool.join()
 
-    # initialize a dictionary to represent clusters
-    C = {}
-    for t in xrange(tmax):
-        # determine clusters, i. e. arrays of data indices
-        J = np.argmin(D[:,M], axis=1)
-        for kappa in range(k):
-            C[kappa] = np.where(J==kappa)[0]
-        # update cluster medoids
-        for kappa in range(k):
-            J = np.mean(D[np.ix_(C[kappa],C[kappa])],axis=1)
-            j = np.argmin(J)
-            Mnew[kappa] = C[kappa][j]
-        np.sort(Mnew)
-        # check for convergence
-        if np.array_equal(M, Mnew):
-            break
-        M = np.copy(Mnew)
+    medoids, cost = min(results, key=lambda result: result[1])
+    labels, _, _ = _nearest_two(_D, medoids)
+    _D = None
+    return medoids, labels, cost
+
+def _run_chain(args):
+    """
+    Return list of results for ks (ascending), each run warm started from the previous k's medoids plus the
+    points BUILD would add
+    """
+    ks, max_iter, warm_start = args
+    results = []
+    medoids = None
+    for k in ks:
+        init = build(_D, k, medoids if warm_start else None)
+        medoids, cost = swap(_D, init, max_iter)
+        labels, dnear, _ = _nearest_two(_D, medoids)
+        results.append({'k': int(k),
+                        'cost': cost,
+                        'medoids': [int(m) for m in medoids],
+                        'sizes': [int(size) for size in np.bincount(labels, minlength=k)],
+                        'silhouette': silhouette(_D, labels)})
+    return results
+
+def kmedoids_sweep(D, ks, max_iter=100, num_workers=None, warm_start=True):
+    """
+    Return list of dicts (k, cost, medoids, sizes, silhouette), one per k, sorted by k
+
+    Parameters
+    ----------
+    D: CondensedDistMatrix or dense (n, n) distance matrix. Converted once and shared (read-only) by all workers
+    ks: list of ints
+    max_iter: int, maximum number of swap passes per k
+    num_workers: int, number of processes. If None, number of cpus
+    warm_start: bool, start each k from the medoids of the next smaller k in the same worker
+
+    Notes
+    -----
+    ks are split into num_workers contiguous chains that run in parallel. Within a chain, k is warm started from
+    the previous k, so the swap phase only has to make a few corrections.
+    """
+    global _D
+    _D = dense(D)
+    ks = sorted(set(int(k) for k in ks))
+    num_workers = min(len(ks), num_workers or multiprocessing.cpu_count())
+    chains = [list(chain) for chain in np.array_split(ks, num_workers)]
+    runs = [(chain, max_iter, warm_start) for chain in chains if len(chain) > 0]
+
+    if len(runs) == 1:
+        results = _run_chain(runs[0])
     else:
-        # final update of cluster memberships
-        J = np.argmin(D[:,M], axis=1)
-        for kappa in range(k):
-            C[kappa] = np.where(J==kappa)[0]
+        pool = multiprocessing.Pool(processes=num_workers)
+        try:
+            results = [result for chain in pool.map(_run_chain, runs) for result in chain]
+        finally:
+            pool.close()
+            pool.join()
+    _D = None
+    return sorted(results, key=lambda result: result['k'])
 
-    # return results
-    return M, C
\ No newline at end of file
+def kMedoids(D, k, tmax=100, n_seeds=1, num_workers=None, init_medoids=None):
+    """
+    Return (M, C), where M is array of medoid indices and C is dict with key kappa (position in M) and value array
+    of indices of points in that cluster
+    """
+    M, labels, _ = fast_kmedoids(D, k, max_iter=tmax, n_seeds=n_seeds, num_workers=num_workers,
+                                 init_medoids=init_medoids)
+    C = {}
+    for kappa in range(k):
+        C[kappa] = np.where(labels == kappa)[0]
+    return M, C
@@ -0,0 +1,276 @@
+# Sparse k-nearest-neighbor graph under DTW (or LB_Keogh), and clustering on it
+#
+# Instead of all n(n-1)/2 distances, only each series' k nearest neighbors are kept, in a scipy.sparse matrix with
+# O(nk) entries. For DTW, the neighbors of a query are found with lower bounds:
+#   - LB_Keogh in both directions against every candidate, computed a chunk of queries at a time (cheap, O(len))
+#   - exact DTW for the k candidates with the smallest bound, which gives a k-th best distance
+#   - the remaining candidates, in order of increasing bound, until the bound reaches the k-th best: DTW early
+#     abandoned at the k-th best
+# so for most pairs DTW is never run. Queries are split across a pool of workers.
+#
+# The graph is symmetrized (i is a neighbor of j if j is a neighbor of i), and can then be clustered without a
+# dense matrix:
+#   - HDBSCAN: core distance is the distance to the min_samples-th neighbor (needs min_samples <= k), the minimum
+#     spanning tree of the mutual reachability graph gives the single linkage tree, and clusters are extracted as in
+#     hdbscan_sweep.py
+#   - single linkage: minimum spanning tree of the graph
+#   - average linkage: average over the pairs that are in the graph (pairs that are not neighbors are ignored)
+# Components that are not connected in the graph are joined last, at distance disconnected_dist.
+
+import heapq
+import multiprocessing
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import minimum_spanning_tree
+
+from cascade import get_lb_radius
+from dtw import dtw_distances
+from lb_keogh import LBKeogh, envelope
+
+METRICS = ['dtw', 'lb_keogh']
+
+########################################################################################################################
+# Build
+########################################################################################################################
+_worker = {}
+
+def _init_worker(data, upper, lower, k, metric, w, r):
+    """Keep series and their envelopes once per worker process (inherited on fork, not sent per task)"""
+    _worker['lb'] = LBKeogh(data, r, upper=upper, lower=lower)
+    _worker['k'] = k
+    _worker['metric'] = metric
+    _worker['w'] = w
+
+def _knn_chunk(queries):
+    """Return (neighbors, dists, num_dtw) of each query, both (len(queries), k)"""
+    lb, k, metric, w = _worker['lb'], _worker['k'], _worker['metric'], _worker['w']
+    n = len(lb.data)
+    bounds = lb.all_pairs(rows=queries)                          # LB_Keogh(query, candidate)
+    if metric == 'dtw':
+        bounds = np.maximum(bounds, lb.all_pairs(cols=queries).T)   # and LB_Keogh(candidate, query)
+    bounds[np.arange(len(queries)), queries] = np.inf               # not its own neighbor
+
+    neighbors = np.zeros([len(queries), k], dtype=np.int64)
+    dists = np.zeros([len(queries), k])
+    num_dtw = 0
+    for i, q in enumerate(queries):
+        if metric == 'lb_keogh':
+            nearest = np.argpartition(bounds[i], k - 1)[:k]
+            neighbors[i], dists[i] = nearest, bounds[i, nearest]
+            continue
+
+        order = np.argsort(bounds[i])[:n - 1]
+        cand = order[:k]
+        cand_dists = dtw_distances(lb.data[q], lb.data[cand], w=w)
+        num_dtw += len(cand)
+        pos = k
+        while pos < len(order):
+            kth = cand_dists.max()
+            batch = order[pos:pos + k]
+            batch = batch[bounds[i, batch] < kth]
+            if len(batch) == 0:                  # bounds are sorted, so no later candidate can be closer
+                break
+            batch_dists = dtw_distances(lb.data[q], lb.data[batch], w=w, cutoff=kth)
+            num_dtw += len(batch)
+            cand = np.concatenate([cand, batch])
+            cand_dists = np.concatenate([cand_dists, batch_dists])
+            keep = np.argsort(cand_dists)[:k]
+            cand, cand_dists = cand[keep], cand_dists[keep]
+            pos += k
+        neighbors[i], dists[i] = cand, cand_dists
+    return neighbors, dists, num_dtw
+
+def build_knn_graph(data, k, metric='dtw', r=None, w=None, num_workers=None, chunk_size=64, logger=None):
+    """
+    Return symmetric scipy.sparse.csr_matrix (num_timeseries, num_timeseries) holding the distance from every
+    series to each of its k nearest neighbors
+
+    Parameters
+    ----------
+    data: np array of dimension (num_timeseries, max_len)
+    k: int, number of neighbors
+    metric: 'dtw' (banded DTW with window w, pruned with LB_Keogh) or 'lb_keogh' (LB_Keogh with window r)
+    r: int, LB_Keogh window size. For dtw, widened to cover the DTW window (see get_lb_radius)
+    w: int, DTW window size
+    num_workers: int, number of processes. If None, number of cpus
+    chunk_size: int, number of queries per task
+    logger: logger to report progress to
+
+    Notes
+    -----
+    Distances of exactly 0 (e.g. duplicate series) are stored as a tiny positive value, because scipy.sparse treats
+    zeros as missing edges.
+    """
+    if metric not in METRICS:
+        raise ValueError('Metric unknown: {}'.format(metric))
+    log = logger.info if logger else (lambda msg: None)
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    k = min(k, n - 1)
+    if metric == 'dtw':
+        r = get_lb_radius(r, w, data.shape[1])
+    upper, lower = envelope(data, r)
+
+    chunks = [np.arange(start, min(n, start + chunk_size)) for start in range(0, n, chunk_size)]
+    neighbors = np.zeros([n, k], dtype=np.int64)
+    dists = np.zeros([n, k])
+    num_dtw = 0
+    num_workers = num_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                                initargs=(data, upper, lower, k, metric, w, r))
+    try:
+        for i, (chunk, (chunk_neighbors, chunk_dists, chunk_num_dtw)) in \
+                enumerate(zip(chunks, pool.imap(_knn_chunk, chunks))):
+            neighbors[chunk], dists[chunk] = chunk_neighbors, chunk_dists
+            num_dtw += chunk_num_dtw
+            if (i + 1) % 10 == 0 or (i + 1) == len(chunks):
+                log('kNN graph: {}/{} queries'.format(chunk[-1] + 1, n))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if metric == 'dtw':
+        log('kNN graph: DTW computed for {} of {} pairs ({:.2%})'.format(num_dtw, n * (n - 1),
+                                                                          num_dtw / float(n * (n - 1))))
+
+    dists = np.maximum(dists, np.finfo(np.float64).tiny)
+    graph = sp.csr_matrix((dists.ravel(), (np.repeat(np.arange(n), k), neighbors.ravel())), shape=(n, n))
+    return graph.maximum(graph.T).tocsr()
+
+def save_knn_graph(path, graph):
+    sp.save_npz(path, graph)
+
+def load_knn_graph(path):
+    return sp.load_npz(path).tocsr()
+
+########################################################################################################################
+# Clustering on the graph
+########################################################################################################################
+def _edges_to_linkage(n, rows, cols, weights, disconnected_dist):
+    """
+    Return single linkage tree ((n-1, 4) scipy linkage format) from the edges of a spanning tree (or forest), by
+    merging in order of increasing weight
+    """
+    parent = np.arange(2 * n - 1)
+    size = np.ones(2 * n - 1, dtype=np.int64)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    z = np.zeros([n - 1, 4])
+    next_id = n
+    for e in np.argsort(weights, kind='mergesort'):
+        a, b = find(rows[e]), find(cols[e])
+        if a == b:
+            continue
+        z[next_id - n] = [min(a, b), max(a, b), weights[e], size[a] + size[b]]
+        parent[a] = parent[b] = next_id
+        size[next_id] = size[a] + size[b]
+        next_id += 1
+
+    # Join components that the graph does not connect
+    roots = sorted(set(find(x) for x in range(n)))
+    while len(roots) > 1:
+        a, b = roots[0], roots[1]
+        z[next_id - n] = [a, b, disconnected_dist, size[a] + size[b]]
+        parent[a] = parent[b] = next_id
+        size[next_id] = size[a] + size[b]
+        roots = roots[2:] + [next_id]
+        next_id += 1
+    return z
+
+def _mst_linkage(graph, disconnected_dist):
+    mst = minimum_spanning_tree(graph).tocoo()
+    return _edges_to_linkage(graph.shape[0], mst.row, mst.col, mst.data, disconnected_dist)
+
+def core_distances(graph, min_samples):
+    """Return distance from every series to its min_samples-th nearest neighbor, read off the graph's rows"""
+    n = graph.shape[0]
+    core = np.zeros(n)
+    for i in range(n):
+        row = graph.data[graph.indptr[i]:graph.indptr[i + 1]]
+        if len(row) < min_samples:
+            raise ValueError('Series {} has {} neighbors in graph, fewer than min_samples={}'.format(
+                i, len(row), min_samples))
+        core[i] = np.partition(row, min_samples - 1)[min_samples - 1]
+    return core
+
+def hdbscan_linkage(graph, min_samples):
+    """Return single linkage tree of the mutual reachability graph, for extract_clusters() in hdbscan_sweep.py"""
+    core = core_distances(graph, min_samples)
+    coo = graph.tocoo()
+    mr = np.maximum(coo.data, np.maximum(core[coo.row], core[coo.col]))
+    mr_graph = sp.csr_matrix((mr, (coo.row, coo.col)), shape=graph.shape)
+    return _mst_linkage(mr_graph, np.inf)
+
+def single_linkage(graph, disconnected_dist=None):
+    """Return single linkage tree of graph. Exact as long as the graph contains the minimum spanning tree"""
+    disconnected_dist = disconnected_dist or 2 * graph.data.max()
+    return _mst_linkage(graph, disconnected_dist)
+
+def average_linkage(graph, disconnected_dist=None):
+    """
+    Return average linkage tree of graph, where the distance between two clusters is the mean over the pairs
+    between them that are in the graph. Clusters with no pair in the graph are only joined at the end
+    """
+    disconnected_dist = disconnected_dist or 2 * graph.data.max()
+    n = graph.shape[0]
+    coo = sp.triu(graph, 1).tocoo()
+    # adj[c][d] = [sum of distances, number of pairs] between clusters c and d
+    adj = [dict() for _ in range(2 * n - 1)]
+    for a, b, d in zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist()):
+        adj[a][b] = [d, 1]
+        adj[b][a] = [d, 1]
+    heap = [(d, a, b) for a, b, d in zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist())]
+    heapq.heapify(heap)
+    alive = np.zeros(2 * n - 1, dtype=bool)
+    alive[:n] = True
+    size = np.ones(2 * n - 1, dtype=np.int64)
+
+    z = np.zeros([n - 1, 4])
+    next_id = n
+    while heap:
+        d, a, b = heapq.heappop(heap)
+        if not (alive[a] and alive[b]):
+            continue
+        z[next_id - n] = [min(a, b), max(a, b), d, size[a] + size[b]]
+        alive[a] = alive[b] = False
+        alive[next_id] = True
+        size[next_id] = size[a] + size[b]
+
+        # Merge neighbor sums of a and b
+        merged = adj[a]
+        for c, (s, cnt) in adj[b].items():
+            if c in merged:
+                merged[c][0] += s
+                merged[c][1] += cnt
+            else:
+                merged[c] = [s, cnt]
+        merged.pop(a, None)
+        merged.pop(b, None)
+        adj[next_id] = merged
+        adj[a], adj[b] = {}, {}
+        for c, (s, cnt) in merged.items():
+            adj[c].pop(a, None)
+            adj[c].pop(b, None)
+            adj[c][next_id] = merged[c]
+            heapq.heappush(heap, (s / cnt, c, next_id))
+        next_id += 1
+
+    # Join components that the graph does not connect
+    roots = list(np.where(alive)[0])
+    while len(roots) > 1:
+        a, b = roots[0], roots[1]
+        z[next_id - n] = [a, b, disconnected_dist, size[a] + size[b]]
+        size[next_id] = size[a] + size[b]
+        roots = roots[2:] + [next_id]
+        next_id += 1
+    return z
@@ -0,0 +1,179 @@
+# Shape-based distance (SBD) and k-Shape clustering
+#
+# SBD(x, y) = 1 - max_s NCC_s(x, y), where NCC_s is the cross-correlation of x and y at shift s, normalized by
+# ||x|| ||y||. All shifts are computed at once with an FFT, i.e. O(n log n) per pair instead of DTW's O(n w).
+# The FFTs of all series are computed once in SBDIndex and reused for every iteration and every k; each iteration
+# only needs the FFTs of the k centroids.
+#
+# k-Shape (Paparrizos and Gravano, 2015) alternates between assigning series to the centroid with the smallest SBD,
+# and extracting each cluster's shape as the top eigenvector of Q^T S Q, where S is the scatter matrix of the members
+# aligned to the previous centroid and Q centers them. S (n x n) is never formed, only multiplied with (see
+# _extract_shape), so 15k-point film curves fit in memory.
+
+from collections import defaultdict
+
+import numpy as np
+from scipy.sparse.linalg import LinearOperator, eigsh
+
+def zscore(data):
+    """Return z-normalized series (last axis). Constant series become all zeros"""
+    data = np.asarray(data, dtype=np.float64)
+    std = data.std(axis=-1, keepdims=True)
+    std[std == 0] = 1.0
+    return (data - data.mean(axis=-1, keepdims=True)) / std
+
+def _shift(x, s):
+    """Return x shifted so that out[t] = x[t + s], zero filled"""
+    out = np.zeros_like(x)
+    if s >= 0:
+        out[:len(x) - s] = x[s:]
+    else:
+        out[-s:] = x[:len(x) + s]
+    return out
+
+class SBDIndex(object):
+    def __init__(self, data, max_elems=2 ** 22):
+        """
+        data: np array of dimension (num_timeseries, max_len). Series are z-normalized
+        max_elems: int, bound on the number of elements of each temporary (series, fft_len) array
+
+        fft holds the rfft of every (zero padded) series, norms their L2 norms
+        """
+        self.data = zscore(data)
+        self.num_ts, self.max_len = self.data.shape
+        self.fft_len = 1 << int(np.ceil(np.log2(2 * self.max_len - 1)))
+        self.chunk_size = max(1, max_elems // self.fft_len)
+        self.fft = np.fft.rfft(self.data, self.fft_len, axis=1)
+        self.norms = np.linalg.norm(self.data, axis=1)
+
+    def ncc_max(self, y, idxs=None):
+        """
+        Return (max NCC, shift at max) between every series (or series in idxs) and y. Shift s means series[t + s]
+        is aligned with y[t]
+
+        Parameters
+        ----------
+        y: 1-d array of length max_len
+        idxs: array of indices into data
+        """
+        idxs = np.arange(self.num_ts) if idxs is None else np.asarray(idxs)
+        y = np.asarray(y, dtype=np.float64)
+        y_fft = np.conj(np.fft.rfft(y, self.fft_len))
+        y_norm = np.linalg.norm(y)
+        n = self.max_len
+        shifts = np.r_[np.arange(-(n - 1), 0), np.arange(n)]
+
+        ncc = np.zeros(len(idxs))
+        best_shift = np.zeros(len(idxs), dtype=np.int64)
+        if y_norm == 0:
+            return ncc, best_shift
+        for start in range(0, len(idxs), self.chunk_size):
+            chunk = idxs[start:start + self.chunk_size]
+            cc = np.fft.irfft(self.fft[chunk] * y_fft, self.fft_len, axis=1)
+            cc = np.concatenate([cc[:, self.fft_len - (n - 1):], cc[:, :n]], axis=1)     # shifts -(n-1)..(n-1)
+            best = np.argmax(cc, axis=1)
+            denom = self.norms[chunk] * y_norm
+            denom[denom == 0] = np.inf
+            ncc[start:start + len(chunk)] = cc[np.arange(len(chunk)), best] / denom
+            best_shift[start:start + len(chunk)] = shifts[best]
+        return ncc, best_shift
+
+    def sbd(self, y, idxs=None):
+        """Return SBD between every series (or series in idxs) and y"""
+        ncc, _ = self.ncc_max(y, idxs)
+        return 1 - ncc
+
+class KShape(object):
+    def __init__(self, num_clust):
+        """
+        num_clust is the number of clusters
+        assignments holds the assignments of data points (indices) to clusters
+        centroids holds the centroids of the clusters, np array of dimension (num_clust, max_len)
+        ts_dists holds the SBD of every series to its centroid, key is cluster, value = dict (key is member_idx)
+        """
+        self.num_clust = num_clust
+        self.assignments = {}
+        self.centroids = None
+        self.ts_dists = {}
+
+    def fit(self, index, num_iter, seed=None, verbose=True):
+        """
+        Parameters
+        ----------
+        index: SBDIndex of the series to cluster. Build it once and reuse it for every k
+        num_iter: maximum number of iterations
+        seed: int, seed for the random initial assignment
+        """
+        rng = np.random.RandomState(seed)
+        labels = rng.randint(self.num_clust, size=index.num_ts)
+        shifts = np.zeros(index.num_ts, dtype=np.int64)
+        self.centroids = np.zeros([self.num_clust, index.max_len])
+
+        for n in range(num_iter):
+            if verbose:
+                print 'iteration ' + str(n+1)
+
+            # Refine centroids from members aligned to previous centroid
+            for c in range(self.num_clust):
+                members = np.where(labels == c)[0]
+                if len(members) > 0:
+                    self.centroids[c] = self._extract_shape(index, members, shifts[members], self.centroids[c])
+
+            # Assign to centroid with smallest SBD
+            best_ncc = np.full(index.num_ts, -np.inf)
+            new_labels = np.zeros(index.num_ts, dtype=np.int64)
+            for c in range(self.num_clust):
+                ncc, c_shifts = index.ncc_max(self.centroids[c])
+                better = ncc > best_ncc
+                best_ncc[better] = ncc[better]
+                new_labels[better] = c
+                shifts[better] = c_shifts[better]
+
+            converged = np.array_equal(new_labels, labels)
+            labels = new_labels
+            if converged:
+                break
+
+        self.labels = labels
+        self.dists = 1 - best_ncc
+        self.assignments = {c: list(np.where(labels == c)[0]) for c in np.unique(labels)}
+        self.ts_dists = defaultdict(dict)
+        for ts_idx, c in enumerate(labels):
+            self.ts_dists[c][ts_idx] = self.dists[ts_idx]
+
+    def _extract_shape(self, index, members, shifts, prev_centroid):
+        """
+        Return z-normalized top eigenvector of Q^T S Q for members aligned (by shifts) to prev_centroid
+        """
+        if np.any(prev_centroid):
+            aligned = np.array([_shift(index.data[m], s) for m, s in zip(members, shifts)])
+        else:
+            aligned = index.data[members]
+        aligned = zscore(aligned)
+        if len(members) == 1:
+            return aligned[0]
+
+        def matvec(v):
+            v = np.ravel(v)
+            v = v - v.mean()                        # Q v
+            u = aligned.T.dot(aligned.dot(v))       # S Q v
+            return u - u.mean()                     # Q^T S Q v
+
+        n = index.max_len
+        op = LinearOperator((n, n), matvec=matvec, dtype=np.float64)
+        _, vecs = eigsh(op, k=1, which='LA')
+        centroid = zscore(vecs[:, 0])
+
+        # Eigenvector sign is arbitrary, keep the one closer to the members
+        if np.sum((aligned - centroid) ** 2) > np.sum((aligned + centroid) ** 2):
+            centroid = -centroid
+        return centroid
+
+    def get_centroids(self):
+        return self.centroids
+
+    def get_assignments(self):
+        return self.assignments
+
+    def get_ts_dists(self):
+        return self.ts_dists
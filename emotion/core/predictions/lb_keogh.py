@@ -0,0 +1,183 @@
+# LB_Keogh lower bound to dynamic time warping using precomputed envelopes
+#
+# The upper / lower envelope of every series is computed once with an O(n) sliding min / max (scipy's
+# minimum_filter1d / maximum_filter1d) and cached. Bounds for one-vs-many and all-pairs are then plain vectorized
+# numpy over the stacked (num_timeseries, max_len) array.
+#
+# The envelope window matches utils.LB_Keogh: index i of s2 contributes s2[max(0, i-r):i+r], so saved distance
+# matrices stay comparable with the ones computed pair by pair.
+#
+# Envelopes for several window sizes are nested (the window for r contains the window for any smaller r), so for
+# r <= 2 r_prev the envelope for r is the max (min) of the envelope for r_prev shifted by +-(r - r_prev), two reads
+# per element instead of a new sliding window. MultiLBKeogh computes the bounds for all window sizes together.
+
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+def envelope(data, r):
+    """
+    Return (upper, lower) envelopes of series
+
+    Parameters
+    ----------
+    data: 1-d array, or 2-d array of dimension (num_timeseries, max_len)
+    r: int, LB_Keogh window size
+
+    Returns
+    -------
+    upper, lower: arrays of same dimension as data
+    """
+    data = np.asarray(data, dtype=np.float64)
+    size = max(1, 2 * r)
+    upper = maximum_filter1d(data, size, axis=-1, mode='nearest')
+    lower = minimum_filter1d(data, size, axis=-1, mode='nearest')
+    return upper, lower
+
+def envelopes(data, rs):
+    """
+    Return (upper, lower) envelopes of series for every window size in rs, each of dimension (len(rs),) + data.shape.
+    Each envelope is grown from the one for the next smaller window size when possible (see top of file)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    upper = np.zeros((len(rs),) + data.shape)
+    lower = np.zeros((len(rs),) + data.shape)
+    max_len = data.shape[-1]
+    prev = None
+    for i in np.argsort(rs, kind='mergesort'):
+        r = rs[i]
+        if (prev is None) or (r - prev > prev):
+            upper[i], lower[i] = envelope(data, r)
+        else:
+            d = r - prev
+            left = np.maximum(np.arange(max_len) - d, 0)
+            right = np.minimum(np.arange(max_len) + d, max_len - 1)
+            upper[i] = np.maximum(upper[prev_i][..., left], upper[prev_i][..., right])
+            lower[i] = np.minimum(lower[prev_i][..., left], lower[prev_i][..., right])
+        prev, prev_i = r, i
+    return upper, lower
+
+def lb_keogh_envelope(query, upper, lower):
+    """
+    Return LB_Keogh between query and the series that upper and lower were computed from
+
+    Parameters
+    ----------
+    query: 1-d array of length max_len, or 2-d array of dimension (num_queries, max_len)
+    upper, lower: 1-d array of length max_len, or 2-d array of dimension (num_candidates, max_len)
+        - if both query and envelopes are 2-d, they must have the same first dimension (computed row-wise)
+
+    Returns
+    -------
+    float, or 1-d array
+    """
+    above = query - upper
+    np.maximum(above, 0.0, out=above)
+    below = lower - query
+    np.maximum(below, 0.0, out=below)
+    return np.sqrt(np.einsum('...i,...i->...', above, above) + np.einsum('...i,...i->...', below, below))
+
+class LBKeogh(object):
+    def __init__(self, data, r, upper=None, lower=None):
+        """
+        data: np array of dimension (num_timeseries, max_len)
+        r: int, LB_Keogh window size
+        upper, lower: precomputed envelopes of data (e.g. memmaps shared between processes). Computed if None
+
+        upper and lower hold the cached envelopes of every series in data
+        """
+        self.data = np.asarray(data, dtype=np.float64)
+        self.r = r
+        if (upper is None) or (lower is None):
+            upper, lower = envelope(self.data, r)
+        self.upper, self.lower = upper, lower
+
+    def one_vs_many(self, query, idxs=None):
+        """
+        Return LB_Keogh(query, data[j], r) for every j in idxs (all series if None)
+
+        Parameters
+        ----------
+        query: int (index into data) or 1-d array of length max_len
+        idxs: list or array of indices into data
+        """
+        if isinstance(query, (int, np.integer)):
+            query = self.data[query]
+        if idxs is None:
+            return lb_keogh_envelope(query, self.upper, self.lower)
+        return lb_keogh_envelope(query, self.upper[idxs], self.lower[idxs])
+
+    def many_vs_one(self, queries, idx):
+        """
+        Return LB_Keogh(queries[i], data[idx], r) for every row i of queries, i.e. the bound in the other direction
+        """
+        return lb_keogh_envelope(queries, self.upper[idx], self.lower[idx])
+
+    def all_pairs(self, rows=None, cols=None, max_elems=2 ** 22):
+        """
+        Return matrix where entry (i, j) is LB_Keogh(data[rows[i]], data[cols[j]], r)
+
+        Parameters
+        ----------
+        rows, cols: list or array of indices into data. If None, all series
+        max_elems: int, bound on the number of elements of each temporary array, i.e. pairs are evaluated in
+            tiles of (num_rows, num_cols) with num_rows * num_cols * max_len <= max_elems
+
+        Notes
+        -----
+        LB_Keogh is not symmetric. Callers that only fill the upper triangle (as the distance matrix used to be)
+        should take np.triu() of the result.
+        """
+        rows = np.arange(len(self.data)) if rows is None else np.asarray(rows)
+        cols = np.arange(len(self.data)) if cols is None else np.asarray(cols)
+        max_len = self.data.shape[1]
+        tile_cols = max(1, min(len(cols), max_elems // max_len))
+        tile_rows = max(1, max_elems // (tile_cols * max_len))
+
+        lbs = np.zeros([len(rows), len(cols)])
+        for c_start in range(0, len(cols), tile_cols):
+            c_idxs = cols[c_start:c_start + tile_cols]
+            upper = self.upper[c_idxs][np.newaxis]              # (1, tile_cols, max_len)
+            lower = self.lower[c_idxs][np.newaxis]
+            for r_start in range(0, len(rows), tile_rows):
+                q = self.data[rows[r_start:r_start + tile_rows]][:, np.newaxis, :]     # (tile_rows, 1, max_len)
+                lbs[r_start:r_start + tile_rows, c_start:c_start + tile_cols] = lb_keogh_envelope(q, upper, lower)
+        return lbs
+
+class MultiLBKeogh(object):
+    def __init__(self, data, rs, upper=None, lower=None):
+        """
+        data: np array of dimension (num_timeseries, max_len)
+        rs: list of ints, LB_Keogh window sizes
+        upper, lower: precomputed envelopes (see envelopes()), of dimension (len(rs), num_timeseries, max_len)
+
+        Bounds are returned stacked, first dimension is the window size
+        """
+        self.data = np.asarray(data, dtype=np.float64)
+        self.rs = list(rs)
+        if (upper is None) or (lower is None):
+            upper, lower = envelopes(self.data, self.rs)
+        self.upper, self.lower = upper, lower
+
+    def all_pairs(self, rows=None, cols=None, max_elems=2 ** 22):
+        """
+        Return (len(rs), len(rows), len(cols)) array where entry (k, i, j) is LB_Keogh(data[rows[i]], data[cols[j]],
+        rs[k]). Same tiling as LBKeogh.all_pairs; each tile of queries is gathered once and used for every window
+        size
+        """
+        rows = np.arange(len(self.data)) if rows is None else np.asarray(rows)
+        cols = np.arange(len(self.data)) if cols is None else np.asarray(cols)
+        max_len = self.data.shape[1]
+        tile_cols = max(1, min(len(cols), max_elems // max_len))
+        tile_rows = max(1, max_elems // (tile_cols * max_len))
+
+        lbs = np.zeros([len(self.rs), len(rows), len(cols)])
+        for c_start in range(0, len(cols), tile_cols):
+            c_idxs = cols[c_start:c_start + tile_cols]
+            upper = self.upper[:, c_idxs][:, np.newaxis]        # (len(rs), 1, tile_cols, max_len)
+            lower = self.lower[:, c_idxs][:, np.newaxis]
+            for r_start in range(0, len(rows), tile_rows):
+                q = self.data[rows[r_start:r_start + tile_rows]][:, np.newaxis, :]     # (tile_rows, 1, max_len)
+                for k in range(len(self.rs)):
+                    lbs[k, r_start:r_start + tile_rows, c_start:c_start + tile_cols] = \
+                        lb_keogh_envelope(q, upper[k], lower[k])
+        return lbs
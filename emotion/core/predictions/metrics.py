@@ -0,0 +1,93 @@
+# Clustering quality metrics computed from a precomputed distance matrix, for many clusterings at once
+#
+# Every clustering (e.g. one per k) is given as a label vector. The one-hot membership matrices of all of them are
+# stacked side by side into one (n, total number of clusters) matrix M, so a single product S = D M gives, for every
+# series and every cluster of every clustering, the sum of distances from the series to the cluster's members.
+# Everything else is read off S:
+#   - medoid: member with the smallest sum of distances to its cluster
+#   - cost: sum of distances from every series to its cluster's medoid (and per member distance to medoid)
+#   - silhouette: (b - a) / max(a, b), a = mean distance to own cluster, b = smallest mean distance to another
+#   - Davies-Bouldin (medoid based): mean over clusters of max_j (scatter_i + scatter_j) / dist(medoid_i, medoid_j),
+#     where scatter is the mean distance of members to their medoid. Lower is better
+#
+# Singleton clusters have a silhouette of 0.
+
+import numpy as np
+
+from condensed import dense
+
+def _relabel(labels):
+    """Return (number of clusters, labels mapped to 0..num_clusters-1)"""
+    clusts, labels = np.unique(labels, return_inverse=True)
+    return len(clusts), labels
+
+def cluster_metrics(D, labels_stack):
+    """
+    Return list of dicts, one per label vector, with keys:
+        num_clusters, cost, mean_dist, silhouette, davies_bouldin, sizes,
+        medoids: array of series indices, one per cluster (clusters in sorted label order)
+        medoid_dists: 1-d array of length n, distance from every series to its cluster's medoid
+
+    Parameters
+    ----------
+    D: CondensedDistMatrix or dense (n, n) distance matrix
+    labels_stack: 2-d array of dimension (num_clusterings, n), or list of label vectors. Labels can be any ints
+    """
+    D = dense(D)
+    n = len(D)
+    relabeled = [_relabel(np.asarray(labels)) for labels in labels_stack]
+
+    # One membership matrix for all clusterings, one product with the distance matrix
+    offsets = np.cumsum([0] + [num_c for num_c, _ in relabeled])
+    members = np.zeros([n, offsets[-1]], dtype=D.dtype)
+    for (num_c, labels), offset in zip(relabeled, offsets):
+        members[np.arange(n), offset + labels] = 1
+    sums = D.dot(members).astype(np.float64)        # (n, total clusters)
+
+    rows = np.arange(n)
+    results = []
+    for (num_c, labels), offset in zip(relabeled, offsets):
+        S = sums[:, offset:offset + num_c]
+        sizes = np.bincount(labels, minlength=num_c).astype(np.float64)
+        own = S[rows, labels]
+
+        # Medoids: smallest sum of distances within own cluster
+        masked = np.where(members[:, offset:offset + num_c] > 0, S, np.inf)
+        medoids = np.argmin(masked, axis=0)
+        medoid_dists = D[rows, medoids[labels]].astype(np.float64)
+
+        # Silhouette
+        if num_c > 1:
+            a = own / np.maximum(sizes[labels] - 1, 1)
+            means = S / sizes
+            means[rows, labels] = np.inf
+            b = means.min(axis=1)
+            sil = (b - a) / np.maximum(np.maximum(a, b), 1e-12)
+            sil[sizes[labels] == 1] = 0
+            silhouette = float(sil.mean())
+        else:
+            silhouette = 0.0
+
+        # Davies-Bouldin with medoids as cluster centers
+        if num_c > 1:
+            scatter = np.bincount(labels, weights=medoid_dists, minlength=num_c) / sizes
+            sep = D[np.ix_(medoids, medoids)].astype(np.float64)
+            np.fill_diagonal(sep, np.inf)
+            ratios = (scatter[:, np.newaxis] + scatter[np.newaxis, :]) / np.maximum(sep, 1e-12)
+            davies_bouldin = float(ratios.max(axis=1).mean())
+        else:
+            davies_bouldin = 0.0
+
+        results.append({'num_clusters': num_c,
+                        'cost': float(medoid_dists.sum()),
+                        'mean_dist': float(medoid_dists.mean()),
+                        'silhouette': silhouette,
+                        'davies_bouldin': davies_bouldin,
+                        'sizes': sizes.astype(np.int64),
+                        'medoids': medoids,
+                        'medoid_dists': medoid_dists})
+    return results
+
+def silhouette(D, labels):
+    """Return mean silhouette of one label vector"""
+    return cluster_metrics(D, [labels])[0]['silhouette']
@@ -0,0 +1,171 @@
+# Mini-batch k-means (Sculley, "Web-Scale K-Means Clustering", 2010) over a memory-mapped series file
+#
+# Series are never all in memory: each step reads a random batch of rows from the .npy (opened with mmap_mode='r',
+# rows read in sorted order), assigns them with the DTW cascade in cascade.py, and moves each centroid towards its
+# batch members with a per-centroid learning rate 1 / (number of series assigned to it so far). Memory is bounded by
+# batch_size and the (num_clust, max_len) centroids.
+#
+# Batch assignment, and the final assignment of all series, are split across a pool of workers that each open the
+# file themselves.
+#
+# Convergence is reported per batch: the batch's mean distance to its centroid, an exponentially weighted average of
+# it, and how far the centroids moved. Fitting stops when the centroids move less than tol, when the weighted
+# average has not improved for max_no_improvement batches, or after max_batches.
+
+from collections import Counter, defaultdict
+import multiprocessing
+
+import numpy as np
+
+from cascade import PRUNE_STAGES, assign_nearest, get_lb_radius
+
+########################################################################################################################
+# Workers
+########################################################################################################################
+_worker = {}
+
+def _init_worker(path, w, r):
+    """Open series file read-only as a memmap once per worker process"""
+    _worker['data'] = np.load(path, mmap_mode='r')
+    _worker['w'] = w
+    _worker['r'] = r
+
+def _assign_idxs(task):
+    """Return (labels, dists, stats) of series idxs (sorted) against centroids"""
+    idxs, centroids = task
+    stats = Counter()
+    series = np.asarray(_worker['data'][idxs], dtype=np.float64)
+    labels, dists = assign_nearest(series, centroids, _worker['w'], _worker['r'], stats=stats)
+    return labels, dists, stats
+
+class MiniBatchKMeans(object):
+    def __init__(self, num_clust, batch_size=100, max_batches=500, tol=1e-3, max_no_improvement=10):
+        """
+        num_clust is the number of clusters
+        batch_size: int, number of series per batch
+        max_batches: int, maximum number of batches
+        tol: float, stop when the root mean square movement of the centroids in a batch (averaged over centroids) is
+            below this
+        max_no_improvement: int, stop when the smoothed batch distance has not improved for this many batches
+
+        assignments holds the assignments of data points (indices) to clusters
+        centroids holds the centroids of the clusters, np array of dimension (num_clust, max_len)
+        history holds one dict per batch: batch, dist, ewa_dist, shift
+        """
+        self.num_clust = num_clust
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.tol = tol
+        self.max_no_improvement = max_no_improvement
+        self.assignments = {}
+        self.centroids = None
+        self.ts_dists = {}
+        self.history = []
+
+    def fit(self, path, w, r, seed=None, num_workers=None, chunk_size=None, verbose=True):
+        """
+        Parameters
+        ----------
+        path: path to .npy of dimension (num_timeseries, max_len), z-normalized series
+        w: int, DTW window size
+        r: int, LB_Keogh window size (widened to cover the DTW window, see get_lb_radius)
+        seed: int, seed for initial centroids and batches
+        num_workers: int, number of processes. If None, number of cpus
+        chunk_size: int, number of series read at a time when assigning all series at the end. If None, batch_size
+        verbose: bool, print convergence per batch
+        """
+        data = np.load(path, mmap_mode='r')
+        num_ts, max_len = data.shape
+        batch_size = min(self.batch_size, num_ts)
+        chunk_size = chunk_size or batch_size
+        lb_r = get_lb_radius(r, w, max_len)
+        rng = np.random.RandomState(seed)
+
+        self.centroids = np.array(data[np.sort(rng.choice(num_ts, self.num_clust, replace=False))], dtype=np.float64)
+        counts = np.zeros(self.num_clust)
+        self.history = []
+        self.prune_stats = Counter()
+
+        num_workers = num_workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes=num_workers, initializer=_init_worker, initargs=(path, w, lb_r))
+        try:
+            ewa_dist, best_ewa_dist, no_improvement = None, np.inf, 0
+            for b in range(self.max_batches):
+                idxs = np.sort(rng.choice(num_ts, batch_size, replace=False))
+                labels, dists = self._assign(pool, idxs, num_workers)
+                batch = np.asarray(data[idxs], dtype=np.float64)
+
+                # Move centroids towards the mean of their batch members with learning rate 1 / counts
+                batch_counts = np.bincount(labels, minlength=self.num_clust)
+                members = np.zeros([self.num_clust, len(idxs)])
+                members[labels, np.arange(len(idxs))] = 1
+                counts += batch_counts
+                nonempty = batch_counts > 0
+                old = self.centroids.copy()
+                self.centroids[nonempty] += (members.dot(batch)[nonempty] -
+                                             batch_counts[nonempty, np.newaxis] * old[nonempty]) / \
+                                            counts[nonempty, np.newaxis]
+                shift = float(np.sqrt(((self.centroids - old) ** 2).mean(axis=1)).mean())
+
+                # Convergence
+                dist = float(dists.mean())
+                alpha = min(1.0, 2.0 * batch_size / (num_ts + 1))
+                ewa_dist = dist if ewa_dist is None else (1 - alpha) * ewa_dist + alpha * dist
+                self.history.append({'batch': b + 1, 'dist': dist, 'ewa_dist': ewa_dist, 'shift': shift})
+                if verbose:
+                    print 'batch {}: dist {:.4f}, ewa dist {:.4f}, centroid shift {:.6f}'.format(
+                        b + 1, dist, ewa_dist, shift)
+
+                if ewa_dist < best_ewa_dist:
+                    best_ewa_dist, no_improvement = ewa_dist, 0
+                else:
+                    no_improvement += 1
+                if (b > 0) and (shift < self.tol):
+                    if verbose:
+                        print 'converged: centroid shift below {}'.format(self.tol)
+                    break
+                if no_improvement >= self.max_no_improvement:
+                    if verbose:
+                        print 'converged: no improvement in {} batches'.format(no_improvement)
+                    break
+
+            # Assign every series, a chunk at a time
+            self.labels = np.zeros(num_ts, dtype=np.int64)
+            self.dists = np.zeros(num_ts)
+            for start in range(0, num_ts, chunk_size):
+                idxs = np.arange(start, min(num_ts, start + chunk_size))
+                self.labels[idxs], self.dists[idxs] = self._assign(pool, idxs, num_workers)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if verbose:
+            print 'pruned by ' + ', '.join(['{}: {}'.format(stage, self.prune_stats[stage]) for stage in PRUNE_STAGES])
+
+        self.assignments = {}
+        self.ts_dists = defaultdict(dict)
+        for ind, (c, dist) in enumerate(zip(self.labels.tolist(), self.dists.tolist())):
+            self.assignments.setdefault(c, []).append(ind)
+            self.ts_dists[c][ind] = dist
+
+    def _assign(self, pool, idxs, num_workers):
+        """Return (labels, dists) of series idxs, split across workers"""
+        tasks = [(chunk, self.centroids) for chunk in np.array_split(idxs, num_workers) if len(chunk) > 0]
+        results = pool.map(_assign_idxs, tasks)
+        for _, _, stats in results:
+            self.prune_stats.update(stats)
+        labels = np.concatenate([chunk_labels for chunk_labels, _, _ in results])
+        dists = np.concatenate([chunk_dists for _, chunk_dists, _ in results])
+        return labels, dists
+
+    def get_centroids(self):
+        return self.centroids
+
+    def get_assignments(self):
+        return self.assignments
+
+    def get_ts_dists(self):
+        return self.ts_dists
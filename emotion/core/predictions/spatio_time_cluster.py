@@ -1,6 +1,7 @@
 # Cluster time series
 
 from __future__ import division
+from collections import Counter
 import matplotlib.pylab as plt
 import numpy as np
 import random
@@ -9,6 +10,10 @@ from scipy import spatial
 from sklearn.decomposition import PCA
 from sklearn import preprocessing
 
+from cascade import assign_nearest, get_lb_radius
+from dtw import dtw_distance
+from utils import LB_Keogh
+
 class ts_cluster(object):
     def __init__(self,num_clust=100):
         '''
@@ -20,81 +25,51 @@ class ts_cluster(object):
         self.assignments={}
         self.centroids=[]
 
-    def compa_clust(self,s1,centroid,w):
+    def assign_clusters(self,data,centroids,w,r=5):
+        '''
+        Assign every series in data to its closest centroid under SpatioTemporalDis, all series at once.
+        The invariant-feature distances come from one cdist, the DTW part from the batched cascade in cascade.py.
+        Returns (labels, distances)
+        '''
+        data=np.asarray(data,dtype=np.float64)
+        centroids=np.asarray(centroids,dtype=np.float64)
+        disInvari=spatial.distance.cdist(data[:,0:2],centroids[:,0:2])
+        lb_r=get_lb_radius(r,w,data.shape[1]-2)
+        self.prune_stats=Counter()
+        return assign_nearest(data[:,2:],centroids[:,2:],w,lb_r,offsets=disInvari,stats=self.prune_stats)
+
+    def compa_clust(self,s1,centroid,w,r=5):
         centroid_part = centroid[:,:5]
-        self.assign = pd.Series([[] for i in range(len(centroid))],index=np.arange(len(centroid)))
-
-        for ind,i in enumerate(s1):
-            min_dist=float('inf')
-            #closest_clust=None
-            for c_ind,j in enumerate(centroid_part):
-
-                if self.LB_Keogh(i,j,5)<min_dist:
-                    cur_dist=self.SpatioTemporalDis(i, j, w)
-
-                    if cur_dist<min_dist:
-                        min_dist=cur_dist
-                        closest_clust=c_ind
-
-
-            self.assign[closest_clust].append(ind)
+        labels,_ = self.assign_clusters(s1,centroid_part,w,r)
+        self.assign = pd.Series([list(np.where(labels==c)[0]) for c in range(len(centroid))],index=np.arange(len(centroid)))
 
         print self.assign
-        #print s1[1]
-        self.s2 = pd.Series([[] for i in range(len(s1))],index=np.arange(len(s1)))
-        #print self.s2
-        for key in self.assign.index:
-            for k in self.assign[key]:
-                self.s2[k] = centroid[key,6:].tolist()
-                #print self.s2[k]
-        self.s2 = np.array(self.s2)
+        self.s2 = centroid[labels,6:]
         return self.s2
 
-
-
-    def k_means_clust(self,data,num_iter,w,progress=True):
+    def k_means_clust(self,data,num_iter,w,progress=True,r=5):
 
         '''
         k-means clustering algorithm for time series data.  dynamic time warping Euclidean distance
          used as default similarity measure.
         '''
-        self.centroids=random.sample(data,self.num_clust)
+        data=np.asarray(data,dtype=np.float64)
+        self.centroids=np.array(random.sample(data,self.num_clust))
         print len(self.centroids)
         for n in range(num_iter):
             if progress:
                 print 'iteration '+str(n+1)
 
-            self.assignments={}
-            for ind,i in enumerate(data):
-                min_dist=float('inf')
-                closest_clust=None
-                for c_ind,j in enumerate(self.centroids):
-                    if self.LB_Keogh(i,j,5)<min_dist:
-                        cur_dist=self.SpatioTemporalDis(i, j, w)
-
-                        if cur_dist<min_dist:
-                            min_dist=cur_dist
-                            closest_clust=c_ind
-
-                if closest_clust in self.assignments:
-                    self.assignments[closest_clust].append(ind)
-                else:
-                    self.assignments[closest_clust]=[]
+            labels,_=self.assign_clusters(data,self.centroids,w,r)
+            self.assignments={c:list(np.where(labels==c)[0]) for c in np.unique(labels)}
 
             print len(self.assignments)
-            #recalculate centroids of clusters
-
-            for key in self.assignments:
-                clust_sum=np.zeros(len(data[0]))
-                for k in self.assignments[key]:
-                    clust_sum=np.add(clust_sum,data[k])
-                    self.centroids[key]=[m/len(self.assignments[key]) for m in clust_sum]
-            # for key in self.assignments:
-            #     clust_sum=0
-            #     for k in self.assignments[key]:
-            #         clust_sum=clust_sum+data[k]
-            #         print clust_sum
-            #     self.centroids[key]=[m/len(self.assignments[key]) for m in clust_sum]
+            #recalculate centroids of clusters, one segmented mean over all series
+            counts=np.bincount(labels,minlength=self.num_clust)
+            sums=np.zeros(self.centroids.shape)
+            np.add.at(sums,labels,data)
+            nonempty=counts>0
+            self.centroids[nonempty]=sums[nonempty]/counts[nonempty][:,np.newaxis]
 
     def get_centroids(self):
         return self.centroids
@@ -126,52 +101,14 @@ class ts_cluster(object):
 
     def DTWDistance(self,s1,s2,w=None):
         '''
-        Calculates dynamic time warping Euclidean distance between two
+        Calculates (squared) dynamic time warping Euclidean distance between two
         sequences. Option to enforce locality constraint for window w.
         '''
-        DTW={}
-
-        if w:
-            w = max(w, abs(len(s1)-len(s2)))
-
-            for i in range(-1,len(s1)):
-                for j in range(-1,len(s2)):
-                    DTW[(i, j)] = float('inf')
-
-        else:
-            for i in range(len(s1)):
-                DTW[(i, -1)] = float('inf')
-            for i in range(len(s2)):
-                DTW[(-1, i)] = float('inf')
-
-        DTW[(-1, -1)] = 0
-
-        for i in range(len(s1)):
-            if w:
-                for j in range(max(0, i-w), min(len(s2), i+w)):
-                    dist= (s1[i]-s2[j])**2
-                    DTW[(i, j)] = dist + min(DTW[(i-1, j)],DTW[(i, j-1)], DTW[(i-1, j-1)])
-            else:
-                for j in range(len(s2)):
-                    dist= (s1[i]-s2[j])**2
-                    DTW[(i, j)] = dist + min(DTW[(i-1, j)],DTW[(i, j-1)], DTW[(i-1, j-1)])
-
-        return (DTW[len(s1)-1, len(s2)-1])
+        return dtw_distance(s1, s2, w) ** 2
 
     def LB_Keogh(self,s1,s2,r):
         '''
         Calculates LB_Keough lower bound to dynamic time warping. Linear
         complexity compared to quadratic complexity of dtw.
         '''
-        LB_sum=0
-        for ind,i in enumerate(s1):
-
-            lower_bound=min(s2[(ind-r if ind-r>=0 else 0):(ind+r)])
-            upper_bound=max(s2[(ind-r if ind-r>=0 else 0):(ind+r)])
-
-            if i>upper_bound:
-                LB_sum=LB_sum+(i-upper_bound)**2
-            elif i<lower_bound:
-                LB_sum=LB_sum+(i-lower_bound)**2
-
-        return np.sqrt(LB_sum)
\ No newline at end of file
+        return LB_Keogh(s1, s2, r)
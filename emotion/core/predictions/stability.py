@@ -0,0 +1,99 @@
+# Bootstrap stability of a clustering, from the precomputed distance matrix
+#
+# Hennig, "Cluster-wise assessment of cluster stability" (2007). num_boot subsamples (a fraction of the series, drawn
+# without replacement, so no series is duplicated at distance 0 from itself) are taken by slicing rows / columns of
+# the distance matrix, so no distance is recomputed. Each subsample is reclustered with k-medoids (kmedoids.py) in a
+# pool of workers. Then, for every cluster of the reference clustering:
+#   - Jaccard similarity to the most similar cluster of each subsample, restricted to the subsampled series
+#   - stability: mean of those over the subsamples in which the cluster appears. Roughly, above 0.75 is a stable
+#     cluster, below 0.5 is not a real one
+# and, for every pair of series, the co-assignment: fraction of the subsamples containing both in which both are in
+# the same cluster.
+
+import multiprocessing
+
+import numpy as np
+
+from condensed import dense
+import kmedoids
+
+_D = None       # dense distance matrix, set before the pool is created so that workers inherit it on fork
+
+def _run_bootstrap(args):
+    """Return (indices of subsampled series, k-medoids labels of the subsample)"""
+    seed, k, size, max_iter = args
+    rng = np.random.RandomState(seed)
+    idxs = np.sort(rng.choice(len(_D), size, replace=False))
+    D = _D[np.ix_(idxs, idxs)]
+    medoids, _ = kmedoids.swap(D, kmedoids.build(D, k), max_iter, rng)
+    labels, _, _ = kmedoids._nearest_two(D, medoids)
+    return idxs, labels.astype(np.int32)
+
+def _jaccard(ref_labels, labels, num_ref):
+    """Return, for every reference cluster, Jaccard similarity to its most similar cluster in labels (nan if empty)"""
+    num_c = labels.max() + 1
+    inter = np.bincount(ref_labels * num_c + labels, minlength=num_ref * num_c).reshape(num_ref, num_c)
+    ref_sizes = inter.sum(axis=1)
+    sizes = inter.sum(axis=0)
+    union = ref_sizes[:, np.newaxis] + sizes[np.newaxis, :] - inter
+    jaccard = (inter / np.maximum(union, 1).astype(np.float64)).max(axis=1)
+    jaccard[ref_sizes == 0] = np.nan
+    return jaccard
+
+def bootstrap_stability(D, k, ref_labels, num_boot=200, frac=0.8, max_iter=100, num_workers=None, seed=0,
+                        logger=None):
+    """
+    Return (stability, jaccard, coassign)
+
+    Parameters
+    ----------
+    D: CondensedDistMatrix or dense (n, n) distance matrix. Converted once and shared (read-only) by all workers
+    k: int, number of clusters of every subsample
+    ref_labels: 1-d array of length n, clustering to assess (labels can be any ints)
+    num_boot: int, number of subsamples
+    frac: float, fraction of series in every subsample
+    max_iter: int, maximum number of k-medoids swap passes per subsample
+    num_workers: int, number of processes. If None, number of cpus
+    seed: int, subsample b is drawn with seed + b, so results do not depend on num_workers
+    logger: logger to report progress to
+
+    Returns
+    -------
+    stability: 1-d array, mean Jaccard of every reference cluster (clusters in sorted label order)
+    jaccard: 2-d array of dimension (num_boot, num_clusters), nan where a cluster has no series in a subsample
+    coassign: 2-d float32 array of dimension (n, n)
+    """
+    global _D
+    log = logger.info if logger else (lambda msg: None)
+    _D = dense(D)
+    n = len(_D)
+    _, ref_labels = np.unique(ref_labels, return_inverse=True)
+    num_ref = ref_labels.max() + 1
+    size = int(round(frac * n))
+
+    jaccard = np.zeros([num_boot, num_ref])
+    together = np.zeros([n, n], dtype=np.float32)
+    sampled = np.zeros([n, n], dtype=np.float32)
+    runs = [(seed + b, k, size, max_iter) for b in range(num_boot)]
+    pool = multiprocessing.Pool(processes=num_workers or multiprocessing.cpu_count())
+    try:
+        for b, (idxs, labels) in enumerate(pool.imap(_run_bootstrap, runs)):
+            jaccard[b] = _jaccard(ref_labels[idxs], labels, num_ref)
+            members = np.zeros([len(idxs), k], dtype=np.float32)
+            members[np.arange(len(idxs)), labels] = 1
+            block = np.ix_(idxs, idxs)
+            together[block] += members.dot(members.T)
+            sampled[block] += 1
+            if (b + 1) % 20 == 0 or (b + 1) == num_boot:
+                log('Bootstrap: {}/{} subsamples'.format(b + 1, num_boot))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _D = None
+
+    stability = np.nanmean(jaccard, axis=0)
+    coassign = together / np.maximum(sampled, 1)
+    return stability, jaccard, coassign
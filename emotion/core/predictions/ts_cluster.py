@@ -1,10 +1,34 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 import matplotlib.pylab as plt
+import multiprocessing
 import numpy as np
 import random
 
+from cascade import PRUNE_STAGES, assign_nearest, get_lb_radius
+from lb_keogh import envelope
 from utils import DTWDistance, fastdtw_dist, LB_Keogh
 
+########################################################################################################################
+# Workers for the k-means assignment step
+########################################################################################################################
+_worker = {}
+
+def _init_worker(data, data_upper, data_lower, w, r):
+    """Keep series and their envelopes once per worker process (inherited on fork, not sent per task)"""
+    _worker['data'] = data
+    _worker['env'] = (data_upper, data_lower)
+    _worker['w'] = w
+    _worker['r'] = r
+
+def _assign_chunk(task):
+    """Return (labels, dists, stats) of the series in chunk against centroids"""
+    chunk, centroids = task
+    stats = Counter()
+    upper, lower = _worker['env']
+    labels, dists = assign_nearest(_worker['data'][chunk], centroids, _worker['w'], _worker['r'], stats=stats,
+                                   series_env=(upper[chunk], lower[chunk]))
+    return labels, dists, stats
+
 class ts_cluster(object):
     def __init__(self, num_clust):
         """
@@ -16,69 +40,94 @@ class ts_cluster(object):
         self.assignments = {}
         self.centroids = []
 
-    def k_means_clust(self, data, num_iter, w, r, verbose=True):
+    def k_means_clust(self, data, num_iter, w, r, verbose=True, num_workers=None):
         """
         k-means clustering algorithm for time series data.  dynamic time warping Euclidean distance
          used as default similarity measure.
+
+        Series are assigned to the centroid with the smallest (banded, window w) DTW distance, found with the
+        LB_Kim -> LB_Keogh -> early-abandoned DTW cascade in cascade.py. prune_stats holds, per iteration, how many
+        (series, centroid) candidates were resolved at each stage.
+
+        The assignment step is split over chunks of series in a pool of num_workers processes (number of cpus if
+        None), which share data and its envelopes. centroids is a (num_clust, max_len) array.
         """
-        self.centroids = random.sample(data, self.num_clust)
-        self.ts_dists = defaultdict(dict)
+        data = np.asarray(data, dtype=np.float64)
+        self.centroids = data[random.sample(range(len(data)), self.num_clust)].copy()
+        self.prune_stats = []
+
+        # LB_Keogh is only a lower bound to DTW if the envelope covers the DTW band
+        lb_r = get_lb_radius(r, w, data.shape[1])
+        if verbose and lb_r != r:
+            print 'LB_Keogh window size increased from {} to {} to cover DTW window {}'.format(r, lb_r, w)
+        data_upper, data_lower = envelope(data, lb_r)
+
+        num_workers = num_workers or multiprocessing.cpu_count()
+        chunks = [chunk for chunk in np.array_split(np.arange(len(data)), num_workers * 4) if len(chunk) > 0]
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                                        initargs=(data, data_upper, data_lower, w, lb_r))
+        else:
+            _init_worker(data, data_upper, data_lower, w, lb_r)
+
+        try:
+            for n in range(num_iter):
+                if verbose:
+                    print 'iteration ' + str(n+1)
+
+                # Assign data points to clusters, a chunk of series per task
+                tasks = [(chunk, self.centroids) for chunk in chunks]
+                results = pool.map(_assign_chunk, tasks) if pool else [_assign_chunk(task) for task in tasks]
+                labels = np.concatenate([chunk_labels for chunk_labels, _, _ in results])
+                dists = np.concatenate([chunk_dists for _, chunk_dists, _ in results])
+                stats = sum([chunk_stats for _, _, chunk_stats in results], Counter())
+
+                self.assignments = {}
+                self.ts_dists = defaultdict(dict)
+                for ind, (closest_clust, min_dist) in enumerate(zip(labels.tolist(), dists.tolist())):
+                    # Add distance b/n series i and centroid to ts_dists
+                    self.ts_dists[closest_clust][ind] = min_dist
+                    self.assignments.setdefault(closest_clust, []).append(ind)
+
+                self.prune_stats.append(stats)
+                if verbose:
+                    print 'pruned by ' + ', '.join(['{}: {}'.format(stage, stats[stage]) for stage in PRUNE_STAGES])
+
+                # Recalculate centroids of clusters: one (num_clust, num_ts) x (num_ts, max_len) product sums the
+                # members of every cluster. Empty clusters keep their previous centroid
+                counts = np.bincount(labels, minlength=self.num_clust)
+                members = np.zeros([self.num_clust, len(data)])
+                members[labels, np.arange(len(data))] = 1
+                sums = members.dot(data)
+                nonempty = counts > 0
+                self.centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+            _worker.clear()
+
+    def k_medoids_clust(self, data, dist_matrix, num_iter, n_seeds=1, num_workers=None, init_medoids=None):
+        """
+        dist_matrix: CondensedDistMatrix, symmetric distances between every pair of series in data
+        n_seeds: int, number of k-medoids runs (in parallel), keeping the one with lowest cost
+        num_workers: int, number of processes for the runs
+        init_medoids: array of medoid indices to start the first run from instead of BUILD
 
-        for n in range(num_iter):
-            if verbose:
-                print 'iteration ' + str(n+1)
-
-            # Assign data points to clusters
-            self.assignments = {}
-            for ind, i in enumerate(data):
-                min_dist = float('inf')
-                closest_clust = None
-                for c_ind, j in enumerate(self.centroids):
-                    # Attempt using fastdtw - fastdtw still much slower than LB_Keogh with r=5, but much faster than DTWDistance
-                    # fastdtw is about 2 times slower than LB_Keogh with r=500, where ts length for films is ~15000
-                    # cur_dist = fastdtw_dist(i, j)
-                    # if cur_dist < min_dist:
-                    #     min_dist = cur_dist
-                    #     closest_clust = c_ind
-
-                    # Attempt to only use LB_Keogh
-                    cur_dist = LB_Keogh(i, j, r)
-                    if cur_dist < min_dist:
-                        min_dist = cur_dist
-                        closest_clust = c_ind
-
-                    # Attempt to use LB_Keogh AND DTWDistance
-                    # if LB_Keogh(i,j,5)<min_dist:
-                    #     cur_dist=DTWDistance(i,j,w)
-                    #     if cur_dist<min_dist:
-                    #         min_dist=cur_dist
-                    #         closest_clust=c_ind
-
-                # Add distance b/n series i and centroid to ts_dists
-                self.ts_dists[closest_clust][ind] = min_dist
-
-                if closest_clust in self.assignments:
-                    self.assignments[closest_clust].append(ind)
-                else:
-                    self.assignments[closest_clust] = []        # TODO: shouldn't this be [ind]
-
-            # Recalculate centroids of clusters
-            for key in self.assignments:
-                clust_sum = np.zeros(len(data[0]))
-                for k in self.assignments[key]:
-                    clust_sum = np.add(clust_sum,data[k])
-                    self.centroids[key]= [m / len(self.assignments[key]) for m in clust_sum]
-
-    def k_medoids_clust(self, data, dist_matrix, num_iter):
+        cost holds the sum of distances from every series to its medoid
+        """
     # def k_medoids_cluster(self, data, dist_matrix, num_iter, w, r, verbose=True):
 
-        # Turn dist_matrix from upper-triangle to full
-        for i in range(len(data)):
-            for j in range(0, i):
-                dist_matrix[i][j] = dist_matrix[j][i]
-
         import kmedoids
-        M, C = kmedoids.kMedoids(dist_matrix, self.num_clust, num_iter)
+        M, C = kmedoids.kMedoids(dist_matrix, self.num_clust, num_iter, n_seeds=n_seeds, num_workers=num_workers,
+                                 init_medoids=init_medoids)
+        self.medoid_idxs = M
 
         # Wrap up, get in same format as kmeans
         self.medoids = []
@@ -91,9 +140,9 @@ class ts_cluster(object):
             # print c_ts_idx
             c_ts_idx = M[c]
             for ts_idx in C[c]:
-                self.assignments[c].append(data[ts_idx])
-                self.ts_dists[c][ts_idx] = max(dist_matrix[c_ts_idx][ts_idx],
-                                                   dist_matrix[ts_idx][c_ts_idx])
+                self.assignments[c].append(ts_idx)
+                self.ts_dists[c][ts_idx] = float(dist_matrix[c_ts_idx, ts_idx])
+        self.cost = sum([sum(dists.values()) for dists in self.ts_dists.values()])
 
         # Even though whole point of medoids is to avoid Euclidean mean-based centroids, I think it is still
         # nice to show the 'mean' of the curves of one cluster for kmedoids to produce smoother representations
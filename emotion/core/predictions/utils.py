@@ -4,43 +4,24 @@ from fastdtw import fastdtw
 import numpy as np
 from scipy.spatial.distance import euclidean
 
+from dtw import dtw_distance
+from lb_keogh import envelope, lb_keogh_envelope
+
 ########################################################################################################################
 # Calculating dynamic time warping (DTW) distance
 ########################################################################################################################
 
-def DTWDistance(s1, s2, w=None):
+def DTWDistance(s1, s2, w=None, cutoff=None):
     """
     Calculates dynamic time warping Euclidean distance between two
-    sequences. Option to enforce locality constraint for window w.
-    """
-    DTW={}
-
-    if w:
-        w = max(w, abs(len(s1)-len(s2)))
-
-        for i in range(-1,len(s1)):
-            for j in range(-1,len(s2)):
-                DTW[(i, j)] = float('inf')
-
-    else:
-        for i in range(len(s1)):
-            DTW[(i, -1)] = float('inf')
-        for i in range(len(s2)):
-            DTW[(-1, i)] = float('inf')
+    sequences. Option to enforce locality constraint for window w, and to
+    early abandon (returning inf) once the distance must exceed cutoff.
+    See dtw.py for the banded, two-row kernel.
 
-    DTW[(-1, -1)] = 0
-
-    for i in range(len(s1)):
-        if w:
-            for j in range(max(0, i-w), min(len(s2), i+w)):
-                dist= (s1[i]-s2[j])**2
-                DTW[(i, j)] = dist + min(DTW[(i-1, j)],DTW[(i, j-1)], DTW[(i-1, j-1)])
-        else:
-            for j in range(len(s2)):
-                dist= (s1[i]-s2[j])**2
-                DTW[(i, j)] = dist + min(DTW[(i-1, j)],DTW[(i, j-1)], DTW[(i-1, j-1)])
-
-    return np.sqrt(DTW[len(s1)-1, len(s2)-1])
+    Note: the band is now inclusive, columns [i-w, i+w]. The previous implementation left out column i+w (and so was
+    asymmetric for small w), so distances differ from those saved before for the same w, e.g. w=2 as used by k-means.
+    """
+    return dtw_distance(s1, s2, w=w, cutoff=cutoff)
 
 def fastdtw_dist(s1, s2, dist=euclidean):
     """
@@ -52,20 +33,13 @@ def fastdtw_dist(s1, s2, dist=euclidean):
 def LB_Keogh(s1, s2, r):
     """
     Calculates LB_Keough lower bound to dynamic time warping. Linear
-    complexity compared to quadratic complexity of dtw.
+    complexity compared to quadratic complexity of dtw. Use lb_keogh.LBKeogh
+    to cache envelopes when bounding many pairs.
     """
-    LB_sum=0
-    for ind,i in enumerate(s1):
-
-        lower_bound=min(s2[(ind-r if ind-r>=0 else 0):(ind+r)])
-        upper_bound=max(s2[(ind-r if ind-r>=0 else 0):(ind+r)])
-
-        if i>upper_bound:
-            LB_sum=LB_sum+(i-upper_bound)**2
-        elif i<lower_bound:
-            LB_sum=LB_sum+(i-lower_bound)**2
-
-    return np.sqrt(LB_sum)
+    s1 = np.asarray(s1, dtype=np.float64)
+    upper, lower = envelope(s2, r)
+    n = min(len(s1), len(upper))
+    return lb_keogh_envelope(s1[:n], upper[:n], lower[:n])
 
 ########################################################################################################################
 # Smoothing predictions
@@ -0,0 +1,187 @@
+# Content-addressed cache of analysis artifacts (time series of a corpus, clustering results, ...)
+#
+# An artifact is keyed by a sha1 of its stage, its parameters, and fingerprints of its inputs:
+#   - for a stage that reads predictions, fingerprint_preds() of every video (size and mtime of each prediction file
+#     and of credits_index.txt), so changed predictions give a new key instead of reusing a stale file of the same name
+#   - for a stage that reads another artifact, fingerprint_file() of that artifact's file (sha1 of its contents)
+# and kept in <root>/<stage>/<key>/, with its files and lineage.json:
+#   key, stage, params, inputs (name -> fingerprint), files (name -> sha1 of contents), info (e.g. n), created
+# A stage looks up its key with get() before computing and skips if the artifact exists. latest() returns the newest
+# artifact of a stage with given parameters (the website uses it instead of hard-coded file names), and parents()
+# follows lineage: an input fingerprint that is the sha1 of another artifact's file links to that artifact.
+#
+# Files are hard-linked into the cache (and back out by restore()), not copied, so a cached artifact takes no space
+# beyond the working file it was put from. Writers must therefore replace files (write a temporary file and rename
+# it), never write into them in place. Only the newest `keep` artifacts of a stage with the same parameters are kept,
+# older ones (e.g. from earlier predictions) are pruned on put().
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from pred_store import META_FN, get_csv_path, get_store_path
+
+LINEAGE_FN = 'lineage.json'
+KEEP = 3                # default number of artifacts kept per stage and parameters
+
+########################################################################################################################
+# Fingerprints
+########################################################################################################################
+def fingerprint_file(path, chunk_size=1 << 20):
+    """Return sha1 of file contents"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint_preds(vid_dirpaths, pred_fn):
+    """
+    Return sha1 over the prediction files (binary store or csv, see pred_store.py) and credits_index.txt of every
+    video, from their paths, sizes and mtimes (not contents, so a corpus is fingerprinted without reading it)
+    """
+    h = hashlib.sha1()
+    for vid_dirpath in sorted(vid_dirpaths):
+        store_path = get_store_path(vid_dirpath, pred_fn)
+        if os.path.exists(os.path.join(store_path, META_FN)):
+            paths = [os.path.join(store_path, fn) for fn in sorted(os.listdir(store_path))]
+        else:
+            paths = [get_csv_path(vid_dirpath, pred_fn)]
+        paths.append(os.path.join(vid_dirpath, 'credits_index.txt'))
+        for path in paths:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                h.update('{}\0{}\0{}\n'.format(path, stat.st_size, int(stat.st_mtime * 1e6)))
+    return h.hexdigest()
+
+def _link_or_copy(src_path, dst_path):
+    """Hard-link src_path to dst_path, or copy it if links are not possible (e.g. another filesystem)"""
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+########################################################################################################################
+# Cache
+########################################################################################################################
+class ArtifactCache(object):
+    def __init__(self, root, keep=KEEP):
+        """
+        root: e.g. outputs/cluster/data/cache
+        keep: int, number of newest artifacts kept per stage and parameters (see prune())
+        """
+        self.root = root
+        self.keep = keep
+
+    @staticmethod
+    def key(stage, params, inputs):
+        """Return sha1 of stage, params (dict) and inputs (dict, name -> fingerprint)"""
+        s = json.dumps({'stage': stage, 'params': params, 'inputs': inputs}, sort_keys=True)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def _get_dirpath(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def get(self, stage, key):
+        """Return lineage (dict, with 'dirpath') of artifact, or None if it is not cached"""
+        dirpath = self._get_dirpath(stage, key)
+        lineage_path = os.path.join(dirpath, LINEAGE_FN)
+        if not os.path.exists(lineage_path):
+            return None
+        with open(lineage_path, 'r') as f:
+            lineage = json.load(f)
+        lineage['dirpath'] = dirpath
+        return lineage
+
+    def put(self, stage, key, params, inputs, name2path, info=None):
+        """
+        Link files into the cache as the artifact stage / key, prune older artifacts with the same parameters, and
+        return its lineage
+
+        Parameters
+        ----------
+        params: dict of parameters of the stage
+        inputs: dict, name -> fingerprint of every input
+        name2path: dict, name -> path of file to cache (name is the file name in the cache)
+        info: dict of json-serializable values known once computed, e.g. number of series
+        """
+        dirpath = self._get_dirpath(stage, key)
+        tmp_dirpath = dirpath + '.tmp'
+        if os.path.exists(tmp_dirpath):
+            shutil.rmtree(tmp_dirpath)
+        os.makedirs(tmp_dirpath)
+        files = {}
+        for name, path in name2path.items():
+            _link_or_copy(path, os.path.join(tmp_dirpath, name))
+            files[name] = fingerprint_file(path)
+        lineage = {'key': key, 'stage': stage, 'params': params, 'inputs': inputs, 'files': files,
+                   'info': info or {}, 'created': time.time()}
+        with open(os.path.join(tmp_dirpath, LINEAGE_FN), 'w') as f:
+            json.dump(lineage, f, sort_keys=True, indent=2)
+
+        # Directory appears complete or not at all
+        if os.path.exists(dirpath):
+            shutil.rmtree(dirpath)
+        os.rename(tmp_dirpath, dirpath)
+        lineage['dirpath'] = dirpath
+        self.prune(stage, params)
+        return lineage
+
+    def restore(self, lineage, name2path):
+        """
+        Link files of cached artifact to paths, dict name -> path. Linked to a temporary file and renamed, so
+        processes that have the previous file memory-mapped keep reading it
+        """
+        for name, path in name2path.items():
+            _link_or_copy(self.get_path(lineage, name), path + '.tmp')
+            os.rename(path + '.tmp', path)
+
+    def get_path(self, lineage, name):
+        return os.path.join(lineage['dirpath'], name)
+
+    def get_all(self, stage):
+        """Return lineages of every cached artifact of stage"""
+        stage_path = os.path.join(self.root, stage)
+        if not os.path.exists(stage_path):
+            return []
+        lineages = []
+        for key in os.listdir(stage_path):
+            lineage = self.get(stage, key)
+            if lineage is not None:
+                lineages.append(lineage)
+        return lineages
+
+    def latest(self, stage, params, inputs=None):
+        """
+        Return lineage of newest artifact of stage whose parameters (and inputs, if given) include the given ones, or
+        None
+        """
+        def matches(saved, wanted):
+            return all((name in saved) and (saved[name] == val) for name, val in (wanted or {}).items())
+
+        candidates = [lineage for lineage in self.get_all(stage)
+                      if matches(lineage['params'], params) and matches(lineage['inputs'], inputs)]
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda lineage: lineage['created'])
+
+    def prune(self, stage, params):
+        """Remove all but the newest self.keep artifacts of stage with exactly these parameters"""
+        same = [lineage for lineage in self.get_all(stage) if lineage['params'] == params]
+        same.sort(key=lambda lineage: lineage['created'], reverse=True)
+        for lineage in same[self.keep:]:
+            shutil.rmtree(lineage['dirpath'])
+
+    def parents(self, lineage):
+        """Return lineages of cached artifacts whose files are inputs of lineage"""
+        fingerprints = set(lineage['inputs'].values())
+        parents = []
+        for stage in os.listdir(self.root):
+            for other in self.get_all(stage):
+                if fingerprints & set(other['files'].values()):
+                    parents.append(other)
+        return parents
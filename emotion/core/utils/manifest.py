@@ -0,0 +1,245 @@
+# Manifest of a video corpus, replacing os.walk / os.listdir scans of the video tree
+#
+# <root>/manifest.json holds:
+#   dirs        relpath -> {mtime, dirs, files}: listing of every directory under root (frames/ and preds/ are not
+#               descended into). A directory is only listed again when its mtime changes
+#   videos      relpath -> entry, for every directory with frames/, preds/, a movie or an mp3:
+#                   num_frames      number of files in frames/ (None if there is no frames/)
+#                   fps, duration   frames per second and seconds covered by frames/, from the timestamps in the frame
+#                                   names written by MovieReader (frame_<i>_<h>h<mm>m<ss>s.jpg), None if not parsable
+#                   credits_idx     index of the frame where credits start (see get_credits_idx), or None
+#                   movie_fn        movie file (not a sample), or None
+#                   audio_fn        mp3 file, or None
+#                   preds           prediction file names, as csv or binary store (see pred_store.py)
+#               frames/ is only listed again when its mtime changes (or credits_index.txt when its own does)
+#
+# refresh() updates the manifest from directory mtimes and saves it, and find() lists videos matching a query.
+# Manifest.for_path() uses the manifest of the nearest directory at or above a path, so e.g. data/videos/films is
+# served by data/videos/manifest.json if it exists.
+
+import json
+import os
+import re
+import tempfile
+
+from natsort import natsorted
+
+from pred_store import META_FN
+from utils import VID_EXTS
+
+MANIFEST_FN = 'manifest.json'
+FRAME_FN_RE = re.compile(r'frame_(\d+)_(\d+)h(\d+)m(\d+)s')
+SKIP_DIRS = ['frames', 'preds']         # video subdirectories that are not descended into
+
+def _to_str(obj):
+    """Return obj loaded from json with unicode strings encoded to utf-8 str, as returned by os.listdir()"""
+    if isinstance(obj, dict):
+        return {_to_str(k): _to_str(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_to_str(v) for v in obj]
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+def _get_duration_and_fps(frame_fns):
+    """Return (seconds, frames per second) of frames, from the timestamp of the last frame. (None, None) if unknown"""
+    last_idx, last_secs = -1, None
+    for fn in frame_fns:
+        m = FRAME_FN_RE.match(fn)
+        if m and int(m.group(1)) > last_idx:
+            last_idx = int(m.group(1))
+            last_secs = 3600 * int(m.group(2)) + 60 * int(m.group(3)) + int(m.group(4))
+    if not last_secs:
+        return None, None
+    return last_secs, last_idx / float(last_secs)
+
+def _get_credits_idx(frame_fns, credits_path):
+    """Return index of the credits frame in the sorted frames, as get_credits_idx() in utils.py, or None"""
+    with open(credits_path, 'r') as f:
+        fn = f.readline().strip('\n')
+    frames = natsorted(frame_fns)
+    return frames.index(fn) if fn in frames else None
+
+class Manifest(object):
+    def __init__(self, root):
+        """root: corpus directory, e.g. data/videos. Loads root/manifest.json if it exists"""
+        self.root = root
+        self.dirs = {}
+        self.videos = {}
+        path = os.path.join(root, MANIFEST_FN)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = _to_str(json.load(f))
+            self.dirs = saved['dirs']
+            self.videos = saved['videos']
+
+    @classmethod
+    def for_path(cls, path):
+        """Return manifest of the nearest directory at or above path that has one, else a new one rooted at path"""
+        cur = os.path.abspath(path)
+        while True:
+            if os.path.exists(os.path.join(cur, MANIFEST_FN)):
+                return cls(os.path.relpath(cur) if not os.path.isabs(path) else cur)
+            parent = os.path.dirname(cur)
+            if parent == cur:
+                return cls(path)
+            cur = parent
+
+    def save(self):
+        """
+        Write manifest. Written to a temporary file unique to this writer and renamed, so concurrent readers see a
+        complete file and concurrent writers (e.g. gunicorn workers, predict and analysis jobs) never interleave
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=MANIFEST_FN + '.', suffix='.tmp', dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'dirs': self.dirs, 'videos': self.videos}, f)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, os.path.join(self.root, MANIFEST_FN))
+
+    ####################################################################################################################
+    # Paths
+    ####################################################################################################################
+    def _get_relpath(self, path):
+        return '.' if path is None else os.path.normpath(os.path.relpath(path, self.root))
+
+    def _get_path(self, relpath):
+        return self.root if relpath == '.' else os.path.join(self.root, relpath)
+
+    def _is_under(self, relpath, start):
+        return (start == '.') or (relpath == start) or relpath.startswith(start + os.sep)
+
+    ####################################################################################################################
+    # Refresh
+    ####################################################################################################################
+    def refresh(self, path=None, logger=None):
+        """
+        Update entries of every directory under path (root if None) whose mtime changed, remove entries of
+        directories that no longer exist, and save if anything changed (so read-only entry points do not write).
+        Returns self
+        """
+        log = logger.info if logger else (lambda msg: None)
+        start = self._get_relpath(path)
+        seen = set()
+        num_listed, num_videos_updated = 0, 0
+        stack = [start]
+        while stack:
+            relpath = stack.pop()
+            dirpath = self._get_path(relpath)
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except OSError:
+                continue
+            seen.add(relpath)
+
+            listing = self.dirs.get(relpath)
+            if (listing is None) or (listing['mtime'] != mtime):
+                # The manifest's own files are left out, so saving it (which changes the root's mtime) does not
+                # count as a change of the root
+                names = [name for name in os.listdir(dirpath) if not name.startswith(MANIFEST_FN)]
+                subdirs = sorted([name for name in names if os.path.isdir(os.path.join(dirpath, name))])
+                files = sorted(set(names) - set(subdirs))
+                if (listing is None) or (listing['dirs'] != subdirs) or (listing['files'] != files):
+                    num_listed += 1
+                listing = {'mtime': mtime, 'dirs': subdirs, 'files': files}
+                self.dirs[relpath] = listing
+
+            entry = self._refresh_video(relpath, listing)
+            if entry is not None:
+                if entry != self.videos.get(relpath):
+                    num_videos_updated += 1
+                self.videos[relpath] = entry
+            elif self.videos.pop(relpath, None) is not None:
+                num_videos_updated += 1
+
+            for name in listing['dirs']:
+                if name not in SKIP_DIRS:
+                    stack.append(name if relpath == '.' else os.path.join(relpath, name))
+
+        # Directories under path that were removed
+        num_removed = 0
+        for entries in [self.dirs, self.videos]:
+            for relpath in [r for r in entries if self._is_under(r, start) and (r not in seen)]:
+                del entries[relpath]
+                num_removed += 1
+
+        log('Manifest of {}: {} changed directories, updated {} videos, {} videos in total'.format(
+            self.root, num_listed, num_videos_updated, len(self.videos)))
+        if num_listed or num_videos_updated or num_removed:
+            self.save()
+        return self
+
+    def _refresh_video(self, relpath, listing):
+        """Return entry of video directory, reusing the previous entry's frame information if frames/ is unchanged"""
+        movie_fns = [fn for fn in listing['files']
+                     if ('sample' not in fn.lower()) and any([fn.endswith(ext) for ext in VID_EXTS])]
+        audio_fns = [fn for fn in listing['files'] if fn.endswith('mp3')]
+        if not (movie_fns or audio_fns or [d for d in SKIP_DIRS if d in listing['dirs']]):
+            return None
+
+        dirpath = self._get_path(relpath)
+        prev = self.videos.get(relpath, {})
+        entry = {'movie_fn': movie_fns[0] if movie_fns else None,
+                 'audio_fn': audio_fns[0] if audio_fns else None}
+
+        # Frames and credits
+        frames_path = os.path.join(dirpath, 'frames')
+        credits_path = os.path.join(dirpath, 'credits_index.txt')
+        frames_mtime = os.stat(frames_path).st_mtime if 'frames' in listing['dirs'] else None
+        credits_mtime = os.stat(credits_path).st_mtime if 'credits_index.txt' in listing['files'] else None
+        entry['frames_mtime'] = frames_mtime
+        entry['credits_mtime'] = credits_mtime
+        if (frames_mtime == prev.get('frames_mtime')) and (credits_mtime == prev.get('credits_mtime')) and \
+                ('num_frames' in prev):
+            for field in ['num_frames', 'fps', 'duration', 'credits_idx']:
+                entry[field] = prev[field]
+        elif frames_mtime is None:
+            entry.update({'num_frames': None, 'fps': None, 'duration': None, 'credits_idx': None})
+        else:
+            frame_fns = os.listdir(frames_path)
+            entry['num_frames'] = len(frame_fns)
+            entry['duration'], entry['fps'] = _get_duration_and_fps(frame_fns)
+            entry['credits_idx'] = _get_credits_idx(frame_fns, credits_path) if credits_mtime is not None else None
+
+        # Predictions. preds/ is small, and a store's meta.json does not change the mtime of preds/, so it is listed
+        preds = []
+        if 'preds' in listing['dirs']:
+            preds_path = os.path.join(dirpath, 'preds')
+            for name in os.listdir(preds_path):
+                if name.endswith('.csv'):
+                    preds.append(name)
+                elif os.path.exists(os.path.join(preds_path, name, META_FN)):
+                    preds.append(name + '.csv')
+        entry['preds'] = sorted(set(preds))
+        return entry
+
+    ####################################################################################################################
+    # Query
+    ####################################################################################################################
+    def get(self, vid_dirpath):
+        """Return entry of video directory, or None"""
+        return self.videos.get(self._get_relpath(vid_dirpath))
+
+    def find(self, path=None, min_frames=None, pred_fns=None, has_movie=False, has_audio=False):
+        """
+        Return sorted list of paths of video directories under path (root if None) that match
+
+        Parameters
+        ----------
+        min_frames: int, minimum number of frames. 0 to only require frames/
+        pred_fns: list of prediction file names that must all be available, e.g. [sent_biclass_19.csv]
+        has_movie: bool, require a movie file
+        has_audio: bool, require an mp3
+        """
+        start = self._get_relpath(path)
+        vid_dirpaths = []
+        for relpath, entry in self.videos.items():
+            if not self._is_under(relpath, start):
+                continue
+            if (min_frames is not None) and ((entry['num_frames'] is None) or (entry['num_frames'] < min_frames)):
+                continue
+            if pred_fns and not all([pred_fn in entry['preds'] for pred_fn in pred_fns]):
+                continue
+            if (has_movie and entry['movie_fn'] is None) or (has_audio and entry['audio_fn'] is None):
+                continue
+            vid_dirpaths.append(self._get_path(relpath))
+        return sorted(vid_dirpaths)
@@ -0,0 +1,158 @@
+# Binary store of per-video predictions, replacing the per-video preds CSV files
+#
+# For a video directory and a prediction file name (the name the CSV had, e.g. sent_biclass_19.csv), predictions
+# are kept in preds/<name without .csv>/:
+#   meta.json           labels (column names, in CSV order), num_rows, dtype, and model metadata (obj, epoch, ...)
+#   <label>.npy         float32 array of length num_rows, one per label, memory-mapped when loaded
+# Predict paths write all of a video's predictions at once with save_preds() (and optionally the old CSV).
+# Readers use load_preds(), which falls back to the CSV for videos that have not been converted
+# (see convert_csvs()). The corpus manifest (see manifest.py) lists the prediction files available for every video.
+
+import json
+import os
+
+import numpy as np
+
+DTYPE = np.float32
+META_FN = 'meta.json'
+
+########################################################################################################################
+# Paths
+########################################################################################################################
+def get_store_name(pred_fn):
+    """Return store name for a prediction file name, e.g. sent_biclass_19.csv -> sent_biclass_19"""
+    return pred_fn[:-4] if pred_fn.endswith('.csv') else pred_fn
+
+def get_store_path(vid_dirpath, pred_fn):
+    return os.path.join(vid_dirpath, 'preds', get_store_name(pred_fn))
+
+def get_csv_path(vid_dirpath, pred_fn):
+    return os.path.join(vid_dirpath, 'preds', get_store_name(pred_fn) + '.csv')
+
+def has_store(vid_dirpath, pred_fn):
+    return os.path.exists(os.path.join(get_store_path(vid_dirpath, pred_fn), META_FN))
+
+def has_preds(vid_dirpath, pred_fn):
+    """Return True if video has predictions, in the binary store or as CSV"""
+    return has_store(vid_dirpath, pred_fn) or os.path.exists(get_csv_path(vid_dirpath, pred_fn))
+
+########################################################################################################################
+# Predictions of one video
+########################################################################################################################
+class Preds(object):
+    def __init__(self, labels, label2vals, meta=None):
+        """
+        labels: list of label names (column order)
+        label2vals: dict, key is label, value is 1-d array (memmap if loaded from the store)
+        meta: dict of metadata (obj, epoch, ...)
+        """
+        self.labels = labels
+        self.label2vals = label2vals
+        self.meta = meta or {}
+
+    def __getitem__(self, label):
+        return self.label2vals[label]
+
+    def __contains__(self, label):
+        return label in self.label2vals
+
+    def __len__(self):
+        return len(self.label2vals[self.labels[0]]) if self.labels else 0
+
+    def head(self, n):
+        """Return Preds with the first n rows (e.g. to drop predictions for credits)"""
+        return Preds(self.labels, {label: vals[:n] for label, vals in self.label2vals.items()}, self.meta)
+
+    def to_array(self):
+        """Return (num_rows, num_labels) array, columns in label order"""
+        return np.column_stack([self.label2vals[label] for label in self.labels])
+
+def save_preds(vid_dirpath, pred_fn, labels, values, meta=None, export_csv=False):
+    """
+    Save predictions of one video
+
+    Parameters
+    ----------
+    vid_dirpath: path to video directory (predictions go in its preds/)
+    pred_fn: prediction file name, e.g. sent_biclass_19.csv
+    labels: list of label names
+    values: array-like of dimension (num_rows, len(labels))
+    meta: dict of json-serializable metadata, e.g. {'obj': ..., 'epoch': ...}
+    export_csv: bool, also write the CSV (header of labels, one row per line)
+    """
+    values = np.asarray(values, dtype=DTYPE).reshape(-1, len(labels))
+    path = get_store_path(vid_dirpath, pred_fn)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    # Every file is written to a temporary file and renamed, so when a video is predicted again, readers that have the
+    # previous arrays memory-mapped keep reading them instead of a truncated file. meta.json is renamed in last, so a
+    # new store is only seen (has_store) once all arrays are there
+    for i, label in enumerate(labels):
+        tmp_path = os.path.join(path, '{}.tmp.npy'.format(label))
+        np.save(tmp_path, np.ascontiguousarray(values[:, i]))
+        os.rename(tmp_path, os.path.join(path, '{}.npy'.format(label)))
+    meta_path = os.path.join(path, META_FN)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({'labels': list(labels), 'num_rows': len(values), 'dtype': np.dtype(DTYPE).name,
+                   'meta': meta or {}}, f)
+    os.rename(meta_path + '.tmp', meta_path)
+
+    if export_csv:
+        np.savetxt(get_csv_path(vid_dirpath, pred_fn), values, delimiter=',', header=','.join(labels),
+                   comments='', fmt='%.8g')
+
+def load_preds(vid_dirpath, pred_fn, mmap_mode='r'):
+    """
+    Return Preds of one video, from the binary store (arrays memory-mapped by default) or, if the video has not
+    been converted, from the CSV
+    """
+    path = get_store_path(vid_dirpath, pred_fn)
+    if has_store(vid_dirpath, pred_fn):
+        with open(os.path.join(path, META_FN), 'r') as f:
+            saved = json.load(f)
+        labels = [str(label) for label in saved['labels']]
+        label2vals = {}
+        for label in labels:
+            if saved['num_rows'] == 0:
+                label2vals[label] = np.zeros(0, dtype=DTYPE)
+            else:
+                label2vals[label] = np.load(os.path.join(path, '{}.npy'.format(label)), mmap_mode=mmap_mode)
+        return Preds(labels, label2vals, saved['meta'])
+    return _load_csv(get_csv_path(vid_dirpath, pred_fn))
+
+def _load_csv(csv_path):
+    """Return Preds from CSV with a header of labels"""
+    with open(csv_path, 'r') as f:
+        labels = f.readline().strip().split(',')
+        values = np.loadtxt(f, delimiter=',', dtype=DTYPE, ndmin=2).reshape(-1, len(labels))
+    return Preds(labels, {label: values[:, i] for i, label in enumerate(labels)})
+
+########################################################################################################################
+# Corpus
+########################################################################################################################
+def convert_csvs(root, pred_fns, remove_csv=False, logger=None):
+    """
+    Convert CSV predictions of every video under root to the binary store. Return number of files converted
+
+    Parameters
+    ----------
+    root: e.g. data/videos/films
+    pred_fns: list of prediction file names, e.g. [sent_biclass_19.csv, audio-valence_class_70_conf32.csv]
+    remove_csv: bool, remove each CSV once converted
+    """
+    log = logger.info if logger else (lambda msg: None)
+    num_converted = 0
+    for dirpath, dirs, files in os.walk(root):
+        if 'preds' not in dirs:
+            continue
+        for pred_fn in pred_fns:
+            csv_path = get_csv_path(dirpath, pred_fn)
+            if (not os.path.exists(csv_path)) or has_store(dirpath, pred_fn):
+                continue
+            preds = _load_csv(csv_path)
+            save_preds(dirpath, pred_fn, preds.labels, preds.to_array(), meta={'converted_from': 'csv'})
+            if remove_csv:
+                os.remove(csv_path)
+            num_converted += 1
+    log('Converted {} prediction files'.format(num_converted))
+    return num_converted
@@ -4,22 +4,37 @@
 # TODO: what to do about shorts, should we filter by length, idk
 
 import argparse
-from concurrent.futures import ProcessPoolExecutor, wait
-from functools import partial
-import hdbscan
+from collections import Counter
+import json
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pylab as plt
+import multiprocessing
 import os
 import pandas as pd
 import cPickle as pickle
-import scipy.interpolate as interp
+from scipy.stats import rankdata
 import sqlite3
+import time
 
 # from core.predictions.spatio_time_cluster import *
 from core.predictions.ts_cluster import *
+from core.predictions.cascade import assign_nearest, get_lb_radius
+from core.predictions.dist_store import DistStore, build_lb_keogh_stores
+from core.predictions.hdbscan_sweep import extract_clusters, hdbscan_sweep, single_linkage_tree
 from core.predictions.hierarchical_cluster import *
+from core.predictions.kclust_result import KClustResult
+from core.predictions.kmedoids import kmedoids_sweep
+from core.predictions.knn_graph import build_knn_graph, hdbscan_linkage, load_knn_graph, save_knn_graph
+from core.predictions.kshape import KShape, SBDIndex
+from core.predictions.lb_keogh import envelope, lb_keogh_envelope
+from core.predictions.metrics import cluster_metrics
+from core.predictions.minibatch_kmeans import MiniBatchKMeans
+from core.predictions.stability import bootstrap_stability
 from core.predictions.utils import DTWDistance, fastdtw_dist, LB_Keogh, smooth
+from core.utils.artifact_cache import ArtifactCache, fingerprint_file, fingerprint_preds
+from core.utils.manifest import Manifest
+from core.utils.pred_store import load_preds
 from core.utils.utils import setup_logging, get_credits_idx, VIZ_SENT_PRED_FN
 
 # For local vs shannon`
@@ -31,19 +46,33 @@ VIDEOS_PATH = 'data/videos'
 TS_STR = 'dir{}-n{}-w{}-ds{}-maxnf{}-fn{}'
 KCLUST_STR = 'dir{}-n{}-w{}-ds{}-maxnf{}-fn{}-k{}-it{}-r{}'
 DIST_MATRIX_STR = GROUP_COHERENCE_STR = 'dir{}-n{}-w{}-ds{}-maxnf{}-fn{}-r{}'
+DIST_STORE_STR = 'dir{}-w{}-ds{}-maxnf{}-fn{}-r{}'     # no n, store is keyed by title
 HDBSCAN_STR = 'dir{}-n{}-w{}-ds{}-maxnf{}-fn{}-r{}-mcs{}-ms{}'
+KNN_GRAPH_STR = 'dir{}-n{}-w{}-ds{}-maxnf{}-fn{}-r{}-knn{}'
+HIERARCHICAL_STR = 'dir{}-n{}-w{}-ds{}-maxnf{}-fn{}-r{}-link{}-knn{}'
 
 VIDEOPATH_DB = 'data/db/VideoPath.db'
 VIDEOMETADATA_DB = 'data/db/VideoMetadata.pkl'
 
+# prepare_ts workers. The Analysis instance is set before the pool is created, so workers inherit it on fork
+_worker = {}
+
+def _get_video_ts_timed(args):
+    """Return (series or None, seconds taken) of one video, see Analysis._get_video_ts"""
+    start_time = time.time()
+    downsampled = _worker['analysis']._get_video_ts(*args)
+    return downsampled, time.time() - start_time
+
 class Analysis(object):
     def __init__(self):
         self.logger = self._get_logger()
+        self.cache = ArtifactCache(os.path.join(OUTPUTS_PATH, 'data', 'cache'))
+        self.manifest = None        # set when listing videos, see get_all_vidpaths_with_frames_and_preds()
 
     ####################################################################################################################
     # Preprocess data
     ####################################################################################################################
-    def prepare_ts(self, vids_dirpath, w, ds, max_nframes, pred_fn):
+    def prepare_ts(self, vids_dirpath, w, ds, max_nframes, pred_fn, nw=None, dtype='float64'):
         """
         Create and save np array of [num_timeseries, max_len]
 
@@ -55,6 +84,8 @@ class Analysis(object):
         ds: int, ratio at which to downsample time series
             - used to speed up clustering
             - e.g. 3 = sample every third point
+        nw: int, number of worker processes that read and smooth videos. If None, number of cpus
+        dtype: str, float64 or float32, type the series, means and stds are saved as (.npy, memory-mapped when loaded)
         """
 
         # Get all series from videos with predictions
@@ -62,75 +93,52 @@ class Analysis(object):
         ts = []
         ts_idx2title = {}
 
-        vids_dirpaths = self.get_all_vidpaths_with_frames_and_preds(vids_dirpath)
+        vids_dirpaths = list(self.get_all_vidpaths_with_frames_and_preds(vids_dirpath))
         i = 0
 
-        # For every video, get smoothed and downsampled time series
+        # Skip if already computed with these parameters from the same predictions (see core/utils/artifact_cache.py)
+        ts_params = self._get_ts_cache_params(vids_dirpath, w, ds, max_nframes, pred_fn)
+        ts_params['dtype'] = dtype
+        ts_inputs = {'preds': fingerprint_preds(vids_dirpaths, pred_fn)}
+        ts_key = self.cache.key('ts', ts_params, ts_inputs)
+        lineage = self.cache.get('ts', ts_key)
+        if lineage is not None:
+            n = lineage['info']['n']
+            self.logger.info('Time series cached: {}, restoring (n={})'.format(lineage['dirpath'], n))
+            self.cache.restore(lineage, self._get_ts_cache_files(vids_dirpath, n, w, ds, max_nframes, pred_fn))
+            return self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+
+        # For every video, get smoothed and downsampled time series. Videos are read and smoothed in parallel, and
+        # results come back in the order of vids_dirpaths
         self.logger.info('Getting predictions, removing credits preds, smoothing and downsampling')
-        for vdp in vids_dirpaths:
-            # self.logger.info(u'Video: {}'.format(unicode(vdp, 'utf-8')))
-
-            # Get predictions
-            preds_path = os.path.join(vdp, 'preds', pred_fn)
-            vals = pd.read_csv(preds_path).pos.values
-
-            # Skip if predictions are empty (some cases of this in shorts... I think because frames/ is empty)
-            if len(vals) == 0:
-                self.logger.info(u'{} predictions is 0, skipping'.format(unicode(vdp, 'utf-8')))
-                continue
-
-            # Remove predictions for credits frame
-            credits_idx = get_credits_idx(vdp)
-            if credits_idx:
-                vals = vals[:credits_idx]
-
-            # Skip if window size too big
-            # If w is not None and is > 1 , then use uniform w for all videos
-            if (w is not None) and (w >= 1.0) and (len(vals) <= w):
-            # if (w is not None) and (len(vals) <= w):
-                self.logger.info(u'{} length is {}, less than: {}, skipping'.format(
-                    unicode(vdp, 'utf-8'), len(vals), w))  # unicode for titles
-                continue
-
-            # Skip if video too long (e.g. only 7 shorts are longer than 30 min: 30.03, 36.00, 41.12, 48.00, 49.60, 53.50))
-            if len(vals) > max_nframes:
-                self.logger.info(u'{} length is {}, greater than max_nframes ({})'.format(
-                    unicode(vdp, 'utf-8'), len(vals),  max_nframes))  # unicode for titles
-                continue
-
-            # Smooth and downsample
-            # If w is None, then use 0.07 * video length. Got this val bc using w ~= 500 for films, avg. film is ~ 7200
-            if w is None:
-                cur_w = int(0.07 * len(vals))
-            elif w < 1:
-                cur_w = int(w * len(vals))
-            elif w >= 1:
-                cur_w = w
-            # cur_w = w if w else int(0.07 * len(vals))
-            smoothed = smooth(vals, window_len=cur_w)
-            downsampled = smoothed[::ds]
-
-            ts.append(downsampled)
-            ts_idx2title[i] = os.path.basename(vdp)
-            i += 1
-
-            # For debugging - to have quick results
-            # if i == 5:
-            #     break
+        start_time = time.time()
+        _worker['analysis'] = self
+        pool = multiprocessing.Pool(processes=nw or multiprocessing.cpu_count())
+        try:
+            tasks = [(vdp, w, ds, max_nframes, pred_fn) for vdp in vids_dirpaths]
+            for j, (vdp, (downsampled, secs)) in enumerate(zip(vids_dirpaths,
+                                                               pool.imap(_get_video_ts_timed, tasks, chunksize=4))):
+                self.logger.info(u'Video {}/{}: {} in {:.2f}s'.format(
+                    j + 1, len(vids_dirpaths), unicode(os.path.basename(vdp), 'utf-8'), secs))
+                if downsampled is None:
+                    continue
+
+                ts.append(downsampled)
+                ts_idx2title[i] = os.path.basename(vdp)
+                i += 1
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker.clear()
+        self.logger.info('{} videos in {:.1f}s'.format(len(vids_dirpaths), time.time() - start_time))
 
         # Make all timeseries the same length by going from 0% of video to 100% of video and interpolating in between
         self.logger.info('Interpolating series to maximum series length')
         max_len = max([len(s) for s in ts])
-        for i, s in enumerate(ts):
-            if len(s) == max_len:
-                continue
-            else:
-                s_interp = interp.interp1d(np.arange(s.size), s)
-                s_stretch = s_interp(np.linspace(0, s.size-1, max_len))
-                ts[i] = s_stretch
-
-        # Convert into numpy
-        ts = np.array(ts)  # (num_timeseries, max_len)
+        ts = self._stretch_ts(ts, max_len)      # (num_timeseries, max_len)
 
         # Normalize each series by taking mean and std of that one series
         self.logger.info('Z-normalizing each time series')
@@ -141,51 +149,159 @@ class Analysis(object):
         # Save time series data
         # Save mean and std so we can map back to 0-1 later
         self.logger.info('Saving time series data')
-        self._save_ts(ts, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn)
+        self._save_ts(ts, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn, dtype=dtype)
         self._save_ts_idx2title(ts_idx2title, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn)
-        self._save_ts_mean(mean, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn)
-        self._save_ts_std(std, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn)
+        self._save_ts_mean(mean, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn, dtype=dtype)
+        self._save_ts_std(std, vids_dirpath, len(ts), w, ds, max_nframes, pred_fn, dtype=dtype)
+        self.cache.put('ts', ts_key, ts_params, ts_inputs,
+                       self._get_ts_cache_files(vids_dirpath, len(ts), w, ds, max_nframes, pred_fn),
+                       info={'n': len(ts)})
 
         self.logger.info('Number of time series: {}'.format(len(ts)))
         self.logger.info('Time series length (max): {}'.format(ts.shape[1]))
 
         return ts
 
+    def _get_video_ts(self, vdp, w, ds, max_nframes, pred_fn):
+        """
+        Return smoothed and downsampled predictions of one video (credits removed), or None if the video is skipped
+
+        Parameters
+        ----------
+        vdp: path to video directory with frames/ and preds/
+        w, ds, max_nframes, pred_fn: see prepare_ts()
+        """
+        # Get predictions
+        vals = np.asarray(load_preds(vdp, pred_fn)['pos'], dtype=np.float64)
+
+        # Skip if predictions are empty (some cases of this in shorts... I think because frames/ is empty)
+        if len(vals) == 0:
+            self.logger.info(u'{} predictions is 0, skipping'.format(unicode(vdp, 'utf-8')))
+            return None
+
+        # Remove predictions for credits frame. The manifest has the credits index without listing frames/
+        entry = self.manifest.get(vdp) if self.manifest else None
+        credits_idx = entry['credits_idx'] if entry else get_credits_idx(vdp)
+        if credits_idx:
+            vals = vals[:credits_idx]
+
+        # Skip if window size too big
+        # If w is not None and is > 1 , then use uniform w for all videos
+        if (w is not None) and (w >= 1.0) and (len(vals) <= w):
+        # if (w is not None) and (len(vals) <= w):
+            self.logger.info(u'{} length is {}, less than: {}, skipping'.format(
+                unicode(vdp, 'utf-8'), len(vals), w))  # unicode for titles
+            return None
+
+        # Skip if video too long (e.g. only 7 shorts are longer than 30 min: 30.03, 36.00, 41.12, 48.00, 49.60, 53.50))
+        if len(vals) > max_nframes:
+            self.logger.info(u'{} length is {}, greater than max_nframes ({})'.format(
+                unicode(vdp, 'utf-8'), len(vals),  max_nframes))  # unicode for titles
+            return None
+
+        # Smooth and downsample
+        # If w is None, then use 0.07 * video length. Got this val bc using w ~= 500 for films, avg. film is ~ 7200
+        if w is None:
+            cur_w = int(0.07 * len(vals))
+        elif w < 1:
+            cur_w = int(w * len(vals))
+        elif w >= 1:
+            cur_w = w
+        # cur_w = w if w else int(0.07 * len(vals))
+        smoothed = smooth(vals, window_len=cur_w)
+        downsampled = smoothed[::ds]
+        return downsampled
+
+    def _stretch_ts(self, series, max_len):
+        """
+        Return (len(series), max_len) array of every series linearly interpolated to max_len points, going from 0% to
+        100% of the video. All series are interpolated at once on their concatenation
+
+        series: list of 1-d arrays, of any lengths
+        """
+        lens = np.array([len(s) for s in series])
+        starts = np.concatenate([[0], np.cumsum(lens)[:-1]])
+        flat = np.concatenate(series).astype(np.float64)
+
+        # Position of every output point within its series, as (index of left point, fraction towards the right one)
+        pos = np.linspace(0, 1, max_len)[np.newaxis, :] * (lens[:, np.newaxis] - 1)     # (num_timeseries, max_len)
+        left = np.minimum(np.floor(pos).astype(np.int64), np.maximum(lens[:, np.newaxis] - 2, 0))
+        frac = pos - left
+        left += starts[:, np.newaxis]
+        right = np.minimum(left + 1, len(flat) - 1)
+        return flat[left] * (1 - frac) + flat[right] * frac
+
     ####################################################################################################################
     # Cluster
     ####################################################################################################################
-    def cluster_ts(self, data, method, r, k=None, it=None, mcs=None, ms=None):
+    def cluster_ts(self, data, method, r, k=None, it=None, mcs=None, ms=None, nw=None, sweep=False, bs=None,
+                   knn=None, linkage='single'):
         """
         Cluster data and save outputs
 
         Parameters
         ----------
-        data: np of dimension [num_timeseries, max_len]
-        method: str, clustering method to use
+        data: np of dimension [num_timeseries, max_len], memmap (see _load_ts)
+        method: str, clustering method to use (kmeans, minibatchkmeans, kmedoids, kshape, hierarchical, hdbscan)
         k: comma-separated number of clusters (for parametric clustering techniques)
-        mcs: int, minimum_cluster_size
-        ms: int, min_samples
+        mcs: int, minimum_cluster_size (comma-separated with sweep)
+        ms: int, min_samples (comma-separated with sweep)
+        nw: int, number of worker processes used to build the distance matrix, sweep k, or assign series in k-means.
+            If None, number of cpus
+        sweep: bool, kmedoids: cluster all k in parallel and save one results file instead of outputs per k.
+            hdbscan: cluster for every combination of mcs and ms and save one table
+        bs: int, minibatchkmeans batch size
+        knn: int, hdbscan and hierarchical: cluster on a sparse graph of each series' knn nearest neighbors (under
+            DTW) instead of all pairs
+        linkage: str, hierarchical: single, complete, average, weighted (single or average with knn)
         """
 
         if method == 'kmeans':
             for k in k.split(','):
                 print '=' * 100
-                self.cluster_ts_kmeans(data, int(k), it, r)
+                if self._restore_cached_kclust('kmeans', int(k), it, r):
+                    continue
+                self.cluster_ts_kmeans(data, int(k), it, r, nw)
+        elif method == 'minibatchkmeans':
+            for k in k.split(','):
+                print '=' * 100
+                if self._restore_cached_kclust('minibatchkmeans', int(k), it, r):
+                    continue
+                self.cluster_ts_minibatch_kmeans(data.filename, int(k), it, r, nw, bs)
         elif method == 'kmedoids':
-            dist_matrix = self._try_load_dtw_dist_matrix(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r)
+            dist_matrix = self._get_dtw_dist_matrix(data, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, nw)
+            if sweep:
+                self.cluster_ts_kmedoids_sweep(dist_matrix, r, k, it, nw)
+                self.logger.info('Done clustering')
+                return
             for k in k.split(','):
                 print '=' * 100
+                if self._restore_cached_kclust('kmedoids', int(k), it, r):
+                    continue
                 self.cluster_ts_kmedoids(data, dist_matrix, r, int(k), it)
+        elif method == 'kshape':
+            index = SBDIndex(data)      # FFTs of all series, shared by every k
+            for k in k.split(','):
+                print '=' * 100
+                if self._restore_cached_kclust('kshape', int(k), it, None):
+                    continue
+                self.cluster_ts_kshape(index, int(k), it)
         elif method == 'hierarchical':
-            self.cluster_ts_hierarchical(data)
+            self.cluster_ts_hierarchical(data, r, linkage, k, knn, nw)
         elif method == 'hdbscan':
-            self.cluster_ts_hdbscan(data, r, mcs, ms)
+            if knn:
+                self.cluster_ts_hdbscan_knn(data, r, int(mcs), int(ms) if ms is not None else None, knn, nw)
+            elif sweep:
+                self.cluster_ts_hdbscan_sweep(data, r, mcs, ms, nw)
+            else:
+                self.cluster_ts_hdbscan(data, r, int(mcs) if mcs is not None else None,
+                                        int(ms) if ms is not None else None, nw)
         else:
             self.logger.info('Method unknown: {}'.format(method))
 
         self.logger.info('Done clustering')
 
-    def cluster_ts_kmeans(self, data, k, it, r):
+    def cluster_ts_kmeans(self, data, k, it, r, nw=None):
         """
         Parameters
         ----------
@@ -193,11 +309,12 @@ class Analysis(object):
         k: number of clusters (for parametric clustering techniques)
         it: number of iterations
         r: window size for KB_Keogh
+        nw: int, number of worker processes for the assignment step. If None, number of cpus
         """
         # Cluster
         self.logger.info('K-means clustering: k={}, it={}, r={}'.format(k, it, r))
         clusterer = ts_cluster(num_clust=k)
-        clusterer.k_means_clust(data, it, 2, r)     # num_iter, w, r
+        clusterer.k_means_clust(data, it, 2, r, num_workers=nw)     # num_iter, w, r
 
         # Un-normalize so that saved outputs -- centroids are of sentiment in range 0,1
         # Mean and std is per time series, i.e. one per video
@@ -213,6 +330,36 @@ class Analysis(object):
         self.logger.info('Saving centroids, assignments, figure')
         self._save_kclust(clusterer, 'kmeans', self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, k, it, r)
 
+    def cluster_ts_minibatch_kmeans(self, ts_path, k, it, r, nw=None, bs=None):
+        """
+        Parameters
+        ----------
+        ts_path: path to .npy of time series, read in batches through a memmap
+        k: number of clusters
+        it: maximum number of batches
+        r: window size for LB_Keogh
+        nw: int, number of worker processes. If None, number of cpus
+        bs: int, batch size. If None, 100
+        """
+        # Cluster
+        self.logger.info('Mini-batch k-means clustering: k={}, it={}, r={}, bs={}'.format(k, it, r, bs))
+        clusterer = MiniBatchKMeans(num_clust=k, batch_size=bs or 100, max_batches=it)
+        clusterer.fit(ts_path, 2, r, num_workers=nw)         # w, r
+        last = clusterer.history[-1]
+        self.logger.info('Stopped after {} batches: dist {:.4f}, ewa dist {:.4f}, centroid shift {:.6f}'.format(
+            last['batch'], last['dist'], last['ewa_dist'], last['shift']))
+
+        # Un-normalize so that saved outputs -- centroids are of sentiment in range 0,1
+        mean = self._load_ts_mean(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn)
+        std = self._load_ts_std(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn)
+        mean = mean.mean()
+        std = std.mean()
+        clusterer.centroids = (clusterer.centroids * std) + mean
+
+        # Save outputs
+        self.logger.info('Saving centroids, assignments, figure')
+        self._save_kclust(clusterer, 'minibatchkmeans', self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, k, it, r)
+
     def cluster_ts_kmedoids(self, data, dist_matrix, r, k, it):
         # Cluster
         self.logger.info('K-means clustering: k={}, it={}'.format(k, it))
@@ -238,18 +385,118 @@ class Analysis(object):
         self.logger.info('Saving centroids, assignments, figure')
         self._save_kclust(clusterer, 'kmedoids', self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, k, it, r)
 
-    def cluster_ts_hierarchical(self, data):
+    def cluster_ts_kmedoids_sweep(self, dist_matrix, r, k, it, nw=None):
         """
+        Cluster with k-medoids for every k, in parallel, and save cost, cluster sizes, silhouette and medoids per k
+
         Parameters
         ----------
-        data: np of dimension [num_timeseries, max_len]
+        dist_matrix: CondensedDistMatrix, shared read-only by all workers
+        r: window size for LB_Keogh (for file name)
+        k: comma-separated number of clusters
+        it: maximum number of swap passes per k
+        nw: int, number of worker processes. If None, number of cpus
+        """
+        ks = [int(cur_k) for cur_k in k.split(',')]
+        self.logger.info('K-medoids sweep: k={}, it={}'.format(ks, it))
+        results = kmedoids_sweep(dist_matrix, ks, max_iter=it, num_workers=nw)
+        for result in results:
+            self.logger.info('k: {}, cost: {:.4f}, silhouette: {:.4f}, sizes: {}'.format(
+                result['k'], result['cost'], result['silhouette'], result['sizes']))
+
+        self.logger.info('Saving sweep results, figure')
+        self._save_kmedoids_sweep(results, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, k, it, r)
+
+    def cluster_ts_kshape(self, index, k, it):
+        """
+        Parameters
+        ----------
+        index: SBDIndex of the time series
+        k: number of clusters
+        it: maximum number of iterations
+        """
+        # Cluster
+        self.logger.info('K-shape clustering: k={}, it={}'.format(k, it))
+        clusterer = KShape(num_clust=k)
+        clusterer.fit(index, it)
 
+        # Un-normalize so that saved outputs -- centroids are of sentiment in range 0,1
+        mean = self._load_ts_mean(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn)
+        std = self._load_ts_std(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn)
+        mean = mean.mean()
+        std = std.mean()
+        clusterer.centroids = [list((c * std) + mean) for c in clusterer.centroids]
 
+        # Save outputs
+        self.logger.info('Saving centroids, assignments, figure')
+        self._save_kclust(clusterer, 'kshape', self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, k, it, None)
+
+    def cluster_ts_hierarchical(self, data, r, linkage, k=None, knn=None, nw=None):
+        """
+        Hierarchical clustering on the DTW-based distance matrix (or, if knn, on a sparse k-nearest-neighbor DTW
+        graph). Saves the linkage, and labels of the tree cut at every k. Nothing is plotted, see
+        render_hierarchical()
+
+        Parameters
+        ----------
+        data: np array of dimension (num_timeseries, max_len)
+        r: int, window size for LB_Keogh (and DTW for the kNN graph)
+        linkage: str, single, complete, average, weighted (single or average with knn)
+        k: comma-separated number of clusters to cut the tree at
+        knn: int, number of neighbors per series for the kNN graph
+        nw: int, number of worker processes used to build the distance matrix / graph. If None, number of cpus
         """
         clusterer = HierarchicalCluster()
-        clusterer.cluster(data)
+        if knn:
+            graph = self._get_knn_graph(data, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, knn, nw)
+            self.logger.info('{} linkage on kNN graph'.format(linkage))
+            z = clusterer.cluster_graph(graph, linkage)
+        else:
+            dist_matrix = self._get_dtw_dist_matrix(data, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, nw)
+            self.logger.info('{} linkage on distance matrix'.format(linkage))
+            z = clusterer.cluster(dist_matrix, linkage)
+
+        self.logger.info('Saving linkage')
+        params_str = self._get_HIERARCHICAL_STR_formatted(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, linkage, knn)
+        np.save(self._get_linkage_path(params_str), z)
+
+        if k:
+            ks = [int(cur_k) for cur_k in k.split(',')]
+            labels = clusterer.cut(ks=ks)
+            for cur_k, cur_labels in zip(ks, labels):
+                self.logger.info('k: {}, cluster sizes: {}'.format(cur_k, np.bincount(cur_labels).tolist()))
+            np.save(self._get_linkage_cuts_path(params_str, k), labels)
+
+    def render_hierarchical(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, linkage, knn=None, truncate_p=100):
+        """
+        Plot dendrogram of a saved linkage (see cluster_ts_hierarchical), showing the last truncate_p merges
+        """
+        params_str = self._get_HIERARCHICAL_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, r, linkage, knn)
+        z = np.load(self._get_linkage_path(params_str))
+        HierarchicalCluster().plot_dendrogram(z, truncate_p=truncate_p)
+        plt.savefig(os.path.join(OUTPUTS_PATH, 'imgs', 'hierarchical_{}.png'.format(params_str)))
+        plt.close()
 
-    def cluster_ts_hdbscan(self, data, r, mcs, ms):
+    def cluster_ts_hdbscan_knn(self, data, r, mcs, ms, knn, nw=None):
+        """
+        HDBSCAN on a sparse k-nearest-neighbor DTW graph. min_samples (min_cluster_size if None) must be at most knn
+
+        Saves
+        -----
+        dict with labels_, cluster_persistence_, single_linkage_tree_ (same fields as the HDBSCAN clusterer)
+        """
+        graph = self._get_knn_graph(data, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, knn, nw)
+        self.logger.info('HDBSCAN on kNN graph')
+        tree = hdbscan_linkage(graph, ms if ms is not None else mcs)
+        labels, persistence = extract_clusters(tree, mcs)
+        self.logger.info('Number of clusters: {}'.format(len(persistence)))
+        self.logger.info('Cluster persistence: {}'.format(persistence))
+
+        self.logger.info('Saving clusters')
+        clusterer = {'labels_': labels, 'cluster_persistence_': persistence, 'single_linkage_tree_': tree}
+        self._save_hdbscan(clusterer, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, mcs, '{}-knn{}'.format(ms, knn))
+
+    def cluster_ts_hdbscan(self, data, r, mcs, ms, nw=None):
         """
         Compute HDBSCAN cluster based on DTW distance matrix
 
@@ -259,67 +506,34 @@ class Analysis(object):
         r: int, window size for LB_Keogh
         mcs: int, minimum_cluster_size
         ms: int, min_samples, # larger value is more conservative
+        nw: int, number of worker processes used to build the distance matrix. If None, number of cpus
 
         Saves
         -----
-        Clusterer with fields: labels_, probabilities_, cluster_persistence_, condensed_tree_, single_linkage_tree_,
-        minimum_spanning_tree_, outlier_scores_.
+        dict with labels_, cluster_persistence_, single_linkage_tree_ (same fields as the HDBSCAN clusterer)
             - See: http://hdbscan.readthedocs.io/en/latest/api.html
         """
         self.logger.info('Clustering using HDBSCAN')
 
-        # Load distance matrix if previously computed
-        self.logger.info('Trying to load DTW-based distance matrix')
-        dist_matrix = self._try_load_dtw_dist_matrix(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r)
-        if dist_matrix is None:
-            self.logger.info('No matrix found, creating DTW-based distance matrix - r:{}'.format(r))
-            # Create DTW distance matrix sequentially. TODO: deprecate this
-            # dist_matrix = np.zeros([len(data), len(data)])
-            # for i in range(len(data)):
-            #     self.logger.info(i)
-            #     for j in range(i+1, len(data)):       # only calculate upper triangle
-            #         # dist_matrix[i][j] = fastdtw_dist(data[i], data[j])
-            #         dist_matrix[i][j] = LB_Keogh(data[i], data[j], r) if i != j else 0.0
-            #         # dist_matrix[i][j] = DTWDistance(data[i], data[j], 5) if i != j else 0.0
-            #         # print i, j, dist_matrix[i][j]
-
-            # Create DTW distance matrix in parallel
-            # data = data[0:10]
-            dist_matrix = np.zeros([len(data), len(data)])
-
-            def callback(i, j, future):
-                dist_matrix[i][j] = future.result()
-                # print 'Distance matrix entries not zero: {}'.format((dist_matrix != 0).sum())
-
-            indices = [(i,j) for i in range(len(data)) for j in range(i+1, len(data))]      # only calculate upper triangle
-            with ProcessPoolExecutor(max_workers=4) as executer:
-                fs = []
-                for i, j in indices:
-                    future = executer.submit(LB_Keogh, data[i], data[j], r)
-                    future.add_done_callback(partial(callback, i, j))
-                    fs.append(future)
-                wait(fs)
-
-            # Save distance matrix
-            self.logger.info('Saving DTW-based distance matrix')
-            self._save_dtw_dist_matrix(dist_matrix, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r)
+        # Load distance matrix, computing entries for any videos added since it was last computed
+        self.logger.info('Getting DTW-based distance matrix')
+        dist_matrix = self._get_dtw_dist_matrix(data, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, nw)
 
-        # Cluster
+        # Cluster. Same steps as hdbscan.HDBSCAN(metric='precomputed'), but on the condensed matrix, so no dense
+        # (n, n) matrix is built (see hdbscan_sweep.py). min_samples defaults to min_cluster_size, as in hdbscan
         self.logger.info('Clustering')
         # mcs = mcs if mcs else len(data) / 20
         # ms = ms if ms else len(data) / 40
-        clusterer = hdbscan.HDBSCAN(min_cluster_size=mcs,
-                                    min_samples=ms,
-                                    metric='precomputed')  #,
-                                    # gen_min_span_tree=True)
-        clusterer.fit(dist_matrix)
+        tree = single_linkage_tree(dist_matrix, ms if ms is not None else mcs)
+        labels, persistence = extract_clusters(tree, mcs)
 
         # Some logs
-        self.logger.info('Number of clusters: {}'.format(clusterer.cluster_persistence_.shape[0]))
-        self.logger.info('Cluster persistence: {}'.format(clusterer.cluster_persistence_))
+        self.logger.info('Number of clusters: {}'.format(len(persistence)))
+        self.logger.info('Cluster persistence: {}'.format(persistence))
 
         # Save
         self.logger.info('Saving clusterer')
+        clusterer = {'labels_': labels, 'cluster_persistence_': persistence, 'single_linkage_tree_': tree}
         self._save_hdbscan(clusterer, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, mcs, ms)
 
         # Robust single linkage hierarchical clustering
@@ -331,32 +545,167 @@ class Analysis(object):
         # hierarchy.plot()
         # plt.savefig('tmp.png')
 
+    def cluster_ts_hdbscan_sweep(self, data, r, mcs, ms, nw=None):
+        """
+        HDBSCAN for every combination of min_cluster_size and min_samples. The single linkage tree of the mutual
+        reachability distances is computed once per min_samples and only the cluster extraction is repeated per
+        min_cluster_size (see hdbscan_sweep.py)
+
+        Parameters
+        ----------
+        data: np array of dimension (num_timeseries, max_len)
+        r: int, window size for LB_Keogh
+        mcs: comma-separated min_cluster_size
+        ms: comma-separated min_samples. If None, min_samples = min_cluster_size
+        nw: int, number of worker processes used to build the distance matrix. If None, number of cpus
+
+        Saves
+        -----
+        Table (csv) with one row per setting: ms, mcs, num_clusters, noise_frac, persistence. Labels of every
+        setting (.npy, one row per table row, -1 is noise)
+        """
+        self.logger.info('HDBSCAN sweep: mcs={}, ms={}'.format(mcs, ms))
+        dist_matrix = self._get_dtw_dist_matrix(data, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, nw)
+
+        mcs_list = [int(cur_mcs) for cur_mcs in mcs.split(',')]
+        ms_list = [int(cur_ms) for cur_ms in ms.split(',')] if ms is not None else [None]
+        settings, labels = hdbscan_sweep(dist_matrix, ms_list, mcs_list, logger=self.logger)
+
+        self.logger.info('Saving sweep table and labels')
+        self._save_hdbscan_sweep(settings, labels, self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes, self.pred_fn, r, mcs, ms)
+
+    ####################################################################################################################
+    # Assign new videos to saved clusters
+    ####################################################################################################################
+    def assign_new(self, new_vids_dirpath, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        """
+        Assign videos that have predictions but are not in the saved time series to the saved clusters, without
+        re-running prepare_ts or clustering. Series are prepared exactly as in prepare_ts() (smoothed, downsampled,
+        stretched to the saved length, z-normalized), then assigned to the nearest saved centroid (medoid for
+        kmedoids) with LB-pruned DTW.
+
+        Parameters
+        ----------
+        new_vids_dirpath: folder to traverse for new videos
+        alg: kmeans, minibatchkmeans, or kmedoids
+        k: int, number of clusters of the saved clustering to assign to
+
+        Notes
+        -----
+        The saved time series, their mean / std / titles, and the saved clustering results are not changed, so the
+        results of every k keep matching the n series. New series, titles, means, stds, labels and distances are
+        saved in a separate assigned file for this clustering result (see _save_assigned), and cached as an
+        'assigned' artifact keyed by the result. Running again only assigns videos that are in neither.
+        """
+        ts = self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        ts_idx2title = self._load_ts_idx2title(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        ts_mean = self._load_ts_mean(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        ts_std = self._load_ts_std(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        result = self._load_kclust_result(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        assigned = self._load_assigned(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+
+        # Prepare new series
+        titles = set(ts_idx2title.values()) | set(assigned['titles'] if assigned else [])
+        new_titles, new_ts, new_vids_dirpaths = [], [], []
+        for vdp in self.get_all_vidpaths_with_frames_and_preds(new_vids_dirpath):
+            title = os.path.basename(vdp)
+            if title in titles:
+                continue
+            downsampled = self._get_video_ts(vdp, w, ds, max_nframes, pred_fn)
+            if downsampled is None:
+                continue
+            new_titles.append(title)
+            new_vids_dirpaths.append(vdp)
+            new_ts.append(downsampled)
+        if len(new_ts) == 0:
+            self.logger.info('No new videos')
+            return
+        new_ts = self._stretch_ts(new_ts, ts.shape[1])
+        new_mean = np.expand_dims(np.mean(new_ts, axis=1), 1)
+        new_std = np.expand_dims(new_ts.std(axis=1), 1)
+        new_ts = (new_ts - new_mean) / new_std
+
+        # Clusters to assign to, z-normalized like the series. Saved centroids were un-normalized with the mean of
+        # the means and stds (see cluster_ts_kmeans)
+        if alg == 'kmedoids':
+            clusters = ts[result.medoids]
+        else:
+            clusters = (np.array(result.centroids, dtype=np.float64) - ts_mean.mean()) / ts_std.mean()
+
+        # Assign with LB_Kim -> LB_Keogh -> early-abandoned DTW (DTW window 2, as in cluster_ts_kmeans)
+        start_time = time.time()
+        stats = Counter()
+        labels, dists = assign_nearest(new_ts, clusters, 2, get_lb_radius(r, 2, ts.shape[1]), stats=stats)
+        self.logger.info('Assigned {} videos in {:.1f}ms'.format(len(new_ts), 1000 * (time.time() - start_time)))
+        for title, label, dist in zip(new_titles, labels, dists):
+            self.logger.info(u'{}: cluster {}, distance {:.4f}'.format(unicode(title, 'utf-8'), label, dist))
+
+        # Append to this result's assigned videos
+        self.logger.info('Saving assigned videos')
+        prev_fingerprint = self._get_assigned_fingerprint(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        new_assigned = {'titles': new_titles, 'ts': new_ts, 'mean': new_mean, 'std': new_std,
+                        'labels': labels, 'dists': dists}
+        if assigned is not None:
+            for name in ['ts', 'mean', 'std', 'labels', 'dists']:
+                new_assigned[name] = np.concatenate([assigned[name], new_assigned[name]])
+            new_assigned['titles'] = assigned['titles'] + new_titles
+        assigned = new_assigned
+        self._save_assigned(assigned, ts.dtype, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+
+        # Cached as an 'assigned' artifact with the clustering result's parameters, keyed by the result itself
+        params, _ = self._get_kclust_cache_params_and_inputs(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn,
+                                                             k, it, r)
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        inputs = {'kclust': fingerprint_file(self._get_kclust_result_path(alg, params_str)),
+                  'assigned': prev_fingerprint,
+                  'new_preds': fingerprint_preds(new_vids_dirpaths, pred_fn)}
+        self.cache.put('assigned', self.cache.key('assigned', params, inputs), params, inputs,
+                       {'assigned.npz': self._get_assigned_path(alg, params_str)},
+                       info={'n': len(assigned['titles'])})
+
     ####################################################################################################################
     # Compute and save distances
     ####################################################################################################################
-    def compute_kclust_error(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+    def compute_kclust_error(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r, nw=None):
         """
-        - Compute sum_over_series{DTWDistance(series, centroid} for each k., basically WCSS
+        - Compute metrics of the clusters for each k from the distance matrix, all k in one pass (see metrics.py):
+          within-cluster cost, silhouette, Davies-Bouldin, and each series' distance to its cluster's medoid
+        - error is the mean distance to the medoid, basically WCSS
         - alg: kmeans or kmedoids
         - Used to determine optimal k
         - k is a comma-separated list
         """
-        k2error = {}
+        ts = self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        dist_matrix = self._get_dtw_dist_matrix(ts, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, nw)
+
+        # Label vector per k, from the saved cluster memberships
+        ks = []
+        labels_stack = []
         for cur_k in k.split(','):
             cur_k = int(cur_k)
-            error = 0.0
             try:
-                ts_dists = self._load_ts_dists(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r)
-                for c_idx, c_members in ts_dists.items():
-                    for m_idx, dist in c_members.items():
-                        error += dist
-                error /= float(n)
-                k2error[cur_k] = error
-                self.logger.info('k: {}, error: {}'.format(cur_k, error))
+                result = self._load_kclust_result(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r)
             except Exception as e:
                 print e
+                continue
+            ks.append(cur_k)
+            labels_stack.append(np.array(result.labels))
+
+        k2error = {}
+        k2metrics = {}
+        for cur_k, result in zip(ks, cluster_metrics(dist_matrix, labels_stack)):
+            k2error[cur_k] = result['mean_dist']
+            k2metrics[cur_k] = {'cost': result['cost'],
+                                'silhouette': result['silhouette'],
+                                'davies_bouldin': result['davies_bouldin'],
+                                'sizes': result['sizes'].tolist(),
+                                'medoids': result['medoids'].tolist(),
+                                'medoid_dists': result['medoid_dists'].tolist()}
+            self.logger.info('k: {}, error: {}, silhouette: {}, davies-bouldin: {}'.format(
+                cur_k, result['mean_dist'], result['silhouette'], result['davies_bouldin']))
 
         self._save_kclust_error(k2error, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        self._save_kclust_metrics(k2metrics, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
 
     ####################################################################################################################
     # Compute and save distances
@@ -373,13 +722,15 @@ class Analysis(object):
 
         Saves
         ------
-        ts_dists: dict, key is int (centroid_idx), value = dict (key is member_idx, value is distance)
+        Clustering result with dists replaced by the LB_Keogh distance of each series to its centroid
 
         Notes
         -----
         Used to sort members by how close they are to the centroid for Clusters view in UGI
         """
         self.logger.info('Creating and saving distances')
+        ts = self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        ts_upper, ts_lower = envelope(ts, r)
 
         for cur_k in k.split(','):
             print '=' * 100
@@ -388,33 +739,131 @@ class Analysis(object):
 
             try:
                 # Load data
-                ts = self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-                centroids = self._load_centroids(vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r)
-                assignments = self._load_assignments(vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r)
-
-                # Compute
-                ts_dists = {}
-                for c_idx, members in assignments.items():
-                    ts_dists[c_idx] = {}
-                    i = 0
-                    for m_idx in members:
-                        # ts_dists[c_idx][m_idx] =
-                        ts_dists[c_idx][m_idx] = LB_Keogh(centroids[c_idx], ts[m_idx], r)
-
-                        if i  % 100 == 0:
-                            self.logger.info('centroid: {} - {} distances computed'.format(c_idx, i))
-                        i += 1
+                result = self._load_kclust_result(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r,
+                                                  mmap_mode=None)
+
+                # Compute, all members of a centroid at once against the members' envelopes
+                for c_idx in range(result.num_clust):
+                    members = result.members(c_idx)
+                    result.dists[members] = lb_keogh_envelope(np.asarray(result.centroids[c_idx], dtype=np.float64),
+                                                              ts_upper[members], ts_lower[members])
+                    self.logger.info('centroid: {} - {} distances computed'.format(c_idx, len(members)))
 
                 # Save
-                self._save_ts_dists(ts_dists, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r)
+                self._save_kclust_result(result, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, cur_k, it, r)
 
             except Exception as e:
                 self.logger.info(e)
 
+    ####################################################################################################################
+    # Choose LB_Keogh window size
+    ####################################################################################################################
+    def sweep_lb_radius(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, rs, nw=None):
+        """
+        Build the LB_Keogh distance stores for every window size in rs in one pass (see build_lb_keogh_stores), so
+        that clustering with any of them (-r) uses the saved matrix, and save how much the distances change with r
+
+        Parameters
+        ----------
+        rs: comma-separated LB_Keogh window sizes
+        nw: int, number of worker processes. If None, number of cpus
+
+        Saves
+        -----
+        json with, per window size, the mean distance, and per pair of window sizes, the Pearson and Spearman
+        correlation of all pairwise distances and the fraction of series with the same nearest neighbor
+        """
+        rs = [int(r) for r in rs.split(',')]
+        ts = self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        ts_idx2title = self._load_ts_idx2title(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        titles = [ts_idx2title[i] for i in range(len(ts))]
+
+        self.logger.info('Building distance matrices for r={}'.format(rs))
+        start_time = time.time()
+        paths = [self._get_dtw_dist_store_path(
+            self._get_DIST_STORE_STR_formatted(vids_dirpath, w, ds, max_nframes, pred_fn, r)) for r in rs]
+        stores = build_lb_keogh_stores(paths, rs, titles, ts, num_workers=nw, logger=self.logger)
+        self.logger.info('Built {} matrices in {:.1f}s'.format(len(rs), time.time() - start_time))
+
+        # Summary. Stores share the same (title) order, so condensed arrays are directly comparable
+        dists = [np.asarray(store.matrix.dists, dtype=np.float64) for store in stores]
+        ranks = [rankdata(d) for d in dists]
+        nearest = []
+        for store in stores:
+            square = store.matrix.to_square()
+            np.fill_diagonal(square, np.inf)
+            nearest.append(square.argmin(axis=1))
+        summary = {'rs': rs,
+                   'mean_dist': [float(d.mean()) for d in dists],
+                   'pairs': []}
+        for i in range(len(rs)):
+            for j in range(i + 1, len(rs)):
+                pair = {'r1': rs[i],
+                        'r2': rs[j],
+                        'pearson': float(np.corrcoef(dists[i], dists[j])[0, 1]),
+                        'spearman': float(np.corrcoef(ranks[i], ranks[j])[0, 1]),
+                        'same_nearest': float(np.mean(nearest[i] == nearest[j]))}
+                summary['pairs'].append(pair)
+                self.logger.info('r={} vs r={}: pearson {:.4f}, spearman {:.4f}, same nearest neighbor {:.3f}'.format(
+                    rs[i], rs[j], pair['pearson'], pair['spearman'], pair['same_nearest']))
+
+        params_str = self._get_DIST_STORE_STR_formatted(vids_dirpath, w, ds, max_nframes, pred_fn, ','.join(map(str, rs)))
+        with open(self._get_lb_radius_sweep_path(params_str), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    ####################################################################################################################
+    # Bootstrap stability of clusters
+    ####################################################################################################################
+    def analyze_stability(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r, nb=200, nw=None):
+        """
+        Assess how stable the saved clusters are: recluster nb subsamples of the distance matrix with k-medoids, in
+        parallel, and compare each to the saved clustering (see stability.py)
+
+        Parameters
+        ----------
+        alg: kmeans, minibatchkmeans, kmedoids, or kshape -- saved clustering to assess
+        k: int, number of clusters of the saved clustering (and of every subsample)
+        it: int, used to load the saved clustering, and maximum number of swap passes per subsample
+        nb: int, number of subsamples
+        nw: int, number of worker processes. If None, number of cpus
+
+        Saves
+        -----
+        json with per-cluster stability and size, co-assignment matrix (npy), and co-assignment figure with series
+        sorted by cluster
+        """
+        ts = self._load_ts(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        dist_matrix = self._get_dtw_dist_matrix(ts, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, nw)
+        result = self._load_kclust_result(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        labels = np.array(result.labels)
+
+        start_time = time.time()
+        stability, jaccard, coassign = bootstrap_stability(dist_matrix, int(k), labels, num_boot=nb, max_iter=it,
+                                                           num_workers=nw, logger=self.logger)
+        self.logger.info('{} subsamples in {:.1f}s'.format(nb, time.time() - start_time))
+
+        clusts, sizes = np.unique(labels, return_counts=True)
+        clust2stability = {}
+        for c, size, c_stability in zip(clusts.tolist(), sizes.tolist(), stability.tolist()):
+            clust2stability[c] = {'size': size, 'stability': c_stability}
+            self.logger.info('Cluster {}: {} series, stability {:.3f}'.format(c, size, c_stability))
+
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        with open(self._get_stability_path(alg, params_str, nb), 'w') as f:
+            json.dump({'num_boot': nb, 'clusters': clust2stability, 'jaccard': jaccard.tolist()}, f)
+        np.save(self._get_coassign_path(alg, params_str, nb), coassign)
+
+        # Plot co-assignment, series sorted by cluster
+        order = np.argsort(labels, kind='mergesort')
+        plt.imshow(coassign[np.ix_(order, order)], cmap='viridis', vmin=0, vmax=1, interpolation='nearest')
+        plt.colorbar()
+        plt.savefig(os.path.join(OUTPUTS_PATH, 'imgs', '{}-coassign_{}-nb{}.png'.format(alg, params_str, nb)))
+        plt.gcf().clear()
+
     ####################################################################################################################
     # Analyze coherence of 'groups' (combinations of different metadata, e.g. genre + year)
     ####################################################################################################################
-    def analyze_group_coherence(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r):
+    def analyze_group_coherence(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, nw=None):
         """
         Analyze coherence 'groups' (combinations of different metadata, e.g. genre + year)
         """
@@ -435,32 +884,15 @@ class Analysis(object):
         self.logger.info('{} groups have at least {} members'.format(len(group2titles), MIN_GROUP_SIZE))
         self.logger.info('Calculating coherence for {} groups'.format(len(group2titles)))
 
+        # Distances between every pair of videos, computed only if not already in the distance store
+        dist_matrix = self._get_dtw_dist_matrix(ts, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, nw)
         for group, titles in group2titles.items():
             self.logger.info('Group: {}, num_videos: {}'.format(group, len(titles)))
-            coherences = []         # parallel
-            # coherence = 0.0       # sequential
-            npairs = 0
-            valid_titles = set()
-
-            # Parallel
-            def callback(future):
-                coherences.append(future.result())
-
-            indices = [(i,j) for i in range(len(titles)) for j in range(i+1, len(titles))]
-            with ProcessPoolExecutor(max_workers=4) as executer:
-                fs = []
-                for i, j in indices:
-                    title1 = titles[i]
-                    title2 = titles[j]
-                    if (title1 in title2ts_idx) and (title2 in title2ts_idx):
-                        npairs += 1
-                        valid_titles.add(title1)
-                        valid_titles.add(title2)
-                        future = executer.submit(LB_Keogh, ts[title2ts_idx[title1]], ts[title2ts_idx[title2]], r)
-                        future.add_done_callback(callback)
-                        fs.append(future)
-                wait(fs)
-            coherence = sum(coherences) / float(npairs)
+            valid_titles = set([t for t in titles if t in title2ts_idx])
+            idxs = [title2ts_idx[t] for t in titles if t in title2ts_idx]
+            npairs = len(idxs) * (len(idxs) - 1) / 2
+
+            coherence = dist_matrix.upper_sum(idxs) / float(npairs)
 
             # # Sequential
             # for i in range(len(titles)):
@@ -532,46 +964,59 @@ class Analysis(object):
         ----------
         starting_dir: e.g. data/videos/films
         """
-        self.logger.info('Traversing: {}'.format(starting_dir))
-        self.logger.info('Finding all directories with frames/ and preds/ folders')
-        vidpaths = []
-        for root, dirs, files in os.walk(starting_dir):
-            if ('preds' in dirs) and ('frames' in dirs) \
-                    and (len(os.listdir(os.path.join(root, 'frames'))) > 0) \
-                    and (VIZ_SENT_PRED_FN in os.listdir(os.path.join(root, 'preds'))):
-                vidpaths.append(root)
+        # Corpus manifest (see core/utils/manifest.py) only relists directories that changed since the last run
+        self.logger.info('Finding all directories with frames/ and preds/ in: {}'.format(starting_dir))
+        self.manifest = Manifest.for_path(starting_dir).refresh(starting_dir, logger=self.logger)
+        vidpaths = self.manifest.find(starting_dir, min_frames=1, pred_fns=[VIZ_SENT_PRED_FN])
 
         return vidpaths
 
-    def _save_ts(self, ts, vids_dirpath, n, w, ds, max_nframes, pred_fn):
+    def _save_npy(self, arr, path, dtype):
+        """
+        Save array as .npy. Written to a temporary file and renamed, so processes that have the previous file
+        memory-mapped keep reading it
+        """
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, np.asarray(arr, dtype=dtype))
+        os.rename(tmp_path, path)
+
+    def _load_npy(self, path, mmap_mode='r'):
+        """
+        Return array saved by _save_npy(), memory-mapped (read-only by default). If only the pickle saved before .npy
+        files exists, it is converted once
+        """
+        pkl_path = path[:-len('.npy')] + '.pkl'
+        if (not os.path.exists(path)) and os.path.exists(pkl_path):
+            self.logger.info('Converting {} to .npy'.format(pkl_path))
+            with open(pkl_path, 'rb') as f:
+                self._save_npy(pickle.load(f), path, np.float64)
+        return np.load(path, mmap_mode=mmap_mode)
+
+    def _save_ts(self, ts, vids_dirpath, n, w, ds, max_nframes, pred_fn, dtype=np.float64):
         params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-        path = self._get_ts_path(params_str)
-        with open(path, 'wb') as f:
-            pickle.dump(ts, f, protocol=2)
+        self._save_npy(ts, self._get_ts_path(params_str), dtype)
 
-    def _save_ts_mean(self, mean, vids_dirpath, n, w, ds, max_nframes, pred_fn):
+    def _save_ts_mean(self, mean, vids_dirpath, n, w, ds, max_nframes, pred_fn, dtype=np.float64):
         params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-        path = self._get_ts_mean_path(params_str)
-        with open(path, 'wb') as f:
-            pickle.dump(mean, f, protocol=2)
+        self._save_npy(mean, self._get_ts_mean_path(params_str), dtype)
 
-    def _save_ts_std(self, std, vids_dirpath, n, w, ds, max_nframes, pred_fn):
+    def _save_ts_std(self, std, vids_dirpath, n, w, ds, max_nframes, pred_fn, dtype=np.float64):
         params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-        path = self._get_ts_std_path(params_str)
-        with open(path, 'wb') as f:
-            pickle.dump(std, f, protocol=2)
+        self._save_npy(std, self._get_ts_std_path(params_str), dtype)
 
     def _save_ts_idx2title(self, ts_idx2title, vids_dirpath, n, w, ds, max_nframes, pred_fn):
         params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
         path = self._get_ts_idx2title_path(params_str)
-        with open(path, 'w') as f:
+        # Replaced rather than written in place, as the file may be hard-linked into the artifact cache
+        with open(path + '.tmp', 'w') as f:
             pickle.dump(ts_idx2title, f, protocol=2)
+        os.rename(path + '.tmp', path)
 
     def _load_ts(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
         """
-        Load timeseries (np array of dim [num_timeseries, max_len]) saved by prepare_and_save_timeseries(). Set
-        self fields because this method is called before clustering. Once clustering is done, will need these fields
-        to save output.
+        Load timeseries (np array of dim [num_timeseries, max_len]) saved by prepare_ts(), as a read-only memmap, so
+        processes loading the same series share one copy. Set self fields because this method is called before
+        clustering. Once clustering is done, will need these fields to save output.
         """
         self.logger.info('Loading ts')
         self.vids_dirpath = vids_dirpath
@@ -581,9 +1026,8 @@ class Analysis(object):
         self.max_nframes = max_nframes
         self.pred_fn = pred_fn
 
-        str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-        path = self._get_ts_path(str)
-        ts = pickle.load(open(path, 'rb'))
+        params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        ts = self._load_npy(self._get_ts_path(params_str))
         return ts
 
     def _load_ts_idx2title(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
@@ -594,27 +1038,23 @@ class Analysis(object):
 
     def _load_ts_mean(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
         params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-        path = self._get_ts_mean_path(params_str)
-        mean = pickle.load(open(path, 'rb'))
+        mean = self._load_npy(self._get_ts_mean_path(params_str))
         return mean
 
     def _load_ts_std(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
         params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
-        path = self._get_ts_std_path(params_str)
-        std = pickle.load(open(path, 'rb'))
+        std = self._load_npy(self._get_ts_std_path(params_str))
         return std
 
     def _save_kclust(self, clusterer, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
         """
-        Save centroids, assignments, plots, and ts-distsfor kmeans
+        Save result (labels, medoids, distances to medoid / centroid, centroids; see kclust_result.py) and plots
         """
         params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
-        centroids_path = self._get_centroids_path(alg, params_str)
-        assignments_path = self._get_assignments_path(alg, params_str)
-        with open(centroids_path, 'wb') as f:
-            pickle.dump(clusterer.centroids, f, protocol=2)
-        with open(assignments_path, 'wb') as f:
-            pickle.dump(clusterer.assignments, f, protocol=2)
+        num_ts = sum([len(members) for members in clusterer.assignments.values()])
+        result = KClustResult.from_clusters(num_ts, clusterer.assignments, clusterer.ts_dists, clusterer.centroids,
+                                            medoids=getattr(clusterer, 'medoid_idxs', None))
+        self._save_kclust_result(result, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
 
         # Plot centroids
         for i, c in enumerate(clusterer.centroids):
@@ -631,20 +1071,54 @@ class Analysis(object):
             plt.savefig(os.path.join(OUTPUTS_PATH, 'imgs', '{}-medoids_{}.png'.format(alg, params_str)))
             plt.gcf().clear()
 
-        # Ts dists to centroids
-        ts_dists_path = self._get_ts_dists_path(alg, params_str)
-        with open(ts_dists_path, 'wb') as f:
-            pickle.dump(clusterer.ts_dists, f, protocol=2)
 
         # Some extra logging
         for centroid_idx, assignments in clusterer.assignments.items():
             self.logger.info('Centroid {}: {} series'.format(centroid_idx, len(assignments)))
 
-    def _save_ts_dists(self, ts_dists, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+    def _save_kclust_result(self, result, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        """Save result, and cache it keyed by its parameters and the saved time series it was computed from"""
         params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
-        path = self._get_ts_dists_path(alg, params_str)
-        with open(path, 'wb') as f:
-            pickle.dump(ts_dists, f, protocol=2)
+        path = self._get_kclust_result_path(alg, params_str)
+        result.save(path)
+        params, inputs = self._get_kclust_cache_params_and_inputs(alg, vids_dirpath, n, w, ds, max_nframes, pred_fn,
+                                                                  k, it, r)
+        self.cache.put('kclust', self.cache.key('kclust', params, inputs), params, inputs, {'result.kclust': path},
+                       info={'n': len(result.labels)})
+
+    def _save_assigned(self, assigned, dtype, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        """
+        Save videos assigned to a clustering result by assign_new(), as one .npz of titles, ts, mean, std (dtype of the
+        saved time series), labels and dists. Written to a temporary file and renamed
+        """
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        path = self._get_assigned_path(alg, params_str)
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, titles=np.array(assigned['titles'], dtype=str),
+                 ts=np.asarray(assigned['ts'], dtype=dtype), mean=np.asarray(assigned['mean'], dtype=dtype),
+                 std=np.asarray(assigned['std'], dtype=dtype), labels=np.asarray(assigned['labels'], dtype=np.int32),
+                 dists=np.asarray(assigned['dists'], dtype=np.float32))
+        os.rename(tmp_path, path)
+
+    def _load_assigned(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        """
+        Return dict of videos assigned to a clustering result by assign_new() (see _save_assigned). Series i is
+        titles[i], with labels[i] and dists[i]. None if none were assigned
+        """
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        path = self._get_assigned_path(alg, params_str)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            assigned = {name: f[name] for name in ['ts', 'mean', 'std', 'labels', 'dists']}
+            assigned['titles'] = [str(title) for title in f['titles']]
+        return assigned
+
+    def _get_assigned_fingerprint(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        """Return sha1 of saved assigned videos, or None if there are none"""
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        path = self._get_assigned_path(alg, params_str)
+        return fingerprint_file(path) if os.path.exists(path) else None
 
     def _save_kclust_error(self, k2error, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
         params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
@@ -657,6 +1131,41 @@ class Analysis(object):
         plt.savefig(os.path.join(OUTPUTS_PATH, 'imgs', '{}-error_{}.png'.format(alg, params_str)))
         plt.gcf().clear()
 
+    def _save_kclust_metrics(self, k2metrics, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        path = self._get_kclust_metrics_path(alg, params_str)
+        with open(path, 'w') as f:
+            json.dump(k2metrics, f)
+
+        # Plot
+        ks = sorted(k2metrics.keys())
+        fig, (ax_sil, ax_db) = plt.subplots(2, 1, sharex=True)
+        ax_sil.plot(ks, [k2metrics[cur_k]['silhouette'] for cur_k in ks])
+        ax_sil.set_ylabel('silhouette')
+        ax_db.plot(ks, [k2metrics[cur_k]['davies_bouldin'] for cur_k in ks])
+        ax_db.set_ylabel('davies-bouldin')
+        ax_db.set_xlabel('k')
+        fig.savefig(os.path.join(OUTPUTS_PATH, 'imgs', '{}-metrics_{}.png'.format(alg, params_str)))
+        plt.close(fig)
+
+    def _save_kmedoids_sweep(self, results, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        """
+        Save list of per-k results (see kmedoids_sweep) to one json, and plot cost and silhouette against k
+        """
+        params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
+        path = self._get_kmedoids_sweep_path(params_str)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        ks = [result['k'] for result in results]
+        fig, (ax_cost, ax_sil) = plt.subplots(2, 1, sharex=True)
+        ax_cost.plot(ks, [result['cost'] for result in results])
+        ax_cost.set_ylabel('cost')
+        ax_sil.plot(ks, [result['silhouette'] for result in results])
+        ax_sil.set_ylabel('silhouette')
+        ax_sil.set_xlabel('k')
+        fig.savefig(os.path.join(OUTPUTS_PATH, 'imgs', 'kmedoids-sweep_{}.png'.format(params_str)))
+        plt.close(fig)
 
     def _save_hdbscan(self, clusterer, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, mcs, ms):
         """
@@ -674,44 +1183,48 @@ class Analysis(object):
         # plt.gcf().clear()
         # clusterer.condensed_tree_.plot(select_clusters=True, selection_palette=sns.color_palette('deep', 8))
 
-    def _save_dtw_dist_matrix(self, dtw_dist_matrix, vids_dirpath, n, w, ds, max_nframes, pred_fn, r):
-        params_str = self._get_DIST_MATRIX_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, r)
-        path = self._get_dtw_dist_matrix_path(params_str)
-        with open(path, 'wb') as f:
-            pickle.dump(dtw_dist_matrix, f, protocol=2)
+    def _save_hdbscan_sweep(self, settings, labels, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, mcs, ms):
+        params_str = self._get_HDBSCAN_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, r, mcs, ms)
+        table = pd.DataFrame(settings, columns=['ms', 'mcs', 'num_clusters', 'noise_frac', 'persistence'])
+        table['persistence'] = table['persistence'].apply(lambda p: ' '.join(['{:.4f}'.format(v) for v in p]))
+        table.to_csv(self._get_hdbscan_sweep_path(params_str), index=False)
+        np.save(self._get_hdbscan_sweep_labels_path(params_str), labels)
 
-    def _try_load_dtw_dist_matrix(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r):
-        params_str = self._get_DIST_MATRIX_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, r)
-        path = self._get_dtw_dist_matrix_path(params_str)
+    def _get_knn_graph(self, data, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, knn, nw):
+        """
+        Return sparse (num_timeseries, num_timeseries) graph of DTW distances (window r) to each series' knn nearest
+        neighbors, loading it if it was already built
+        """
+        params_str = self._get_KNN_GRAPH_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, r, knn)
+        path = self._get_knn_graph_path(params_str)
         if os.path.exists(path):
-            dist_matrix = pickle.load(open(path, 'rb'))
-            return dist_matrix
-        else:
-            return None
-
-    def _load_centroids(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+            self.logger.info('Loading kNN graph')
+            return load_knn_graph(path)
+        self.logger.info('Building kNN graph: knn={}'.format(knn))
+        graph = build_knn_graph(data, knn, metric='dtw', r=r, w=r, num_workers=nw, logger=self.logger)
+        save_knn_graph(path, graph)
+        return graph
+
+    def _get_dtw_dist_matrix(self, data, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, nw):
         """
-        Load centroids from k means clustering
+        Return CondensedDistMatrix for data, ordered as in ts_idx2title. Distances are kept in a store
+        keyed by video title (not n), so only entries for new or changed videos are computed
         """
-        clusters_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
-        centroids_path = self._get_centroids_path(alg, clusters_str)
-        centroids = pickle.load(open(centroids_path, 'rb'))
-        return centroids
-
-    def _load_assignments(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        ts_idx2title = self._load_ts_idx2title(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        titles = [ts_idx2title[i] for i in range(len(data))]
+        params_str = self._get_DIST_STORE_STR_formatted(vids_dirpath, w, ds, max_nframes, pred_fn, r)
+        store = DistStore(self._get_dtw_dist_store_path(params_str), metric='lb_keogh', r=r)
+        store.update(titles, data, num_workers=nw, logger=self.logger)
+        dist_matrix = store.get_matrix(titles)
+        return dist_matrix
+
+    def _load_kclust_result(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r, mmap_mode='r'):
         """
-        Load assignments from k means clustering
+        Load result of k means / k medoids / k shape clustering, arrays memory-mapped (read into memory if
+        mmap_mode is None)
         """
-        clusters_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
-        assignments_path = self._get_assignments_path(alg, clusters_str)
-        assignments = pickle.load(open(assignments_path, 'rb'))
-        return assignments
-
-    def _load_ts_dists(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
         params_str = self._get_KCLUST_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r)
-        path = self._get_ts_dists_path(alg, params_str)
-        ts_dists = pickle.load(open(path, 'rb'))
-        return ts_dists
+        return KClustResult.load(self._get_kclust_result_path(alg, params_str), mmap_mode=mmap_mode)
 
     def _save_group_coherence(self, group2coherence, vids_dirpath, n, w, ds, max_nframes, pred_fn, r):
         params_str = self._get_GROUP_COHERENCE_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn, r)
@@ -719,6 +1232,48 @@ class Analysis(object):
         with open(path, 'wb') as f:
             pickle.dump(group2coherence, f, protocol=2)
 
+    ####################################################################################################################
+    # Artifact cache (see core/utils/artifact_cache.py)
+    ####################################################################################################################
+    def _get_ts_cache_params(self, vids_dirpath, w, ds, max_nframes, pred_fn):
+        return {'vids_dir': os.path.basename(vids_dirpath), 'w': w, 'ds': ds, 'max_nframes': max_nframes,
+                'pred_fn': pred_fn}
+
+    def _get_ts_cache_files(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
+        """Return dict, name in cache -> path of every file saved by prepare_ts()"""
+        params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        return {'ts.npy': self._get_ts_path(params_str),
+                'ts-idx2title.pkl': self._get_ts_idx2title_path(params_str),
+                'ts-mean.npy': self._get_ts_mean_path(params_str),
+                'ts-std.npy': self._get_ts_std_path(params_str)}
+
+    def _get_ts_fingerprint(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
+        """Return sha1 of saved time series, the input of clusterings"""
+        params_str = self._get_TS_STR_formatted(vids_dirpath, n, w, ds, max_nframes, pred_fn)
+        return fingerprint_file(self._get_ts_path(params_str))
+
+    def _get_kclust_cache_params_and_inputs(self, alg, vids_dirpath, n, w, ds, max_nframes, pred_fn, k, it, r):
+        params = self._get_ts_cache_params(vids_dirpath, w, ds, max_nframes, pred_fn)
+        params.update({'alg': alg, 'k': k, 'it': it, 'r': r})
+        inputs = {'ts': self._get_ts_fingerprint(vids_dirpath, n, w, ds, max_nframes, pred_fn)}
+        return params, inputs
+
+    def _restore_cached_kclust(self, alg, k, it, r):
+        """
+        Return True if a result for these parameters was already computed from the same (loaded) time series, after
+        restoring it to its path. Plots are not redrawn
+        """
+        params, inputs = self._get_kclust_cache_params_and_inputs(alg, self.vids_dirpath, self.n, self.w, self.ds,
+                                                                  self.max_nframes, self.pred_fn, k, it, r)
+        lineage = self.cache.get('kclust', self.cache.key('kclust', params, inputs))
+        if lineage is None:
+            return False
+        self.logger.info('{} result for k={} cached: {}, restoring'.format(alg, k, lineage['dirpath']))
+        params_str = self._get_KCLUST_STR_formatted(self.vids_dirpath, self.n, self.w, self.ds, self.max_nframes,
+                                                    self.pred_fn, k, it, r)
+        self.cache.restore(lineage, {'result.kclust': self._get_kclust_result_path(alg, params_str)})
+        return True
+
     def _get_TS_STR_formatted(self, vids_dirpath, n, w, ds, max_nframes, pred_fn):
         str = TS_STR.format(
             os.path.basename(vids_dirpath), n,
@@ -739,6 +1294,24 @@ class Analysis(object):
             ds, max_nframes, pred_fn[:-4], r)
         return str
 
+    def _get_DIST_STORE_STR_formatted(self, vids_dirpath, w, ds, max_nframes, pred_fn, r):
+        str = DIST_STORE_STR.format(
+            os.path.basename(vids_dirpath), w,
+            ds, max_nframes, pred_fn[:-4], r)
+        return str
+
+    def _get_KNN_GRAPH_STR_formatted(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, knn):
+        str = KNN_GRAPH_STR.format(
+            os.path.basename(vids_dirpath), n, w,
+            ds, max_nframes, pred_fn[:-4], r, knn)
+        return str
+
+    def _get_HIERARCHICAL_STR_formatted(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r, linkage, knn):
+        str = HIERARCHICAL_STR.format(
+            os.path.basename(vids_dirpath), n, w,
+            ds, max_nframes, pred_fn[:-4], r, linkage, knn)
+        return str
+
     def _get_GROUP_COHERENCE_STR_formatted(self, vids_dirpath, n, w, ds, max_nframes, pred_fn, r):
         str = GROUP_COHERENCE_STR.format(
             os.path.basename(vids_dirpath), n, w,
@@ -753,39 +1326,68 @@ class Analysis(object):
         return str
 
     def _get_ts_path(self, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', 'ts_{}.pkl'.format(params_str))
+        path = os.path.join(OUTPUTS_PATH, 'data', 'ts_{}.npy'.format(params_str))
         return path
 
     def _get_ts_mean_path(self, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', 'ts-mean_{}.pkl'.format(params_str))
+        path = os.path.join(OUTPUTS_PATH, 'data', 'ts-mean_{}.npy'.format(params_str))
         return path
 
     def _get_ts_std_path(self, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', 'ts-std_{}.pkl'.format(params_str))
+        path = os.path.join(OUTPUTS_PATH, 'data', 'ts-std_{}.npy'.format(params_str))
         return path
 
     def _get_ts_idx2title_path(self, params_str):
         path = os.path.join(OUTPUTS_PATH, 'data', 'ts-idx2title_{}.pkl'.format(params_str))
         return path
 
-    def _get_centroids_path(self, alg, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', '{}-centroids_{}.pkl'.format(alg, params_str))
+    def _get_kclust_result_path(self, alg, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', '{}-result_{}.kclust'.format(alg, params_str))
         return path
 
-    def _get_assignments_path(self, alg, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', '{}-assignments_{}.pkl'.format(alg, params_str))
-        return path
-
-    def _get_ts_dists_path(self, alg, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', '{}-ts-dists_{}.pkl'.format(alg, params_str))
+    def _get_assigned_path(self, alg, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', '{}-assigned_{}.npz'.format(alg, params_str))
         return path
 
     def _get_kclust_error_path(self, alg, params_str):
         path = os.path.join(OUTPUTS_PATH, 'data', '{}-error_{}.pkl'.format(alg, params_str))
         return path
 
-    def _get_dtw_dist_matrix_path(self, params_str):
-        path = os.path.join(OUTPUTS_PATH, 'data', 'dtw-dist-matrix_{}.pkl'.format(params_str))
+    def _get_kclust_metrics_path(self, alg, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', '{}-metrics_{}.json'.format(alg, params_str))
+        return path
+
+    def _get_stability_path(self, alg, params_str, nb):
+        path = os.path.join(OUTPUTS_PATH, 'data', '{}-stability_{}-nb{}.json'.format(alg, params_str, nb))
+        return path
+
+    def _get_coassign_path(self, alg, params_str, nb):
+        path = os.path.join(OUTPUTS_PATH, 'data', '{}-coassign_{}-nb{}.npy'.format(alg, params_str, nb))
+        return path
+
+    def _get_kmedoids_sweep_path(self, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'kmedoids-sweep_{}.json'.format(params_str))
+        return path
+
+    def _get_dtw_dist_store_path(self, params_str):
+        """Path without extension, see DistStore"""
+        path = os.path.join(OUTPUTS_PATH, 'data', 'dtw-dist-store_{}'.format(params_str))
+        return path
+
+    def _get_lb_radius_sweep_path(self, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'lb-radius-sweep_{}.json'.format(params_str))
+        return path
+
+    def _get_knn_graph_path(self, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'knn-graph_{}.npz'.format(params_str))
+        return path
+
+    def _get_linkage_path(self, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'hierarchical-linkage_{}.npy'.format(params_str))
+        return path
+
+    def _get_linkage_cuts_path(self, params_str, k):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'hierarchical-cuts_{}-k{}.npy'.format(params_str, k))
         return path
 
     def _get_group_coherence_path(self, params_str):
@@ -796,6 +1398,14 @@ class Analysis(object):
         path = os.path.join(OUTPUTS_PATH, 'data', 'hdbscan_{}.pkl'.format(params_str))
         return path
 
+    def _get_hdbscan_sweep_path(self, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'hdbscan-sweep_{}.csv'.format(params_str))
+        return path
+
+    def _get_hdbscan_sweep_labels_path(self, params_str):
+        path = os.path.join(OUTPUTS_PATH, 'data', 'hdbscan-sweep-labels_{}.npy'.format(params_str))
+        return path
+
     def _get_logger(self):
         """Return logger, where path is dependent on mode (train/test), arch, and obj"""
         logs_path = os.path.join(os.path.dirname(__file__), 'logs')
@@ -808,14 +1418,24 @@ if __name__ == '__main__':
     # Action to take
     parser.add_argument('--prepare_ts', dest='prepare_ts', action='store_true', default=False)
     parser.add_argument('--cluster_ts', dest='cluster_ts', action='store_true', default=False)
-    parser.add_argument('-m', '--method', dest='method', default=None, help='kmeans,kmedoids,hierarchical,hdbscan')
+    parser.add_argument('-m', '--method', dest='method', default=None, help='kmeans,minibatchkmeans,kmedoids,kshape,hierarchical,hdbscan')
     parser.add_argument('--compute_kclust_error', dest='compute_kclust_error', action='store_true', default=False)
     parser.add_argument('--compute_kclust_clusters_ts_dists', dest='compute_kclust_clusters_ts_dists', action='store_true', default=False)
+    parser.add_argument('--render_hierarchical', dest='render_hierarchical', action='store_true', default=False,
+                        help='plot dendrogram of linkage saved by -m hierarchical')
+    parser.add_argument('--assign_new', dest='assign_new', action='store_true', default=False,
+                        help='assign videos in new_vids_dirpath to the clusters saved for -m, -k, -it, -r')
+    parser.add_argument('--sweep_lb_radius', dest='sweep_lb_radius', action='store_true', default=False,
+                        help='build LB_Keogh distance matrices for every window size in -rs in one pass, and compare')
+    parser.add_argument('--analyze_stability', dest='analyze_stability', action='store_true', default=False,
+                        help='bootstrap stability of the clusters saved for -m, -k, -it, -r')
     parser.add_argument('--analyze_group_coherence', dest='analyze_group_coherence', action='store_true', default=False)
 
     # Time serise data parameters
     parser.add_argument('--vids_dirpath', dest='vids_dirpath', default=None,
                         help='folder to traverse for predictions, e.g. data/videos/films')
+    parser.add_argument('--new_vids_dirpath', dest='new_vids_dirpath', default=None,
+                        help='--assign_new: folder to traverse for new videos')
     parser.add_argument('-n', dest='n', default=None, help='n - get from filename')
     parser.add_argument('-w', dest='w', type=float, default=None,
                         help='window size for smoothing predictions.'
@@ -825,15 +1445,33 @@ if __name__ == '__main__':
                         help='filter out videos with more frames than this. May be used with shorts to filter out'
                              'the high end (7 out of 1400 shorts are longer than 30 minutes')
     parser.add_argument('--pred_fn', dest='pred_fn', default=VIZ_SENT_PRED_FN, help='pred file name')
+    parser.add_argument('--ts_dtype', dest='ts_dtype', default='float64',
+                        help='prepare_ts: float64 or float32, type the series, means and stds are saved as')
 
     # Clustering-specific parameters
     parser.add_argument('-r', dest='r', type=int, default=None, help='LB_Keogh window size')
+    parser.add_argument('-rs', dest='rs', default=None,
+                        help='--sweep_lb_radius: comma-separated LB_Keogh window sizes')
     parser.add_argument('-k', dest='k', default=None, help='k-means: list of comma-separated k to evaluate')
-    parser.add_argument('-it', dest='it', type=int, default=None, help='k-means: number of iterations')
-    parser.add_argument('-mcs', dest='mcs', type=int, default=None,
-                        help='HDBSCAN: min_cluster_size. If none, use....')
-    parser.add_argument('-ms', dest='ms', type=int, default=None,
-                        help='HDBSCAN: min_samples (larger is more conservative clustering). If None, use....')
+    parser.add_argument('-it', dest='it', type=int, default=None,
+                        help='k-means: number of iterations. Mini-batch k-means: maximum number of batches')
+    parser.add_argument('-bs', dest='bs', type=int, default=None, help='mini-batch k-means: batch size')
+    parser.add_argument('-mcs', dest='mcs', default=None,
+                        help='HDBSCAN: min_cluster_size (comma-separated with --sweep). If none, use....')
+    parser.add_argument('-ms', dest='ms', default=None,
+                        help='HDBSCAN: min_samples (larger is more conservative clustering, comma-separated with '
+                             '--sweep). If None, use....')
+    parser.add_argument('-knn', dest='knn', type=int, default=None,
+                        help='HDBSCAN, hierarchical: cluster on a sparse graph of each series\' knn nearest neighbors '
+                             'under DTW instead of the full distance matrix')
+    parser.add_argument('--linkage', dest='linkage', default='single',
+                        help='hierarchical: single, complete, average, weighted (single or average with -knn)')
+    parser.add_argument('-nb', dest='nb', type=int, default=200, help='stability: number of bootstrap subsamples')
+    parser.add_argument('-nw', dest='nw', type=int, default=None,
+                        help='number of worker processes used to build the distance matrix. If None, number of cpus')
+    parser.add_argument('--sweep', dest='sweep', action='store_true', default=False,
+                        help='k-medoids: cluster all k in parallel, warm started, and save one results file. '
+                             'HDBSCAN: cluster for every mcs and ms, reusing the tree per ms, and save one table')
 
 
     cmdline = parser.parse_args()
@@ -844,20 +1482,36 @@ if __name__ == '__main__':
     analysis = Analysis()
     if cmdline.prepare_ts:
         analysis.prepare_ts(cmdline.vids_dirpath, cmdline.w,
-                                     cmdline.ds, cmdline.max_nframes, cmdline.pred_fn)
+                                     cmdline.ds, cmdline.max_nframes, cmdline.pred_fn, cmdline.nw, cmdline.ts_dtype)
     elif cmdline.cluster_ts:
         ts = analysis._load_ts(cmdline.vids_dirpath, cmdline.n, cmdline.w,
-                              cmdline.ds, cmdline.max_nframes, cmdline.pred_fn)
-        analysis.cluster_ts(ts, cmdline.method, cmdline.r, cmdline.k, cmdline.it, cmdline.mcs, cmdline.ms)
+                               cmdline.ds, cmdline.max_nframes, cmdline.pred_fn)
+        analysis.cluster_ts(ts, cmdline.method, cmdline.r, cmdline.k, cmdline.it, cmdline.mcs, cmdline.ms, cmdline.nw,
+                            cmdline.sweep, cmdline.bs, cmdline.knn, cmdline.linkage)
     elif cmdline.compute_kclust_error:
         analysis.compute_kclust_error(cmdline.method, cmdline.vids_dirpath, cmdline.n, cmdline.w,
                                       cmdline.ds, cmdline.max_nframes, cmdline.pred_fn,
-                                      cmdline.k, cmdline.it, cmdline.r)
+                                      cmdline.k, cmdline.it, cmdline.r, cmdline.nw)
     elif cmdline.compute_kclust_clusters_ts_dists:
         analysis.compute_kclust_clusters_ts_dists(cmdline.method, cmdline.vids_dirpath, cmdline.n,
                                                            cmdline.w, cmdline.ds,
                                                            cmdline.max_nframes, cmdline.pred_fn,
                                                            cmdline.k, cmdline.it, cmdline.r)
+    elif cmdline.render_hierarchical:
+        analysis.render_hierarchical(cmdline.vids_dirpath, cmdline.n, cmdline.w, cmdline.ds, cmdline.max_nframes,
+                                     cmdline.pred_fn, cmdline.r, cmdline.linkage, cmdline.knn)
+    elif cmdline.assign_new:
+        analysis.assign_new(cmdline.new_vids_dirpath, cmdline.method, cmdline.vids_dirpath, cmdline.n,
+                            cmdline.w, cmdline.ds, cmdline.max_nframes, cmdline.pred_fn,
+                            cmdline.k, cmdline.it, cmdline.r)
+    elif cmdline.sweep_lb_radius:
+        analysis.sweep_lb_radius(cmdline.vids_dirpath, cmdline.n, cmdline.w, cmdline.ds, cmdline.max_nframes,
+                                 cmdline.pred_fn, cmdline.rs, cmdline.nw)
+    elif cmdline.analyze_stability:
+        analysis.analyze_stability(cmdline.method, cmdline.vids_dirpath, cmdline.n, cmdline.w, cmdline.ds,
+                                   cmdline.max_nframes, cmdline.pred_fn, cmdline.k, cmdline.it, cmdline.r,
+                                   cmdline.nb, cmdline.nw)
     elif cmdline.analyze_group_coherence:
         analysis.analyze_group_coherence(cmdline.vids_dirpath, cmdline.n,
-                                         cmdline.w, cmdline.ds, cmdline.max_nframes, cmdline.pred_fn, cmdline.r)
\ No newline at end of file
+                                         cmdline.w, cmdline.ds, cmdline.max_nframes, cmdline.pred_fn, cmdline.r,
+                                         cmdline.nw)
\ No newline at end of file
@@ -7,7 +7,6 @@ from fuzzywuzzy import fuzz
 import io
 import json
 import os
-import pandas as pd
 import pickle
 from pprint import pprint
 import re
@@ -19,6 +18,8 @@ import time
 from core.predictions.utils import detect_peaks, smooth
 from core.utils.CreditsLocator import CreditsLocator
 from core.utils.MovieReader import MovieReader
+from core.utils.manifest import Manifest
+from core.utils.pred_store import convert_csvs, load_preds
 from core.utils.utils import VID_EXTS, VIZ_SENT_PRED_FN, AUDIO_SENT_PRED_FN, \
     CMU_PATH, VIDEOPATH_DB, VIDEOMETADATA_DB
 
@@ -163,6 +164,27 @@ def save_credits_index(vids_dir, overwrite_files=False):
     print 'Credits not located for {} movies:'.format(len(not_located))
     pprint(sorted(not_located))
 
+########################################################################################################################
+# Predictions
+########################################################################################################################
+def convert_preds_to_store(vids_dirpath, remove_csv=False):
+    """
+    Convert visual and audio prediction csvs of every video under vids_dirpath to the binary prediction store
+    (see core/utils/pred_store.py), and refresh the manifest of vids_dirpath
+    """
+    num_converted = convert_csvs(vids_dirpath, [VIZ_SENT_PRED_FN, AUDIO_SENT_PRED_FN], remove_csv=remove_csv)
+    print 'Converted {} prediction files'.format(num_converted)
+    refresh_manifest(vids_dirpath)
+
+def refresh_manifest(vids_dirpath):
+    """
+    Create or update the manifest of videos under vids_dirpath (see core/utils/manifest.py). Only directories that
+    changed since the last refresh are listed again
+    """
+    manifest = Manifest.for_path(vids_dirpath).refresh(vids_dirpath)
+    print 'Manifest lists {} videos, {} with frames'.format(
+        len(manifest.find(vids_dirpath)), len(manifest.find(vids_dirpath, min_frames=1)))
+
 ########################################################################################################################
 # VideoPath DB
 ########################################################################################################################
@@ -197,16 +219,6 @@ def extract_highlight_clips(vids_dirpath, overwrite, verbose):
     CLIP_LENGTH = 30
     OUT_WIDTH = 640
 
-    def find_movie_file(files):
-        """
-        Find movie file (name) in list of files if it exists
-        """
-        for f in files:
-            for ext in VID_EXTS:
-                if f.endswith(ext):
-                    return f
-        return None
-
     def get_timestamp_str(seconds):
         """Return '0h3m01s' for 181"""
         m, s = divmod(seconds, 60)
@@ -472,87 +484,84 @@ def extract_highlight_clips(vids_dirpath, overwrite, verbose):
                 FNULL = open(os.devnull, 'wb')
                 subprocess.call(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
 
-    # Main function starts here -- find all videos with predictions and movies
+    # Main function starts here -- find all videos with predictions and movies (see core/utils/manifest.py)
     nvids = 0
     start_run_time = time.time()
-    for root, dirs, files in os.walk(vids_dirpath):
-        if 'preds' in dirs:
-            viz_path = os.path.join(root, 'preds', VIZ_SENT_PRED_FN)
-            audio_path = os.path.join(root, 'preds', AUDIO_SENT_PRED_FN)
-            movie_file = find_movie_file(files)
-            movie = os.path.basename(root.rstrip('/'))
-            if os.path.exists(viz_path) and os.path.exists(audio_path) and movie_file:
-                vid_start_run_time = time.time()
-                if verbose:
-                    print '=' * 100
-                    print '=' * 100
-                    print '=' * 100
-                else:
-                    print '=' * 100
-                print 'Found data for {}'.format(root)
-
-                # Get some info
-                fn, ext = os.path.splitext(movie_file)
-                movie_path = os.path.join(root, movie_file)
-                out_dirpath = os.path.join(HIGHLIGHTS_PATH, movie)
-
-                # Skip if not overwriting and highlights already exists
-                if os.path.exists(out_dirpath):
-                    if not overwrite:
-                        print 'Skipping -- overwrite=false, highlights directory for movie already exists'
-                        continue
-
-                # Skip if extension isn't mp4
-                if ext not in ['.mp4', '.MP4']:
-                    print 'Skipping -- extension is {}, not mp4'.format(ext)
-                    continue
+    manifest = Manifest.for_path(vids_dirpath).refresh(vids_dirpath)
+    for root in manifest.find(vids_dirpath, pred_fns=[VIZ_SENT_PRED_FN, AUDIO_SENT_PRED_FN], has_movie=True):
+        movie_file = manifest.get(root)['movie_fn']
+        movie = os.path.basename(root.rstrip('/'))
+        vid_start_run_time = time.time()
+        if verbose:
+            print '=' * 100
+            print '=' * 100
+            print '=' * 100
+        else:
+            print '=' * 100
+        print 'Found data for {}'.format(root)
 
-                # Skip videos that aren't as wide as desired width (mostly avi's probably)
-                cmd = 'ffprobe -v error -of flat=s=_ -select_streams v:0 -show_entries stream=width,height'.split(' ') + [movie_path]
-                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                out, err = proc.communicate()           # 'streams_stream_0_width=1280\nstreams_stream_0_height=568\n'
-                m = re.match(r'.+width=([0-9]+)\n.+', out)
-                if (m is None) or (int(m.group(1)) < OUT_WIDTH):
-                    print 'Skipping - video width is {}, less than {}'.format(m.group(1), OUT_WIDTH)
-                    continue
+        # Get some info
+        fn, ext = os.path.splitext(movie_file)
+        movie_path = os.path.join(root, movie_file)
+        out_dirpath = os.path.join(HIGHLIGHTS_PATH, movie)
 
-                # Make directory to store highlight clips (if it doesn't already exist)
-                if os.path.exists(out_dirpath):
-                    # If it reaches this point, overwrite should always be true
-                    # Leaving this if here for clarity
-                    # The skipping if not overwrite is placed further up in the code to short-circuit earlier,
-                    # and not create a directory if it's skipped because of extension of width reasons
-                    if overwrite:
-                        shutil.rmtree(out_dirpath)
-                        os.mkdir(out_dirpath)
-                else:
-                    os.mkdir(out_dirpath)
-                print 'Saving clips to {}'.format(out_dirpath)
+        # Skip if not overwriting and highlights already exists
+        if os.path.exists(out_dirpath):
+            if not overwrite:
+                print 'Skipping -- overwrite=false, highlights directory for movie already exists'
+                continue
+
+        # Skip if extension isn't mp4
+        if ext not in ['.mp4', '.MP4']:
+            print 'Skipping -- extension is {}, not mp4'.format(ext)
+            continue
+
+        # Skip videos that aren't as wide as desired width (mostly avi's probably)
+        cmd = 'ffprobe -v error -of flat=s=_ -select_streams v:0 -show_entries stream=width,height'.split(' ') + [movie_path]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        out, err = proc.communicate()           # 'streams_stream_0_width=1280\nstreams_stream_0_height=568\n'
+        m = re.match(r'.+width=([0-9]+)\n.+', out)
+        if (m is None) or (int(m.group(1)) < OUT_WIDTH):
+            print 'Skipping - video width is {}, less than {}'.format(m.group(1), OUT_WIDTH)
+            continue
+
+        # Make directory to store highlight clips (if it doesn't already exist)
+        if os.path.exists(out_dirpath):
+            # If it reaches this point, overwrite should always be true
+            # Leaving this if here for clarity
+            # The skipping if not overwrite is placed further up in the code to short-circuit earlier,
+            # and not create a directory if it's skipped because of extension of width reasons
+            if overwrite:
+                shutil.rmtree(out_dirpath)
+                os.mkdir(out_dirpath)
+        else:
+            os.mkdir(out_dirpath)
+        print 'Saving clips to {}'.format(out_dirpath)
 
-                # Get peaks
-                # TODO: skip if number of extrema too low or too high?
-                # Minor to-do: column names / number of columns should be put in core/utils/utils.py GLOBALS?
-                viz_preds = range_norm(filter_ends(smooth(pd.read_csv(viz_path).pos.values, window_len=WINDOW_LEN)))
-                viz_peaks = detect_peaks(viz_preds, mpd=MPD, mph=MPH, edge=None, show=SHOW_EXTREMA)
-                viz_valleys = detect_peaks(viz_preds, mpd=MPD, mph=MPH-1.0, edge=None, valley=True, show=SHOW_EXTREMA)
-                audio_preds = range_norm(filter_ends(smooth(pd.read_csv(audio_path).Valence.values, window_len=WINDOW_LEN)))
-                audio_peaks = detect_peaks(audio_preds, mpd=MPD, mph=MPH, edge=None, show=SHOW_EXTREMA)
-                audio_valleys = detect_peaks(audio_preds, mpd=MPD, mph=MPH-1.0, edge=None, valley=True, show=SHOW_EXTREMA)
+        # Get peaks
+        # TODO: skip if number of extrema too low or too high?
+        # Minor to-do: column names / number of columns should be put in core/utils/utils.py GLOBALS?
+        viz_preds = range_norm(filter_ends(smooth(load_preds(root, VIZ_SENT_PRED_FN)['pos'], window_len=WINDOW_LEN)))
+        viz_peaks = detect_peaks(viz_preds, mpd=MPD, mph=MPH, edge=None, show=SHOW_EXTREMA)
+        viz_valleys = detect_peaks(viz_preds, mpd=MPD, mph=MPH-1.0, edge=None, valley=True, show=SHOW_EXTREMA)
+        audio_preds = range_norm(filter_ends(smooth(load_preds(root, AUDIO_SENT_PRED_FN)['Valence'], window_len=WINDOW_LEN)))
+        audio_peaks = detect_peaks(audio_preds, mpd=MPD, mph=MPH, edge=None, show=SHOW_EXTREMA)
+        audio_valleys = detect_peaks(audio_preds, mpd=MPD, mph=MPH-1.0, edge=None, valley=True, show=SHOW_EXTREMA)
 
-                # Merge, dedup, tag, etc. extrema
-                extrema, tags = merge_extrema([viz_peaks, viz_valleys, audio_peaks, audio_valleys],
-                                              ['visual', 'visual', 'audio', 'audio'],
-                                              ['peak', 'valley', 'peak', 'valley'])
+        # Merge, dedup, tag, etc. extrema
+        extrema, tags = merge_extrema([viz_peaks, viz_valleys, audio_peaks, audio_valleys],
+                                      ['visual', 'visual', 'audio', 'audio'],
+                                      ['peak', 'valley', 'peak', 'valley'])
 
-                # Save each highlight clip
-                save_extrema_clips(extrema, tags, movie_path, movie, ext, verbose)
+        # Save each highlight clip
+        save_extrema_clips(extrema, tags, movie_path, movie, ext, verbose)
 
-                nvids += 1
+        nvids += 1
 
-                # Stats
-                print 'Done extracting {} clips:'.format(len(extrema))
-                print 'Time elapsed for video: {:.2f} seconds'.format(time.time() - vid_start_run_time)
-                print 'Extracted clips from {} videos'.format(nvids)
+        # Stats
+        print 'Done extracting {} clips:'.format(len(extrema))
+        print 'Time elapsed for video: {:.2f} seconds'.format(time.time() - vid_start_run_time)
+        print 'Extracted clips from {} videos'.format(nvids)
 
 
     print 'Total run time: {}'.format(time.time() - start_run_time)
@@ -564,15 +573,6 @@ def create_videopath_db():
     """
     Create sqllite db storing information about video paths, formats, frames, etc.
     """
-    def get_movie_fn_if_exists(files):
-        for f in files:
-            if 'sample' in f.lower():
-                continue
-            for ext in VID_EXTS:
-                if f.endswith(ext):
-                    return f
-        return None
-
     def get_dataset_name_from_dir(dir):
         # MovieQA_full_movies -> MovieQA
         if dir == 'MovieQA_full_movies':
@@ -596,34 +596,35 @@ def create_videopath_db():
                  'has_frames INTEGER,'
                  'num_frames INTEGER)')
 
-    # Find all directories with movies
+    # Find all directories with movies (see core/utils/manifest.py)
+    manifest = Manifest.for_path(VIDEOS_PATH).refresh(VIDEOS_PATH)
     with conn:
         cur = conn.cursor()
-        for root, dirs, files in os.walk(VIDEOS_PATH):
-            movie_fn = get_movie_fn_if_exists(files)
-            if movie_fn:
-                # root: data/videos/films/MovieQA_full_movies/Yes Man (2008)
-                title = os.path.basename(root)
-                category = root.split(VIDEOS_PATH)[1].split('/')[1]
-                dirpath = root
-                # print root
-                datasets = get_dataset_name_from_dir(root.split(category)[1].split('/')[1])
-                ext = movie_fn.split('.')[-1]
-                has_frames = int(('frames' in dirs) and (len(os.listdir(os.path.join(root, 'frames'))) > 0))
-                num_frames = len(os.listdir(os.path.join(root, 'frames'))) if has_frames else 0
-
-                print category, title, datasets, dirpath, movie_fn, ext, has_frames, num_frames
-
-                cur.execute("INSERT INTO VideoPath VALUES(?, ?, ?, ?, ?, ?, ?, ?)", (
-                    category,
-                    title.decode('utf8'),
-                    datasets,
-                    dirpath.decode('utf8'),
-                    movie_fn.decode('utf8'),
-                    ext,
-                    has_frames,
-                    num_frames
-                ))
+        for root in manifest.find(VIDEOS_PATH, has_movie=True):
+            entry = manifest.get(root)
+            movie_fn = entry['movie_fn']
+            # root: data/videos/films/MovieQA_full_movies/Yes Man (2008)
+            title = os.path.basename(root)
+            category = root.split(VIDEOS_PATH)[1].split('/')[1]
+            dirpath = root
+            # print root
+            datasets = get_dataset_name_from_dir(root.split(category)[1].split('/')[1])
+            ext = movie_fn.split('.')[-1]
+            num_frames = entry['num_frames'] or 0
+            has_frames = int(num_frames > 0)
+
+            print category, title, datasets, dirpath, movie_fn, ext, has_frames, num_frames
+
+            cur.execute("INSERT INTO VideoPath VALUES(?, ?, ?, ?, ?, ?, ?, ?)", (
+                category,
+                title.decode('utf8'),
+                datasets,
+                dirpath.decode('utf8'),
+                movie_fn.decode('utf8'),
+                ext,
+                has_frames,
+                num_frames
+            ))
 
     # TODO and note on datasets field (not high priority, as datasets not being used right now)
     # 1) datasets is meant to track which existing datasets movie is also a part of.
@@ -873,6 +874,10 @@ if __name__ == '__main__':
     parser.add_argument('--save_credits_index', dest='save_credits_index', action='store_true')
     parser.add_argument('--save_credits_index_overwrite', dest='save_credits_index_overwrite', default=False,
                         action='store_true', help='overwrite credits_index.txt files')
+    parser.add_argument('--convert_preds_to_store', dest='convert_preds_to_store', action='store_true')
+    parser.add_argument('--remove_csv', dest='remove_csv', action='store_true',
+                        help='with convert_preds_to_store, remove each csv once converted')
+    parser.add_argument('--refresh_manifest', dest='refresh_manifest', action='store_true')
     parser.add_argument('--extract_highlight_clips', dest='extract_highlight_clips', action='store_true')
     parser.add_argument('--overwrite_clips', dest='overwrite_clips', action='store_true')
     parser.add_argument('--verbose', dest='verbose', action='store_true')
@@ -893,6 +898,10 @@ if __name__ == '__main__':
         convert_avis_to_mp4s(cmdline.vids_dir)
     elif cmdline.save_credits_index:
         save_credits_index(cmdline.vids_dir, overwrite_files=cmdline.save_credits_index_overwrite)
+    elif cmdline.convert_preds_to_store:
+        convert_preds_to_store(cmdline.vids_dirpath, remove_csv=cmdline.remove_csv)
+    elif cmdline.refresh_manifest:
+        refresh_manifest(cmdline.vids_dirpath)
     elif cmdline.extract_highlight_clips:
         extract_highlight_clips(cmdline.vids_dirpath, cmdline.overwrite_clips, cmdline.verbose)
     elif cmdline.create_videopath_db:
@@ -53,6 +53,8 @@ if __name__ == '__main__':
     parser.add_argument('--dropout_conf', dest='dropout_conf', action='store_true',
                         help='Create confidence intervals by predicting each item batch_size times and calculating '\
                         'mean and std of predictions')
+    parser.add_argument('--export_csv', dest='export_csv', action='store_true', default=False,
+                        help='with mode=predict, also write predictions as csv next to the binary prediction store')
 
     # Bookkeeping, checkpointing, etc.
     parser.add_argument('--save_every_epoch', dest='save_every_epoch', type=int, default=None,
@@ -10,6 +10,8 @@ import tensorflow as tf
 import time
 
 from core.audio.AudioCNN import AudioCNN
+from core.utils.manifest import Manifest
+from core.utils.pred_store import save_preds
 from core.utils.utils import get_optimizer, load_model, save_model, setup_logging
 from datasets import get_dataset, MELGRAM_20S_SIZE, NUMPTS_AND_MEANSTD_REG_PATH, NUMPTS_AND_MEANSTD_CLASS_PATH
 from prepare_data import compute_log_melgram_from_np, N_FFT, N_MELS, HOP_LEN
@@ -204,11 +206,9 @@ class Network(object):
         e.g. [data/videos/films/animated/The Incredibles (2004)/The Incredibles (2004).mp3, ...]
         """
         self.logger.info('Getting all vidpaths with mp3')
-        mp3paths = []
-        for root, dirs, files in os.walk(starting_dir):
-            for f in files:
-                if f.endswith('mp3'):
-                    mp3paths.append(os.path.join(root, f))
+        manifest = Manifest.for_path(starting_dir).refresh(starting_dir, logger=self.logger)
+        mp3paths = [os.path.join(vid_dirpath, manifest.get(vid_dirpath)['audio_fn'])
+                    for vid_dirpath in manifest.find(starting_dir, has_audio=True)]
         return mp3paths
 
     def softmax(self, w, t = 1.0):
@@ -283,11 +283,6 @@ class Network(object):
         else:
             num_batches = int(math.floor(float(num_pts) / self.params['batch_size']))
 
-        # Make directory to store predictions
-        preds_dir = os.path.join(os.path.dirname(mp3path), 'preds')
-        if not os.path.exists(preds_dir):
-            os.mkdir(preds_dir)
-
         # Get file to write predictions
         fn = 'audio-{}'.format(self.params['obj'])
         if self.params['load_epoch'] is not None:
@@ -358,20 +353,19 @@ class Network(object):
                             # 0 because only using bs = 1 right now
                             s2preds[cur_s].append(self.softmax(fc[0])[1])  # 1 for positive
 
-        with open(os.path.join(preds_dir, fn), 'wb') as f:
-            # If creating confidence intervals from dropout, each batch is one audio sample repeated
-            if self.params['dropout_conf']:
-                f.write('Valence_mean,Valence_std\n')
-                for s in sorted(s2preds):
-                    mean = np.mean(s2preds[s])
-                    std = np.std(s2preds[s])
-                    f.write('{},{}\n'.format(mean, std))
-            else:
-                f.write('Valence\n')
-                for s in sorted(s2preds):
-                    # print s, s2preds[s]
-                    pred = sum(s2preds[s]) / float(len(s2preds[s]))
-                    f.write('{}\n'.format(pred))
+        # Save all seconds at once to the prediction store (see pred_store.py)
+        seconds = sorted(s2preds)
+        # If creating confidence intervals from dropout, each batch is one audio sample repeated
+        if self.params['dropout_conf']:
+            labels = ['Valence_mean', 'Valence_std']
+            rows = [[np.mean(s2preds[s]), np.std(s2preds[s])] for s in seconds]
+        else:
+            labels = ['Valence']
+            rows = [[sum(s2preds[s]) / float(len(s2preds[s]))] for s in seconds]
+        save_preds(os.path.dirname(mp3path), fn, labels, np.array(rows).reshape(-1, len(labels)),
+                   meta={'obj': self.params['obj'], 'arch': self.params['arch'], 'epoch': self.params['load_epoch'],
+                         'dropout_conf': self.params['dropout_conf'], 'stride': self.params['stride']},
+                   export_csv=self.params['export_csv'])
 
         print 'Number pts according to source signal: {}'.format(num_pts)
         print 'Number batches according to source signal: {}'.format(num_batches)
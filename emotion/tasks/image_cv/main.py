@@ -62,6 +62,8 @@ if __name__ == '__main__':
                         help='uniform,recursive; used with mode=test')
     parser.add_argument('--scramble_blocksize', dest='scramble_blocksize', default=None, type=int,
                         help='multiple of 2 in range [2,128]')
+    parser.add_argument('--export_csv', dest='export_csv', action='store_true', default=False,
+                        help='with mode=predict, also write predictions as csv next to the binary prediction store')
 
     # Bookkeeping, checkpointing, etc.
     parser.add_argument('--save_every_epoch', dest='save_every_epoch', type=int, default=None,
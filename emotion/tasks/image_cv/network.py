@@ -8,6 +8,8 @@ import tensorflow as tf
 
 from datasets import get_dataset
 from core.image.ff_net import FFNet
+from core.utils.manifest import Manifest
+from core.utils.pred_store import save_preds
 from core.utils.utils import get_optimizer, load_model, save_model, setup_logging, scramble_img, scramble_img_recursively
 from prepare_data import get_grayscale_hist, get_color_hist
 
@@ -198,10 +200,8 @@ class Network(object):
         Return list of full paths to every video directory that contains frames/
         e.g. [<VIDEOS_PATH>/@Animated/@OldDisney/Feast/, ...]
         """
-        vidpaths = []
-        for root, dirs, files in os.walk(starting_dir):
-            if 'frames' in os.listdir(root):
-                vidpaths.append(root)
+        manifest = Manifest.for_path(starting_dir).refresh(starting_dir, logger=self.logger)
+        vidpaths = manifest.find(starting_dir, min_frames=0)
 
         return vidpaths
 
@@ -240,12 +240,7 @@ class Network(object):
                 self.logger.info('Restoring checkpoint')
                 saver = load_model(sess, self.params)
 
-                # Make directory to store predictions
-                preds_dir = os.path.join(dirpath, 'preds')
-                if not os.path.exists(preds_dir):
-                    os.mkdir(preds_dir)
-
-                # Predict, write to file
+                # Predict, collect rows and save all at once to the prediction store (see pred_store.py)
                 idx2label = self.get_idx2label()
                 num_batches = self.dataset.get_num_batches('predict')
                 if self.params['load_epoch'] is not None:
@@ -253,19 +248,21 @@ class Network(object):
                 else:
                     fn = '{}.csv'.format(self.params['obj'])
 
-                with open(os.path.join(preds_dir, fn), 'w') as f:
-                    labels = [idx2label[i] for i in range(self.output_dim)]
-                    f.write('{}\n'.format(','.join(labels)))
-                    for j in range(num_batches):
-                        last_fc, probs = sess.run([model.last_fc, model.probs],
-                                                  feed_dict={'img_batch:0': img_batch.eval()})
-
-                        if self.params['debug']:
-                            print last_fc
-                            print probs
-                        for frame_prob in probs:
-                            frame_prob = ','.join([str(v) for v in frame_prob])
-                            f.write('{}\n'.format(frame_prob))
+                labels = [idx2label[i] for i in range(self.output_dim)]
+                rows = []
+                for j in range(num_batches):
+                    last_fc, probs = sess.run([model.last_fc, model.probs],
+                                              feed_dict={'img_batch:0': img_batch.eval()})
+
+                    if self.params['debug']:
+                        print last_fc
+                        print probs
+                    rows.extend(probs)
+
+                save_preds(dirpath, fn, labels, np.array(rows).reshape(-1, len(labels)),
+                           meta={'obj': self.params['obj'], 'arch': self.params['arch'],
+                                 'epoch': self.params['load_epoch']},
+                           export_csv=self.params['export_csv'])
 
                 coord.request_stop()
                 coord.join(threads)
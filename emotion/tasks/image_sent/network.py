@@ -15,6 +15,8 @@ from core.image.basic_plus_cnn import BasicPlusCNN
 from core.image.ff_net import FFNet
 from core.image.vgg.vgg16 import vgg16
 from core.image.modified_alexnet import ModifiedAlexNet
+from core.utils.manifest import Manifest
+from core.utils.pred_store import save_preds
 from core.utils.utils import get_optimizer, load_model, save_model, setup_logging, scramble_img, scramble_img_recursively
 
 class Network(object):
@@ -384,10 +386,8 @@ class Network(object):
         Return list of full paths to every video directory that contains frames/
         e.g. [<VIDEOS_PATH>/@Animated/@OldDisney/Feast/, ...]
         """
-        vidpaths = []
-        for root, dirs, files in os.walk(starting_dir):
-            if 'frames' in os.listdir(root):
-                vidpaths.append(root)
+        manifest = Manifest.for_path(starting_dir).refresh(starting_dir, logger=self.logger)
+        vidpaths = manifest.find(starting_dir, min_frames=0)
 
         return vidpaths
 
@@ -499,12 +499,7 @@ class Network(object):
                 self.logger.info('Restoring checkpoint')
                 saver = load_model(sess, self.params)
 
-                # Make directory to store predictions
-                preds_dir = os.path.join(dirpath, 'preds')
-                if not os.path.exists(preds_dir):
-                    os.mkdir(preds_dir)
-
-                # Predict, write to file
+                # Predict, collect rows and save all at once to the prediction store (see pred_store.py)
                 idx2label = self.get_idx2label()
                 num_batches = self.dataset.get_num_batches('predict')
                 fn = self.params['obj']
@@ -514,37 +509,36 @@ class Network(object):
                     fn += '_conf{}'.format(self.params['batch_size'])
                 fn += '.csv'
 
-                with open(os.path.join(preds_dir, fn), 'w') as f:
-                    # If creating confidence intervals from dropout, each batch is one image
-                    if self.params['dropout_conf']:
-                        header = []
-                        for i in range(self.output_dim):
-                            header.extend([str(idx2label[i]) + '_mean', str(idx2label[i]) + '_std'])
-                        f.write('{}\n'.format(','.join(header)))
-                        for j in range(num_batches):
-                            last_fc, probs = sess.run([model.last_fc, model.probs],
-                                                      feed_dict={'img_batch:0': img_batch.eval()})
-                            if self.params['debug']:
-                                print last_fc
-                                print probs
-                            means = np.mean(probs, axis=0)
-                            stds = np.std(probs, axis=0)
-                            row = [item for sublst in zip(means, stds) for item in sublst]  # list comp for flatten
-                            row = ','.join([str(v) for v in row])
-                            f.write('{}\n'.format(row))
-                    else:
-                        header = [idx2label[i] for i in range(self.output_dim)]
-                        f.write('{}\n'.format(','.join(header)))
-                        for j in range(num_batches):
-                            last_fc, probs = sess.run([model.last_fc, model.probs],
-                                                      feed_dict={'img_batch:0': img_batch.eval()})
-
-                            if self.params['debug']:
-                                print last_fc
-                                print probs
-                            for frame_prob in probs:
-                                frame_prob = ','.join([str(v) for v in frame_prob])
-                                f.write('{}\n'.format(frame_prob))
+                rows = []
+                # If creating confidence intervals from dropout, each batch is one image
+                if self.params['dropout_conf']:
+                    header = []
+                    for i in range(self.output_dim):
+                        header.extend([str(idx2label[i]) + '_mean', str(idx2label[i]) + '_std'])
+                    for j in range(num_batches):
+                        last_fc, probs = sess.run([model.last_fc, model.probs],
+                                                  feed_dict={'img_batch:0': img_batch.eval()})
+                        if self.params['debug']:
+                            print last_fc
+                            print probs
+                        means = np.mean(probs, axis=0)
+                        stds = np.std(probs, axis=0)
+                        rows.append(np.column_stack([means, stds]).ravel())     # mean, std of each label
+                else:
+                    header = [idx2label[i] for i in range(self.output_dim)]
+                    for j in range(num_batches):
+                        last_fc, probs = sess.run([model.last_fc, model.probs],
+                                                  feed_dict={'img_batch:0': img_batch.eval()})
+
+                        if self.params['debug']:
+                            print last_fc
+                            print probs
+                        rows.extend(probs)
+
+                save_preds(dirpath, fn, header, np.array(rows).reshape(-1, len(header)),
+                           meta={'obj': self.params['obj'], 'arch': self.params['arch'],
+                                 'epoch': self.params['load_epoch'], 'dropout_conf': self.params['dropout_conf']},
+                           export_csv=self.params['export_csv'])
 
                 coord.request_stop()
                 coord.join(threads)
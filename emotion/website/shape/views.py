@@ -6,13 +6,17 @@
 
 from flask import Flask, Response, request, render_template
 import json
+import numpy as np
 from natsort import natsorted
 import os
-import pandas as pd
 import pickle
 
 from shape import app
+from core.predictions.kclust_result import KClustResult
 from core.predictions.utils import smooth
+from core.utils.artifact_cache import ArtifactCache
+from core.utils.manifest import Manifest
+from core.utils.pred_store import has_preds, load_preds
 from core.utils.utils import get_credits_idx, AUDIO_SENT_PRED_FN, VIZ_SENT_PRED_FN
 
 ### PARAMS ###
@@ -25,30 +29,17 @@ CLUSTERS_KS = [2, 3, 4  , 5, 6, 7, 8, 9, 10]
 VIDEOS_PATH = 'shape/static/videos/'
 OUTPUTS_DATA_PATH = 'shape/outputs/cluster/data/'
 
-# Clusters view paths
-TS_FN = \
-    {'films': 'ts_dirfilms-n510-w1000-ds1-maxnf10000-fnsent_biclass_19.pkl',
-     'shorts': 'ts_dirshorts-n1326-w0.14-ds1-maxnf1800-fnsent_biclass_19.pkl',
+# Clusters view: parameters of the time series and clusterings shown. The newest artifacts computed with them are
+# found in the artifact cache of tasks/analysis (see core/utils/artifact_cache.py)
+ARTIFACT_CACHE_PATH = os.path.join(OUTPUTS_DATA_PATH, 'cache')
+TS_PARAMS = \
+    {'films': {'vids_dir': 'films', 'w': 1000, 'ds': 1, 'max_nframes': 10000, 'pred_fn': 'sent_biclass_19.csv'},
+     'shorts': {'vids_dir': 'shorts', 'w': 0.14, 'ds': 1, 'max_nframes': 1800, 'pred_fn': 'sent_biclass_19.csv'},
      'ads': None}
-TS_IDX2TITLE_FN = \
-    {'films': 'ts-idx2title_dirfilms-n510-w1000-ds1-maxnf10000-fnsent_biclass_19.pkl',
-     'shorts': 'ts-idx2title_dirshorts-n1326-w0.14-ds1-maxnf1800-fnsent_biclass_19.pkl',
-     'ads': None}
-TS_MEAN_FN = \
-    {'films': 'ts-mean_dirfilms-n510-w1000-ds1-maxnf10000-fnsent_biclass_19.pkl',
-     'shorts': 'ts-mean_dirshorts-n1326-w0.14-ds1-maxnf1800-fnsent_biclass_19.pkl',
-     'ads': None}
-TS_STD_FN = \
-    {'films': 'ts-std_dirfilms-n510-w1000-ds1-maxnf10000-fnsent_biclass_19.pkl',
-     'shorts': 'ts-std_dirshorts-n1326-w0.14-ds1-maxnf1800-fnsent_biclass_19.pkl',
-     'ads': None}
-CENTROIDS_FN = \
-    {'films': 'kmedoids-centroids_dirfilms-n510-w1000-ds1-maxnf10000-fnsent_biclass_19-k{}-it100-r250.pkl',
-     'shorts': 'kmedoids-centroids_dirshorts-n1326-w0.14-ds1-maxnf1800-fnsent_biclass_19-k{}-it100-r45.pkl',
-     'ads': None}
-TS_DISTS_FN = \
-    {'films': 'kmedoids-ts-dists_dirfilms-n510-w1000-ds1-maxnf10000-fnsent_biclass_19-k{}-it100-r250.pkl',
-     'shorts': 'kmedoids-ts-dists_dirshorts-n1326-w0.14-ds1-maxnf1800-fnsent_biclass_19-k{}-it100-r45.pkl',
+# Clustering results (labels, medoids, distances, centroids; see core/predictions/kclust_result.py), for every k
+KCLUST_PARAMS = \
+    {'films': {'alg': 'kmedoids', 'it': 100, 'r': 250},
+     'shorts': {'alg': 'kmedoids', 'it': 100, 'r': 45},
      'ads': None}
 
 ### GLOBALS ###
@@ -68,7 +59,7 @@ cur_mp3path = None
 
 # Clusters view
 clusters = {}           # fmt -> key (k) -> value {assignments: k-idx: array, centroids: k-idx: array, closest: k-idx: array of member_indices}
-ts = {}                 # fmt -> list of arrays
+ts = {}                 # fmt -> idx -> series (un-normalized list), only for the members shown in the Clusters view
 ts_idx2title = {}       # fmt -> idx -> title
 
 ########################################################################################################################
@@ -93,12 +84,12 @@ def get_preds_from_dfs(name2df_and_window):
         window = df_and_window['window']
         preds[name] = {}
         if name == 'visual':
-            values = list(smooth(df.pos.values, window_len=window)) if (df is not None) else []
+            values = list(smooth(df['pos'], window_len=window)) if (df is not None) else []
             preds[name]['pos'] = values
             preds[name]['std'] = [0.04 for _ in range(len(values))]
         elif name == 'audio':
-            values = list(smooth(df.Valence_mean.values, window_len=window)) if (df is not None) else []
-            std = list(smooth(df.Valence_std.values, window_len=window)) if (df is not None) else []
+            values = list(smooth(df['Valence_mean'], window_len=window)) if (df is not None) else []
+            std = list(smooth(df['Valence_std'], window_len=window)) if (df is not None) else []
             std = [get_capped_std_val(values[i], std_val) for i, std_val in enumerate(std)]
             preds[name]['pos'] = values
             preds[name]['std'] = std
@@ -114,18 +105,10 @@ def get_cur_vid_df_and_framepaths(cur_title):
     """
     global title2vidpath, cur_viz_pd_df, cur_audio_pd_df, cur_vid_framepaths
 
-    # Get dataframe
-    viz_preds_path = os.path.join(title2vidpath[cur_title], 'preds', VIZ_SENT_PRED_FN)
-    if os.path.exists(viz_preds_path):
-        cur_viz_pd_df = pd.read_csv(viz_preds_path)
-    else:
-        cur_viz_pd_df = None
-
-    audio_preds_path = os.path.join(title2vidpath[cur_title], 'preds', AUDIO_SENT_PRED_FN)
-    if os.path.exists(audio_preds_path):
-        cur_audio_pd_df = pd.read_csv(audio_preds_path)
-    else:
-        cur_audio_pd_df = None
+    # Get predictions (Preds from the binary prediction store, or the csv for videos not yet converted)
+    vidpath = title2vidpath[cur_title]
+    cur_viz_pd_df = load_preds(vidpath, VIZ_SENT_PRED_FN) if has_preds(vidpath, VIZ_SENT_PRED_FN) else None
+    cur_audio_pd_df = load_preds(vidpath, AUDIO_SENT_PRED_FN) if has_preds(vidpath, AUDIO_SENT_PRED_FN) else None
 
     # Get framepaths
     # Note: vps in title2vidpath is of the form '<VIDEOS_PATH>/films/animated/Frozen (2013)/...'
@@ -138,13 +121,12 @@ def get_cur_vid_df_and_framepaths(cur_title):
     cur_vid_framepaths = natsorted(cur_vid_framepaths)
 
     # Ignore credits
-    vidpath = title2vidpath[cur_title]
     credit_idx = get_credits_idx(vidpath)
     if credit_idx:
         if cur_viz_pd_df is not None:
-            cur_viz_pd_df = cur_viz_pd_df[:credit_idx]
+            cur_viz_pd_df = cur_viz_pd_df.head(credit_idx)
         if cur_audio_pd_df is not None:
-            cur_audio_pd_df = cur_audio_pd_df[:credit_idx]
+            cur_audio_pd_df = cur_audio_pd_df.head(credit_idx)
         cur_vid_framepaths = cur_vid_framepaths[:credit_idx]
 
     return cur_viz_pd_df, cur_audio_pd_df, cur_vid_framepaths
@@ -172,32 +154,18 @@ def get_cur_mp3path(title):
 def get_all_valid_vidpaths():
     """
     Return list of full paths to every video directory that a) contains frames/ directory, b) predictions/ directory,
-    and c) frames/ directory has more than 0 frames. Starts walking in VIDEOS_PATH directory. Each full path is of the
+    and c) frames/ directory has more than 0 frames. Listed from the manifest of VIDEOS_PATH. Each full path is of the
     form '<VIDEOS_PATH>/films/animated/Frozen (2013)/...'
     """
-    def root_contains_valid_fmt(root):
-        for fmt in FORMATS:
-            if fmt in root:
-                return True
-        return False
-
-    def walk_dirpath(dirpath):
-        vidpaths_nframes = []
-        for root, dirs, files in os.walk(dirpath):
-            if not root_contains_valid_fmt(root):
-                continue
-
-            if ('frames' in os.listdir(root)) and ('preds' in os.listdir(root)):
-                if (AUDIO_SENT_PRED_FN in os.listdir(os.path.join(root, 'preds'))) and \
-                    (VIZ_SENT_PRED_FN in os.listdir(os.path.join(root, 'preds'))):
-                    nframes = len(os.listdir(os.path.join(root, 'frames')))
-                    if nframes > 0:
-                        vidpaths_nframes.append([root, nframes])
-        return vidpaths_nframes
+    def find_in_dirpath(dirpath):
+        # Corpus manifest (see core/utils/manifest.py) only relists directories that changed since the last run
+        manifest = Manifest.for_path(dirpath).refresh(dirpath)
+        vid_dirpaths = manifest.find(dirpath, min_frames=1, pred_fns=[AUDIO_SENT_PRED_FN, VIZ_SENT_PRED_FN])
+        return [[root, manifest.get(root)['num_frames']] for root in vid_dirpaths]
 
     vidpaths_nframes = []
     for fmt in FORMATS:
-        vidpaths_nframes.extend(walk_dirpath(os.path.join(VIDEOS_PATH, fmt)))
+        vidpaths_nframes.extend(find_in_dirpath(os.path.join(VIDEOS_PATH, fmt)))
 
     return vidpaths_nframes
 
@@ -241,26 +209,24 @@ def setup_initial_data(load_clusters=False):
         # NOTE: all the time series are of the same length -- this is the saved interpolated time series used during
         # clustering. These are used to display the closest movies in the clusters view
 
+        cache = ArtifactCache(ARTIFACT_CACHE_PATH)
+        fmt2ts_lineage = {}
+        fmt2ts = {}
         fmt2mean, fmt2std = {}, {}
         for fmt in FORMATS:
             try:
+                # Newest time series for the parameters
+                lineage = cache.latest('ts', TS_PARAMS[fmt])
+                fmt2ts_lineage[fmt] = lineage
+
                 # Load mean and std to unnormalize time series
-                mean_fn = TS_MEAN_FN[fmt]
-                std_fn = TS_STD_FN[fmt]
-                mean_path = os.path.join(OUTPUTS_DATA_PATH, mean_fn)
-                std_path = os.path.join(OUTPUTS_DATA_PATH, std_fn)
-                with open(mean_path) as f:
-                    mean = pickle.load(f).mean()
-                    fmt2mean[fmt] = mean
-                with open(std_path) as f:
-                    std = pickle.load(f).mean()
-                    fmt2std[fmt] = std
-
-                # Load time series and unnormalize each one
-                ts[fmt] = pickle.load(open(os.path.join(OUTPUTS_DATA_PATH, TS_FN[fmt]), 'rb'))
-                ts[fmt] = [ts[fmt][i] * fmt2std[fmt] + fmt2mean[fmt] for i in range(len(ts[fmt]))]
-                ts[fmt] = [list(arr) for arr in ts[fmt]]        # make it serializable
-                ts_idx2title[fmt] = pickle.load(open(os.path.join(OUTPUTS_DATA_PATH, TS_IDX2TITLE_FN[fmt]), 'rb'))
+                fmt2mean[fmt] = float(np.load(cache.get_path(lineage, 'ts-mean.npy'), mmap_mode='r').mean())
+                fmt2std[fmt] = float(np.load(cache.get_path(lineage, 'ts-std.npy'), mmap_mode='r').mean())
+
+                # Time series, memory-mapped so gunicorn workers share one copy. Only the series shown are
+                # unnormalized and made serializable, once clusters are loaded
+                fmt2ts[fmt] = np.load(cache.get_path(lineage, 'ts.npy'), mmap_mode='r')
+                ts_idx2title[fmt] = pickle.load(open(cache.get_path(lineage, 'ts-idx2title.pkl'), 'rb'))
 
             except Exception as e:
                 # print fmt, e
@@ -271,34 +237,36 @@ def setup_initial_data(load_clusters=False):
             clusters[fmt] = {}
             for k in CLUSTERS_KS:
                 try:
+                    # Newest result for the parameters, computed from the time series loaded above
+                    params = dict(TS_PARAMS[fmt], k=k, **KCLUST_PARAMS[fmt])
+                    ts_lineage = fmt2ts_lineage[fmt]
+                    lineage = cache.latest('kclust', params, inputs={'ts': ts_lineage['files']['ts.npy']})
                     k = str(k)          # use string so it's treated as a js Object instead of an array in template
-                    centroids_fn = CENTROIDS_FN[fmt].format(k)
-                    ts_dists_fn = TS_DISTS_FN[fmt].format(k)
-                    centroids_path = os.path.join(OUTPUTS_DATA_PATH, centroids_fn)
-                    ts_dists_path = os.path.join(OUTPUTS_DATA_PATH, ts_dists_fn)
-                    if os.path.exists(centroids_path) and os.path.exists(ts_dists_path):
+                    if lineage is not None:
+                        result = KClustResult.load(cache.get_path(lineage, 'result.kclust'))
                         clusters[fmt][k] = {}
-                        with open(centroids_path, 'rb') as f:
-                            clusters[fmt][k]['centroids'] = pickle.load(f)
-
-                        # TS Distances to centroids
-                        # ts_dists: dict, key is int (centroid_idx), value = dict (key is member_idx, value is distance)
-                        ts_dists_fn = TS_DISTS_FN[fmt].format(k)
-                        ts_dists_path = os.path.join(OUTPUTS_DATA_PATH, ts_dists_fn)
-                        if os.path.exists(ts_dists_path):
-                            with open(ts_dists_path) as f:
-                                kdists = pickle.load(f)      # key is ts_index, value is distance to its centroid
-                            centroid2closest = {}
-                            for centroid_idx, dists in kdists.items():
-                                sorted_member_indices = sorted(dists, key=dists.get)
-                                top_n = sorted_member_indices[:10]
-                                # top_n_series = [ts['films'][m_idx] for m_idx in top_n]
+                        clusters[fmt][k]['centroids'] = result.centroids.tolist()
+
+                        # Members closest to their medoid
+                        centroid2closest = {}
+                        for centroid_idx in range(result.num_clust):
+                            top_n = result.closest(centroid_idx, 10).tolist()
+                            if len(top_n) > 0:
                                 centroid2closest[centroid_idx] = top_n
-                            clusters[fmt][k]['closest'] = centroid2closest
+                        clusters[fmt][k]['closest'] = centroid2closest
                 except Exception as e:
                     # print e
                     pass
 
+        # Series of the members shown
+        for fmt in fmt2ts:
+            idxs = set()
+            for k_clusters in clusters[fmt].values():
+                for top_n in k_clusters['closest'].values():
+                    idxs.update(top_n)
+            ts[fmt] = {idx: list(np.asarray(fmt2ts[fmt][idx], dtype=np.float64) * fmt2std[fmt] + fmt2mean[fmt])
+                       for idx in idxs}
+
     print 'Setup done'
 
 #################################################################################################